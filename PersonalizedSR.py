@@ -1,16 +1,45 @@
 import whisper
+from whisper.tokenizer import get_tokenizer
 import wave
 import numpy as np
 import os
 import json
 from datetime import datetime
 import traceback
+import contextlib
+import importlib
+import copy
 import threading
 import re
+import math
+import time
 import sys
 from tqdm import tqdm
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
+from job_scheduler import JobCancelled
+from dataset_audio import normalize_audio, load_dataset_audio, find_sample_audio, DATASET_AUDIO_NAME
+from mel_features import FeatureCache, batch_log_mel_spectrogram, load_window_audio
+from decoding_presets import get_preset, DEFAULT_PRESET
+from hardware_calibration import load_calibration
+from decoding_cascade import cascade_transcribe
+from repetition_guard import repetition_guard, RepetitionStats, DEFAULT_LOOP_POLICY
+from training_checkpoint import (CheckpointWriter, CheckpointPolicy, find_latest_checkpoint, find_resumable_run,
+                                 capture_rng_state, restore_rng_state, epoch_batches, CHECKPOINT_SUBDIR,
+                                 DEFAULT_CHECKPOINT_MINUTES, DEFAULT_KEEP_CHECKPOINTS)
+from training_controller import (EarlyStopping, evaluate_cer, split_dataset, lr_lambda,
+                                 DEFAULT_VALIDATION_SPLIT, DEFAULT_LR_SCHEDULE, DEFAULT_WARMUP_RATIO, DEFAULT_PATIENCE)
+from training_windows import build_training_windows
+from token_cache import TokenCache
+from training_batches import bucket_batches, padding_ratio, collate_windows, window_losses
+from model_registry import ModelRegistry, DEFAULT_QUOTA_BYTES
+from model_delta import (delta_reference, delta_checkpoint, checkpoint_reference, is_delta_checkpoint, load_delta_model,
+                         DEFAULT_TOLERANCE as DEFAULT_DELTA_TOLERANCE)
+from model_export import load_exported_model, source_signature, INFERENCE_BACKENDS, DEFAULT_BACKEND
+from compiled_inference import get_compiled_model, warmup_batch_sizes
+from training_memory import (select_trainable_parameters, build_optimizer, count_parameters, optimizer_state_bytes,
+                             peak_rss_bytes, autocast_context, share_frozen_weights, enable_gradient_checkpointing, DEFAULT_OPTIMIZER,
+                             DEFAULT_PRECISION)
 
 # プロジェクトのパス設定
 PROJECT_DIR = os.path.abspath(os.path.join(os.getenv('LOCALAPPDATA'), 'WhisperSR'))
@@ -21,16 +50,23 @@ FINETUNED_DIR = os.path.join(PROJECT_DIR, 'finetuned_models')
 MODELS_DIR = os.path.join(PROJECT_DIR, 'models')
 TEMP_DIR = os.path.join(PROJECT_DIR, 'temp')
 ASSETS_DIR = os.path.join(PROJECT_DIR, 'assets')
+FEATURE_CACHE_DIR = os.path.join(PROJECT_DIR, 'feature_cache')
+TOKEN_CACHE_DIR = os.path.join(PROJECT_DIR, 'token_cache')
+MODEL_REGISTRY_PATH = os.path.join(PROJECT_DIR, 'model_registry.json')
+EXPORTED_DIR = os.path.join(PROJECT_DIR, 'exported')
+COMPILE_CACHE_DIR = os.path.join(PROJECT_DIR, 'compile_cache')
 
 # 環境変数の設定
 os.environ["TEMP"] = TEMP_DIR
 os.environ["TMP"] = TEMP_DIR
 os.environ["XDG_CACHE_HOME"] = PROJECT_DIR
 os.environ["WHISPER_HOME"] = PROJECT_DIR
+# torch.compileの生成コードのキャッシュ（アプリを再起動してもコンパイルをやり直さない）
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", COMPILE_CACHE_DIR)
 
 # ディレクトリの作成
 for dir_path in [TRANSCRIPTS_DIR, DATASET_DIR, ANNOTATIONS_DIR, FINETUNED_DIR, 
-                MODELS_DIR, TEMP_DIR, ASSETS_DIR]:
+                MODELS_DIR, TEMP_DIR, ASSETS_DIR, FEATURE_CACHE_DIR, TOKEN_CACHE_DIR]:
     os.makedirs(dir_path, exist_ok=True)
     print(f"✓ ディレクトリを確認: {dir_path}")
 
@@ -56,15 +92,17 @@ file_size = os.path.getsize(mel_filters_path)
 print(f"mel_filters.npzのサイズ: {file_size} bytes")
 
 class AudioTextDataset(Dataset):
-    def __init__(self, dataset_dir):
+    def __init__(self, dataset_dir, names=None):
         self.samples = []
-        for timestamp_dir in os.listdir(dataset_dir):
+        for timestamp_dir in sorted(os.listdir(dataset_dir)):
+            if names is not None and timestamp_dir not in names:
+                continue
             dir_path = os.path.join(dataset_dir, timestamp_dir)
             if os.path.isdir(dir_path):
-                audio_files = [f for f in os.listdir(dir_path) if f.startswith('audio')]
-                if audio_files and os.path.exists(os.path.join(dir_path, 'transcript.txt')):
+                audio_path = find_sample_audio(dir_path)
+                if audio_path and os.path.exists(os.path.join(dir_path, 'transcript.txt')):
                     self.samples.append({
-                        'audio': os.path.join(dir_path, audio_files[0]),
+                        'audio': audio_path,
                         'transcript': os.path.join(dir_path, 'transcript.txt'),
                         'annotation': os.path.join(dir_path, 'annotation.json')
                     })
@@ -109,26 +147,140 @@ class AudioTextDataset(Dataset):
                 'annotation': {}
             }
 
-def fine_tune_model(base_model, dataset_dir, epochs=3, batch_size=4, learning_rate=1e-5, progress_callback=None):
-    """Whisperモデルのファインチューニングを実行"""
-    dataset = AudioTextDataset(dataset_dir)
+def check_cancelled(cancel_event):
+    """キャンセルが要求されていればJobCancelledを送出"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled("処理がキャンセルされました")
+
+def save_model(model_file, model, optimizer, device, include_optimizer=False, reference=None,
+               delta_tolerance=DEFAULT_DELTA_TOLERANCE):
+    """
+    学習済みモデルを保存（書き込み途中で中断されても既存のファイルが壊れないよう一時ファイルから置き換える）
+    推論には不要なため、オプティマイザの状態はinclude_optimizerがTrueの場合だけ保存する。
+    referenceに差分の基準（delta_referenceの結果）を渡すと、標準モデルからの差分だけを保存する。
+    """
+    os.makedirs(os.path.dirname(model_file), exist_ok=True)
+    temp_file = model_file + '.tmp'
+    if reference is not None:
+        state = delta_checkpoint(model, reference, delta_tolerance)
+    else:
+        state = {'model_state_dict': model.state_dict(), 'dims': model.dims}
+    state['device'] = device
+    if include_optimizer:
+        state['optimizer_state_dict'] = optimizer.state_dict()
+    torch.save(state, temp_file)
+    os.replace(temp_file, model_file)
+
+def fine_tune_model(base_model, dataset_dir, epochs=3, batch_size=4, learning_rate=1e-5, progress_callback=None,
+                    cancel_event=None, num_threads=None, feature_cache_dir=FEATURE_CACHE_DIR, resume_from=None,
+                    checkpoint_steps=None, checkpoint_minutes=DEFAULT_CHECKPOINT_MINUTES,
+                    keep_checkpoints=DEFAULT_KEEP_CHECKPOINTS, seed=0, validation_split=DEFAULT_VALIDATION_SPLIT,
+                    eval_steps=None, lr_schedule=DEFAULT_LR_SCHEDULE, warmup_ratio=DEFAULT_WARMUP_RATIO,
+                    accumulation_steps=1, patience=DEFAULT_PATIENCE, min_delta=0.0, token_cache_dir=TOKEN_CACHE_DIR,
+                    bucket_by_length=True, max_batch_tokens=None, optimizer_name=DEFAULT_OPTIMIZER,
+                    train_decoder_blocks=None, parameter_groups=None, export_optimizer_state=False,
+                    precision=DEFAULT_PRECISION, gradient_checkpointing=False, data_snapshot=None,
+                    sample_names=None, shared_model=None, output_dir=None, user=None,
+                    registry_path=MODEL_REGISTRY_PATH, model_quota_bytes=DEFAULT_QUOTA_BYTES, delta_compress=True,
+                    delta_tolerance=DEFAULT_DELTA_TOLERANCE, configure_threads=True):
+    """
+    Whisperモデルのファインチューニングを実行
+    学習中はcheckpoint_stepsステップごと、またはcheckpoint_minutes分ごとにチェックポイントを保存する。
+    resume_fromにモデルの保存先ディレクトリ（またはチェックポイントファイル）を指定すると、
+    保存時の学習設定・学習データ・乱数状態・データの位置から学習を再開する（sample_namesと学習設定の引数は
+    使わない）。中断時の学習データがdataset_dirに揃っていない場合は再開しない。
+
+    データセットのvalidation_splitの割合を検証用に分け、eval_stepsステップごと（Noneならエポックごと）に
+    検証CERを計算する。CERが最良のモデルを保存し、patience回続けて改善しなければ学習を打ち切る。
+    学習率はウォームアップ（全ステップのwarmup_ratio）の後、lr_scheduleに従って減衰させる。
+    accumulation_stepsバッチ分の勾配を累積してから更新する（実効バッチサイズ = batch_size × accumulation_steps）。
+    bucket_by_lengthがTrueの場合はトークン数の近い窓をまとめてバッチを作り、max_batch_tokensを指定すると
+    パディング込みのトークン数がその値を超えないようにバッチを区切る（batch_sizeは1バッチの上限件数になる）。
+    メモリを抑えるには、train_decoder_blocks（上位のデコーダブロック数）やparameter_groupsで学習する
+    パラメータを絞るか、optimizer_name='adafactor' で状態を分解して持つオプティマイザを使う。
+    保存するmodel.ptにはexport_optimizer_stateがTrueの場合だけオプティマイザの状態を含める。
+    precision='bf16' では順伝播をbfloat16のautocastで行い（重み・勾配・オプティマイザの状態はfp32）、
+    gradient_checkpointingがTrueの場合は残差ブロックの活性化を保持せず逆伝播時に再計算する。
+    data_snapshotには学習したデータの一覧を渡し、training_info.jsonに記録して次回の追加学習で差分を求める。
+    sample_namesを指定するとdataset_dir内のそのサンプルだけを学習する。
+    shared_modelには複数の学習ジョブで共有する読み込み済みのモデル（model_name属性に標準モデル名）を渡す。
+    base_modelが同じ標準モデル名の場合はこのモデルをコピーして学習し、凍結したパラメータは値が同じなら重みを共有する。
+    base_modelが別の標準モデルの場合は共有モデルを使わない。
+    output_dirを指定するとFINETUNED_DIRの代わりにそこへ保存する。
+    num_threadsはジョブのCPUスレッド数で、特徴量の事前計算のプロセス数の上限にも使う。configure_threadsがTrueなら
+    プロセス全体のCPUスレッド数をnum_threadsにする（同じプロセスで他のジョブが動く場合はFalseにする）。
+    学習したモデルはモデル登録簿に登録してuserの現在のモデルにし、合計サイズがmodel_quota_bytesを
+    超えた場合は使われていない古いモデルから削除する（registry_pathがNoneなら登録しない）。
+    delta_compressがTrueの場合、model.ptには標準モデルからの差分を量子化・圧縮して保存する（許容誤差は
+    重みのRMSに対するdelta_tolerance）。基準となる標準モデルが分からない場合は完全な形式で保存する。
+    """
+    checkpoint = None
+    if resume_from:
+        checkpoint_path = find_latest_checkpoint(resume_from)
+        if checkpoint_path is None:
+            raise ValueError(f"再開できるチェックポイントがありません: {resume_from}")
+        checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+        # 再開時は保存時の設定で学習を続ける
+        config = checkpoint['config']
+        base_model = config['base_model']
+        epochs = config['epochs']
+        batch_size = config['batch_size']
+        learning_rate = config['learning_rate']
+        seed = config['seed']
+        # 後から追加した設定は、古いチェックポイントでは追加前の動作（検証なし・一定の学習率・
+        # 全パラメータのAdamW・fp32・完全な形式での保存）として扱う
+        validation_split = config.get('validation_split', 0.0)
+        eval_steps = config.get('eval_steps')
+        lr_schedule = config.get('lr_schedule', 'constant')
+        warmup_ratio = config.get('warmup_ratio', 0.0)
+        accumulation_steps = config.get('accumulation_steps', 1)
+        patience = config.get('patience', DEFAULT_PATIENCE)
+        min_delta = config.get('min_delta', 0.0)
+        bucket_by_length = config.get('bucket_by_length', False)
+        max_batch_tokens = config.get('max_batch_tokens')
+        optimizer_name = config.get('optimizer_name', 'adamw')
+        train_decoder_blocks = config.get('train_decoder_blocks')
+        parameter_groups = config.get('parameter_groups')
+        precision = config.get('precision', 'fp32')
+        gradient_checkpointing = config.get('gradient_checkpointing', False)
+        data_snapshot = config.get('data_snapshot')
+        delta_compress = config.get('delta_compress', False)
+        delta_tolerance = config.get('delta_tolerance', DEFAULT_DELTA_TOLERANCE)
+        print(f"チェックポイントから再開します: {checkpoint_path}（ステップ {checkpoint['step']}）")
+        # 中断時と同じサンプルで学習を続ける（再開時に選択し直したデータは使わない）
+        sample_names = [os.path.basename(os.path.dirname(path)) for path in checkpoint['samples']]
+
+    dataset = AudioTextDataset(dataset_dir, sample_names)
+    if checkpoint and checkpoint['samples'] != [sample['audio'] for sample in dataset.samples]:
+        # 異なるデータで続けると中断しなかった場合と同じ結果にならない
+        raise ValueError(f"中断時の学習データが {dataset_dir} に揃っていないため再開できません"
+                         f"（再開せずに学習し直してください）")
     if len(dataset) == 0:
         raise ValueError("データセットが空です")
+    # 録音単位で分割し、同じ録音の区間が学習用と検証用にまたがらないようにする
+    train_indices, validation_indices = split_dataset(len(dataset), validation_split, seed)
+    print(f"学習データ: {len(train_indices)}件、検証データ: {len(validation_indices)}件")
 
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
-    
     # デバイスの設定
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"Using device: {device}")
+    if device == "cpu" and num_threads and configure_threads:
+        torch.set_num_threads(num_threads)
     
+    if (shared_model is not None and not os.path.isdir(base_model)
+            and getattr(shared_model, 'model_name', None) != base_model):
+        # 再開時の設定が別の標準モデルを指している場合などは、共有モデルを使わずに読み込む
+        print(f"共有モデル（{getattr(shared_model, 'model_name', '不明')}）が {base_model} と異なるため使いません")
+        shared_model = None
+
     # ベースモデルのロード
     try:
         if os.path.isdir(base_model):
             # カスタムモデルを使用
-            checkpoint = torch.load(os.path.join(base_model, 'model.pt'), map_location=device)
-            base_model = whisper.load_model(MODEL_NAME, device=device, download_root=MODELS_DIR)
-            base_model.load_state_dict(checkpoint['model_state_dict'])
-            model = base_model
+            model = load_custom_model(base_model, device)
+        elif shared_model is not None:
+            # 常駐している共有モデルをコピー（ディスクからの読み込みを省く）
+            model = copy.deepcopy(shared_model).to(device)
         else:
             # 標準モデルを使用
             model = whisper.load_model(base_model, download_root=MODELS_DIR, device=device)
@@ -140,90 +292,291 @@ def fine_tune_model(base_model, dataset_dir, epochs=3, batch_size=4, learning_ra
     except Exception as e:
         raise RuntimeError(f"モデルのロードに失敗: {str(e)}")
     
-    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+    tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                              language="ja", task="transcribe")
+    
+    # 短い発話は複数を1つの30秒窓に詰め、30秒を超える録音はセグメントの境界で分割する
+    # 転記のトークンID列はキャッシュから取得し、学習ループではテキストの読み込みもトークナイズも行わない
+    max_tokens = model.dims.n_text_ctx - len(tokenizer.sot_sequence)
+    token_cache = TokenCache(token_cache_dir, tokenizer) if token_cache_dir else None
+    train_windows, packing = build_training_windows(
+        [dataset.samples[index] for index in train_indices], tokenizer, max_tokens, token_cache=token_cache)
+    validation_windows, _ = build_training_windows(
+        [dataset.samples[index] for index in validation_indices], tokenizer, max_tokens, token_cache=token_cache)
+    if token_cache:
+        token_cache.save()
+        print(f"トークンキャッシュ: {token_cache.hits}件を再利用、{token_cache.misses}件をトークナイズしました")
+    if not train_windows:
+        raise ValueError("学習に使える発話がありません")
+    print(f"学習用の窓: {packing['utterances']}発話 → {packing['windows']}窓"
+          f"（1回のエンコードあたりの音声: {packing['seconds_per_pass_unpacked']:.1f}秒 → "
+          f"{packing['seconds_per_pass']:.1f}秒）")
+    
+    # ログメル特徴量を事前に一括計算（エポックごとの音声デコードとSTFTを省く）
+    feature_cache = None
+    if feature_cache_dir:
+        feature_cache = FeatureCache(feature_cache_dir, n_mels=model.dims.n_mels)
+        computed = feature_cache.build_windows([window['pieces'] for window in train_windows + validation_windows],
+                                               workers=num_threads)
+        print(f"特徴量キャッシュ: {computed}件を新たに計算しました")
     
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    model_save_path = os.path.join(FINETUNED_DIR, f'model_{timestamp}')
+    def load_mel(window):
+        # キャッシュ済みの特徴量を使用（なければその場で計算）
+        mel = feature_cache.get_window(window['pieces']) if feature_cache else None
+        if mel is None:
+            audio = load_window_audio(window['pieces'])
+            mel = batch_log_mel_spectrogram([audio], n_mels=model.dims.n_mels)[0]
+        return mel
     
-    total_steps = epochs * len(dataloader)
-    current_step = 0
+    validation_mels = [load_mel(window) for window in validation_windows]
+    validation_texts = [window['text'] for window in validation_windows]
     
-    for epoch in range(epochs):
-        model.train()
-        total_loss = 0
-        for batch in tqdm(dataloader, desc=f'Epoch {epoch+1}/{epochs}'):
+    # トークン数の近い窓をまとめてパディングを減らす（エポックごとのバッチ構成はseedから決まる）
+    token_lengths = [len(window['tokens']) for window in train_windows]
+    window_seconds = [window['seconds'] for window in train_windows]
+    if bucket_by_length:
+        epoch_plans = [bucket_batches(token_lengths, batch_size, seed, epoch, max_batch_tokens, window_seconds)
+                       for epoch in range(epochs)]
+    else:
+        epoch_plans = [epoch_batches(len(train_windows), batch_size, seed, epoch) for epoch in range(epochs)]
+    batch_padding = padding_ratio([batch for plan in epoch_plans for batch in plan], token_lengths)
+    print(f"パディング率: {batch_padding * 100:.1f}%")
+    total_steps = sum(math.ceil(len(plan) / accumulation_steps) for plan in epoch_plans)
+    
+    # 凍結したパラメータは勾配もオプティマイザの状態も持たない
+    trainable_parameters = select_trainable_parameters(model, train_decoder_blocks, parameter_groups)
+    num_trainable = count_parameters(trainable_parameters)
+    num_parameters = count_parameters(model.parameters())
+    print(f"学習するパラメータ: {num_trainable / 1e6:.1f}M / {num_parameters / 1e6:.1f}M（オプティマイザ: {optimizer_name}）")
+    optimizer = build_optimizer(trainable_parameters, optimizer_name, learning_rate)
+    if gradient_checkpointing:
+        enable_gradient_checkpointing(model)
+    print(f"精度: {precision}、勾配チェックポイント: {'有効' if gradient_checkpointing else '無効'}")
+    scheduler = torch.optim.lr_scheduler.LambdaLR(
+        optimizer, lr_lambda(total_steps, int(total_steps * warmup_ratio), lr_schedule))
+    early_stopping = EarlyStopping(patience, min_delta)
+    history = []
+    # オプティマイザを更新した時点の学習位置（チェックポイントはこの区切りで保存する）
+    progress = {'epoch': 0, 'next_batch': 0, 'step': 0, 'total_loss': 0.0}
+    
+    # 差分形式で保存するため、基準となる標準モデルと学習するパラメータを控える（重みは保存時に読む）
+    reference = None
+    if delta_compress:
+        reference_name, previous_delta = base_model, None
+        if os.path.isdir(base_model):
+            reference_name, previous_delta = checkpoint_reference(os.path.join(base_model, 'model.pt'))
+        if reference_name is None:
+            print("元のモデルの標準モデルが分からないため、完全な形式で保存します")
+        else:
+            trainable_names = [name for name, parameter in model.named_parameters() if parameter.requires_grad]
+            reference = delta_reference(reference_name, trainable_names, previous_delta, MODELS_DIR)
+    
+    if checkpoint:
+        model.load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if 'scheduler_state_dict' in checkpoint:
+            scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        if 'early_stopping' in checkpoint:
+            early_stopping.load_state_dict(checkpoint['early_stopping'])
+        history = checkpoint.get('history', [])
+        model_save_path = checkpoint['model_save_path']
+        timestamp = checkpoint['timestamp']
+        progress.update(epoch=checkpoint['epoch'], next_batch=checkpoint['next_batch'],
+                        step=checkpoint['step'], total_loss=checkpoint['total_loss'])
+        restore_rng_state(checkpoint['rng'])
+    else:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        model_save_path = output_dir or os.path.join(FINETUNED_DIR, f'model_{timestamp}')
+    if shared_model is not None:
+        # 凍結したパラメータは他のジョブと同じテンソルを参照する
+        num_shared = share_frozen_weights(model, shared_model)
+        print(f"共有モデルと重みを共有: {num_shared / 1e6:.1f}M")
+    model_file = os.path.join(model_save_path, 'model.pt')
+    
+    checkpoint_dir = os.path.join(model_save_path, CHECKPOINT_SUBDIR)
+    checkpoint_writer = CheckpointWriter(checkpoint_dir, keep_checkpoints)
+    checkpoint_policy = CheckpointPolicy(checkpoint_steps, checkpoint_minutes)
+    
+    def training_state():
+        return {
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scheduler_state_dict': scheduler.state_dict(),
+            'early_stopping': early_stopping.state_dict(),
+            'history': history,
+            'dims': model.dims,
+            'config': {
+                'base_model': base_model,
+                'epochs': epochs,
+                'batch_size': batch_size,
+                'learning_rate': learning_rate,
+                'seed': seed,
+                'validation_split': validation_split,
+                'eval_steps': eval_steps,
+                'lr_schedule': lr_schedule,
+                'warmup_ratio': warmup_ratio,
+                'accumulation_steps': accumulation_steps,
+                'patience': patience,
+                'min_delta': min_delta,
+                'bucket_by_length': bucket_by_length,
+                'max_batch_tokens': max_batch_tokens,
+                'optimizer_name': optimizer_name,
+                'train_decoder_blocks': train_decoder_blocks,
+                'parameter_groups': parameter_groups,
+                'precision': precision,
+                'gradient_checkpointing': gradient_checkpointing,
+                'data_snapshot': data_snapshot,
+                'delta_compress': delta_compress,
+                'delta_tolerance': delta_tolerance,
+            },
+            'model_save_path': model_save_path,
+            'timestamp': timestamp,
+            'samples': [sample['audio'] for sample in dataset.samples],
+            'epoch': progress['epoch'],
+            'next_batch': progress['next_batch'],
+            'step': progress['step'],
+            'total_loss': progress['total_loss'],
+            'rng': capture_rng_state(),
+        }
+    
+    def evaluate():
+        cer = evaluate_cer(model, validation_mels, validation_texts)
+        improved = early_stopping.update(cer, progress['step'])
+        history.append({'step': progress['step'], 'cer': cer, 'lr': scheduler.get_last_lr()[0]})
+        print(f"検証CER: {cer:.4f}（最良: {early_stopping.best:.4f}、ステップ {early_stopping.best_step}）")
+        if improved:
+            # 最良のモデルだけを残す
+            save_model(model_file, model, optimizer, device, export_optimizer_state, reference, delta_tolerance)
+        return cer
+    
+    stopped_early = False
+    train_seconds = 0.0
+    trained_windows = 0
+    try:
+        for epoch in range(progress['epoch'], epochs):
+            model.train()
+            first_batch = progress['next_batch'] if epoch == progress['epoch'] else 0
+            epoch_loss = progress['total_loss'] if first_batch else 0.0
+            # エポックごとの並び順はseedから決まるため、途中のバッチから再開できる
+            batches = epoch_plans[epoch]
             optimizer.zero_grad()
-            batch_loss = 0
-            
-            # バッチ内の各サンプルに対して処理
-            for i in range(len(batch['audio_path'])):
-                audio_path = batch['audio_path'][i]
-                transcript = batch['transcript'][i]
+            for batch_index, batch in enumerate(
+                    tqdm(batches[first_batch:], desc=f'Epoch {epoch+1}/{epochs}', initial=first_batch,
+                         total=len(batches)),
+                    start=first_batch):
+                check_cancelled(cancel_event)
+                num_samples = len(batch)
+                # 累積するバッチ数（エポック末尾では端数になる）
+                group_start = batch_index - batch_index % accumulation_steps
+                group_size = min(accumulation_steps, len(batches) - group_start)
+                batch_loss = 0
                 
+                # パディングしたバッチをまとめて順伝播（窓ごとの平均損失を計算）
+                step_start = time.perf_counter()
                 try:
-                    # 音声をWhisper形式に変換
-                    audio = whisper.load_audio(audio_path)
-                    audio = whisper.pad_or_trim(audio)
-                    mel = whisper.log_mel_spectrogram(audio).to(model.device)
-                    
-                    # エンコーダーの出力を取得
-                    encoder_output = model.encoder(mel.unsqueeze(0))
-                    
-                    # テキストのトークン化
-                    tokens = torch.tensor([model.tokenizer.encode(transcript)]).to(model.device)
-                    
-                    # デコーダーの入力準備
-                    decoder_input = tokens[:, :-1]  # 最後のトークンを除外
-                    target = tokens[:, 1:]  # 最初のトークンを除外
-                    
-                    # デコーダーの出力を取得
-                    decoder_output = model.decoder(decoder_input, encoder_output)
-                    
-                    # 損失計算
-                    loss = torch.nn.functional.cross_entropy(
-                        decoder_output.view(-1, decoder_output.size(-1)),
-                        target.view(-1),
-                        ignore_index=-100
-                    )
-                    loss.backward()
-                    batch_loss += loss.item()
+                    windows = [train_windows[window_index] for window_index in batch]
+                    mel, decoder_input, target = collate_windows(windows, [load_mel(window) for window in windows])
+                    with autocast_context(device, precision):
+                        losses = window_losses(model, mel.to(model.device), decoder_input.to(model.device),
+                                               target.to(model.device))
+                    # 累積後の勾配がサンプル平均になるようにスケール
+                    (losses.sum() / (num_samples * group_size)).backward()
+                    batch_loss = losses.sum().item()
                 except Exception as e:
-                    print(f"サンプル処理中にエラー: {str(e)}")
+                    print(f"バッチ処理中にエラー: {str(e)}")
+                train_seconds += time.perf_counter() - step_start
+                trained_windows += num_samples
+                
+                epoch_loss += batch_loss / num_samples
+                if batch_index + 1 < group_start + group_size:
                     continue
-            
-            optimizer.step()
-            total_loss += batch_loss / len(batch)
-            
-            # 進捗更新
-            current_step += 1
-            if progress_callback:
-                progress = (current_step / total_steps) * 100
-                avg_loss = total_loss / (len(dataloader) * (epoch + 1))
-                progress_callback(progress, 
-                                f'Epoch {epoch+1}/{epochs} Loss: {avg_loss:.4f}')
+                
+                # 累積した勾配でパラメータを更新
+                optimizer.step()
+                scheduler.step()
+                optimizer.zero_grad()
+                progress.update(epoch=epoch, next_batch=batch_index + 1, step=progress['step'] + 1,
+                                total_loss=epoch_loss)
+                
+                status = f'Epoch {epoch+1}/{epochs} Loss: {epoch_loss / (batch_index + 1):.4f}'
+                end_of_epoch = batch_index + 1 == len(batches)
+                if validation_windows and (progress['step'] % eval_steps == 0 if eval_steps else end_of_epoch):
+                    status += f' CER: {evaluate():.4f}'
+                
+                # 進捗更新
+                if progress_callback:
+                    progress_callback((progress['step'] / total_steps) * 100, status)
+                
+                # 定期的なチェックポイント（書き込みはバックグラウンドで行う）
+                if checkpoint_policy.should_save(progress['step']):
+                    checkpoint_writer.save(progress['step'], training_state())
+                    checkpoint_policy.saved()
+                
+                if early_stopping.should_stop:
+                    print(f"検証CERが{patience}回続けて改善しなかったため学習を終了します")
+                    stopped_early = True
+                    break
+            if stopped_early:
+                break
+    except (JobCancelled, KeyboardInterrupt):
+        # 中断された位置（直前のパラメータ更新時点）から再開できるように保存
+        checkpoint_writer.save(progress['step'], training_state(), wait=True)
+        print(f"チェックポイントを保存しました（再開するには resume_from={model_save_path} を指定）")
+        raise
+    finally:
+        checkpoint_writer.close()
     
     try:
-        # モデルの保存
-        os.makedirs(model_save_path, exist_ok=True)
-        torch.save({
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'dims': model.dims,
-            'device': device
-        }, os.path.join(model_save_path, 'model.pt'))
+        # モデルの保存（検証を行った場合は最良のモデルが保存済み）
+        if early_stopping.best is None:
+            save_model(model_file, model, optimizer, device, export_optimizer_state, reference, delta_tolerance)
         print(f"モデルを保存しました: {model_save_path}")
     except Exception as e:
         raise RuntimeError(f"モデルの保存に失敗: {str(e)}")
     
     # 学習情報の保存
+    saved = torch.load(model_file, map_location="cpu", mmap=True, weights_only=False)
     info = {
         'timestamp': timestamp,
         'base_model': base_model,
         'epochs': epochs,
         'batch_size': batch_size,
+        'accumulation_steps': accumulation_steps,
         'learning_rate': learning_rate,
-        'final_loss': total_loss / len(dataloader),
+        'lr_schedule': lr_schedule,
+        'warmup_ratio': warmup_ratio,
+        'seed': seed,
+        'final_loss': progress['total_loss'] / max(1, progress['next_batch']),
         'dataset_size': len(dataset),
+        'train_size': len(train_indices),
+        'validation_size': len(validation_indices),
+        'packing': packing,
+        'bucket_by_length': bucket_by_length,
+        'max_batch_tokens': max_batch_tokens,
+        'padding_ratio': batch_padding,
+        'optimizer': optimizer_name,
+        'train_decoder_blocks': train_decoder_blocks,
+        'parameter_groups': parameter_groups,
+        'precision': precision,
+        'gradient_checkpointing': gradient_checkpointing,
+        'memory': {
+            'trainable_parameters': num_trainable,
+            'total_parameters': num_parameters,
+            'optimizer_state_bytes': optimizer_state_bytes(optimizer),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'model_file_bytes': os.path.getsize(model_file),
+            'checkpoint_bytes': checkpoint_writer.last_bytes,
+        },
+        'model_format': 'delta' if reference is not None else 'full',
+        'delta': saved.get('stats') if is_delta_checkpoint(saved) else None,
+        'seconds_per_window': train_seconds / trained_windows if trained_windows else None,
+        'best_cer': early_stopping.best,
+        'best_step': early_stopping.best_step,
+        'steps': progress['step'],
+        'stopped_early': stopped_early,
+        'validation_history': history,
+        'resumed': checkpoint is not None,
+        'data_snapshot': data_snapshot,
         'training_completed': True
     }
     
@@ -231,6 +584,17 @@ def fine_tune_model(base_model, dataset_dir, epochs=3, batch_size=4, learning_ra
               encoding='utf-8') as f:
         json.dump(info, f, ensure_ascii=False, indent=2)
     
+    # 学習が完了したら途中のチェックポイントは不要
+    import shutil
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    
+    if registry_path:
+        registry = ModelRegistry(registry_path)
+        registry.register(model_save_path, user)
+        evicted = registry.enforce_quota(model_quota_bytes)
+        if evicted:
+            print(f"モデルの保存容量の上限を超えたため削除しました: {', '.join(evicted)}")
+    
     return model_save_path
 
 def add_annotation(dataset_dir, timestamp, annotation_data):
@@ -246,7 +610,35 @@ def add_annotation(dataset_dir, timestamp, annotation_data):
     return annotation_file
 
 # Whisperモデルの設定
-MODEL_NAME = "base"  # 処理速度と精度のバランスを考慮
+MODEL_NAME = "base"  # 処理速度と精度のバランスを考慮（キャリブレーション未実施時の既定値）
+DEFAULT_CPU_THREADS = 4
+
+def get_runtime_config():
+    """キャリブレーション結果からモデルサイズとCPUスレッド数を取得"""
+    calibration = load_calibration(PROJECT_DIR)
+    if calibration is None:
+        return {
+            'model_name': MODEL_NAME,
+            'intra_op_threads': DEFAULT_CPU_THREADS,
+            'inter_op_threads': DEFAULT_CPU_THREADS,
+        }
+    return {
+        'model_name': calibration['model_name'],
+        'intra_op_threads': calibration['intra_op_threads'],
+        'inter_op_threads': calibration['inter_op_threads'],
+    }
+
+def load_custom_model(model_path, device, base_model=None):
+    """
+    ファインチューニング済みモデルを読み込む（モデルサイズはチェックポイントの次元情報から決定）
+    差分形式のモデルは標準モデルに差分を加えて復元する（base_modelに常駐している標準モデルを渡すと重みを共有する）。
+    """
+    checkpoint = torch.load(os.path.join(model_path, 'model.pt'), map_location=device, weights_only=False)
+    if is_delta_checkpoint(checkpoint):
+        return load_delta_model(checkpoint, device, MODELS_DIR, base_model)
+    model = whisper.model.Whisper(checkpoint['dims'])
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.to(device)
 
 def check_audio_file(audio_file):
     """音声ファイルの存在と形式を確認"""
@@ -296,9 +688,88 @@ class ProgressCallback:
         else:
             self.callback(self.current_progress, "処理中...")
 
-def transcribe_audio(audio_file, model_path=None, progress_callback=None):
-    """音声認識を実行し、結果を保存する"""
+# whisper.transcribeがverbose=Trueで表示するセグメントの行（[00:01.000 --> 00:03.500] テキスト）
+SEGMENT_LINE = re.compile(r'^\[((?:\d+:)?\d+:\d+\.\d+) --> ((?:\d+:)?\d+:\d+\.\d+)\] ?(.*)$', re.S)
+_segment_local = threading.local()
+_segment_hook_lock = threading.Lock()
+# カスケードの1段目に使う標準モデル（プロセス内で使い回す）
+_stock_model = None
+_stock_model_key = None
+_stock_model_lock = threading.Lock()
+
+def _parse_timestamp(text):
+    seconds = 0.0
+    for part in text.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def _segment_print(*args, **kwargs):
+    """whisper.transcribe内のprintの代わり（segment_eventsの中ではセグメントの行をコールバックに渡す）"""
+    callback = getattr(_segment_local, 'callback', None)
+    match = SEGMENT_LINE.match(str(args[0])) if callback and len(args) == 1 else None
+    if match is None:
+        print(*args, **kwargs)
+        return
+    callback({'start': _parse_timestamp(match.group(1)), 'end': _parse_timestamp(match.group(2)),
+              'text': match.group(3)})
+
+@contextlib.contextmanager
+def segment_events(callback):
+    """
+    このブロック内（同じスレッド）のverbose=Trueのtranscribeで、確定したセグメントを表示する代わりにコールバックへ渡す
+    Args:
+        callback (callable): callback({'start', 'end', 'text'})
+    """
+    # whisper.transcribe は関数で隠れているため、モジュールはimportlibで取得する
+    module = importlib.import_module('whisper.transcribe')
+    with _segment_hook_lock:
+        module.print = _segment_print
+    previous = getattr(_segment_local, 'callback', None)
+    _segment_local.callback = callback
+    try:
+        yield
+    finally:
+        _segment_local.callback = previous
+
+def set_cpu_threads(num_threads, interop_threads=None):
+    """CPU推論のスレッド数を設定"""
+    torch.set_num_threads(num_threads)  # スレッド数を制限
     try:
+        # inter-opスレッド数はプロセスで一度しか設定できない
+        torch.set_num_interop_threads(interop_threads or num_threads)
+    except RuntimeError:
+        pass
+
+def get_stock_model(model_name, device):
+    """
+    標準モデルを取得（プロセス内で初めて使うときだけ読み込み、最後に使った1つを保持する）
+    カスケードでユーザーのモデルを再デコードに使う場合の1段目のモデルとして、文字起こしのたびに読み込まないようにする。
+    """
+    global _stock_model, _stock_model_key
+    with _stock_model_lock:
+        if _stock_model_key != (model_name, device):
+            # キャリブレーションでモデルが変わった場合は、前のモデルを破棄してから読み込む
+            _stock_model = None
+            _stock_model = whisper.load_model(model_name, device=device, download_root=MODELS_DIR)
+            _stock_model_key = (model_name, device)
+        return _stock_model
+
+def transcribe_audio(audio_file, model_path=None, progress_callback=None, cancel_event=None, num_threads=None,
+                     preset=DEFAULT_PRESET, cascade=False, loop_policy=DEFAULT_LOOP_POLICY, backend=DEFAULT_BACKEND,
+                     segment_callback=None, configure_threads=True):
+    """
+    音声認識を実行し、結果を保存する（loop_policy=Noneで繰り返し検出を無効化）
+    segment_callbackを指定すると、確定したセグメント（{'start', 'end', 'text'}）を順に通知する。
+    backendに 'torchscript' / 'onnx' を指定すると、書き出したグラフでCPU推論する（未書き出しなら書き出す）。
+    'compiled' はエンコーダとデコーダの1ステップをtorch.compileし、プロセス内で使い回す（初回だけコンパイル）。
+    configure_threadsがFalseの場合はプロセス全体のCPUスレッド数を変更しない（ジョブスケジューラが
+    同じプロセスで他のジョブと並べて実行する場合。num_threadsはONNX Runtimeのセッションにだけ使う）。
+    """
+    try:
+        decode_options = get_preset(preset)
+        runtime_config = get_runtime_config()
+        model_name = runtime_config['model_name']
+
         # 音声ファイルの確認
         check_audio_file(audio_file)
         update_progress(progress_callback, 0, f"音声ファイルを読み込み中: {audio_file}")
@@ -313,22 +784,41 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
                 device = "cuda" if torch.cuda.is_available() else "cpu"
                 print(f"Using device: {device}")
                 
-                if device == "cpu":
+                if device == "cpu" and configure_threads:
                     # CPU使用時はメモリ使用量を抑制
-                    torch.set_num_threads(4)  # スレッド数を制限
-                    torch.set_num_interop_threads(4)
+                    set_cpu_threads(num_threads or runtime_config['intra_op_threads'],
+                                    runtime_config['inter_op_threads'])
                 
-                if model_path and os.path.isdir(model_path):
+                if backend not in INFERENCE_BACKENDS:
+                    raise ValueError(f"不明な推論エンジンです: {backend}（{', '.join(INFERENCE_BACKENDS)}）")
+                if backend != 'eager' and device != "cpu":
+                    print(f"{backend}はCPU推論用のため、eagerで実行します")
+                    backend = 'eager'
+                custom = bool(model_path and os.path.isdir(model_path))
+                if backend == 'compiled':
+                    # コンパイル済みのモデルを使い回す（初回はプリセットで使うバッチサイズでウォームアップ）
+                    source = source_signature(model_path if custom else None, model_name)
+                    model = get_compiled_model(
+                        json.dumps(source, sort_keys=True),
+                        (lambda: load_custom_model(model_path, device)) if custom else
+                        (lambda: whisper.load_model(model_name, device=device, download_root=MODELS_DIR)),
+                        warmup_batch_sizes(decode_options),
+                        location=os.path.abspath(model_path) if custom else model_name)
+                elif backend != 'eager':
+                    # 書き出したエンコーダとデコーダの1ステップを使用
+                    model = load_exported_model(
+                        model_path if custom else None, model_name, backend, EXPORTED_DIR, MODELS_DIR,
+                        num_threads or runtime_config['intra_op_threads'],
+                        load_model=(lambda: load_custom_model(model_path, device)) if custom else None,
+                        registry=ModelRegistry(MODEL_REGISTRY_PATH) if custom else None)
+                elif custom:
                     # カスタムモデルを使用
-                    checkpoint = torch.load(os.path.join(model_path, 'model.pt'), map_location=device)
-                    base_model = whisper.load_model(MODEL_NAME, device=device, download_root=MODELS_DIR)
-                    base_model.load_state_dict(checkpoint['model_state_dict'])
-                    model = base_model
+                    model = load_custom_model(model_path, device)
                 else:
-                    # デフォルトモデルを使用
-                    model = whisper.load_model(MODEL_NAME, device=device, download_root=MODELS_DIR)
+                    # デフォルトモデルを使用（キャリブレーションで選択したサイズ）
+                    model = whisper.load_model(model_name, device=device, download_root=MODELS_DIR)
                 
-                if device == "cpu":
+                if device == "cpu" and backend == 'eager':
                     # CPUモードの場合、メモリ使用量を最適化
                     model.encoder.conv1.padding_mode = 'zeros'
                     model.encoder.conv2.padding_mode = 'zeros'
@@ -336,7 +826,8 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
                 # モデル情報の表示
                 print(f"Model loaded successfully:")
                 print(f"- Device: {device}")
-                print(f"- Model type: {'Custom' if model_path else MODEL_NAME}")
+                print(f"- Model type: {'Custom' if model_path else model_name}")
+                print(f"- Backend: {backend}")
                 print(f"- Dimensions: {model.dims}")
                 print(f"- Language: Japanese")
                 
@@ -351,6 +842,7 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
             update_progress(progress_callback, 10, f"モデルの読み込みが完了しました（所要時間: {load_time:.2f}秒）")
         except Exception as e:
             raise RuntimeError(f"Whisperモデルの読み込みに失敗しました: {str(e)}")
+        check_cancelled(cancel_event)
         
         # 日本語に特化した設定でWhisperを実行
         try:
@@ -370,6 +862,7 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
                     # リサンプリングが必要な場合
                     from scipy import signal
                     audio = signal.resample(audio, int(len(audio) * whisper.audio.SAMPLE_RATE / sr))
+                audio_duration = len(audio) / whisper.audio.SAMPLE_RATE
                 audio = whisper.pad_or_trim(audio.astype(np.float32))
                 
                 # メルスペクトログラムの計算
@@ -393,15 +886,39 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
             progress_thread.start()
             
             # 音声認識の実行（シンプルな方法で再試行）
+            # 繰り返しを検出した窓はデコードを打ち切り、フォールバックまたは読み飛ばす
+            loop_stats = RepetitionStats()
+            streamed = False
             try:
-                result = model.transcribe(
-                    audio_file,
-                    language="ja",
-                    task="transcribe",
-                    fp16=False,
-                    verbose=False,
-                    initial_prompt="日本語の音声を認識します。"
-                )
+                with repetition_guard(loop_policy, loop_stats) if loop_policy else contextlib.nullcontext():
+                    if cascade:
+                        # 高速設定で全体をデコードし、低信頼・繰り返しの区間だけを再デコード
+                        fast_model = model
+                        if model_path and os.path.isdir(model_path):
+                            # 1段目は標準モデル、再デコードはユーザーのモデルで行う
+                            fast_model = get_stock_model(model_name, device)
+                        # 再デコードは選択したプリセットによらず、精度重視の設定で行う
+                        result = cascade_transcribe(
+                            fast_model,
+                            load_dataset_audio(audio_file),
+                            accurate_model=model,
+                            accurate_preset='accurate'
+                        )
+                        stats = result['cascade']
+                        print(f"✓ 再デコードしたセグメント: {stats['segments_redecoded']}/{stats['segments_total']}")
+                    else:
+                        with segment_events(segment_callback) if segment_callback else contextlib.nullcontext():
+                            result = model.transcribe(
+                                audio_file,
+                                language="ja",
+                                task="transcribe",
+                                fp16=False,
+                                # セグメントを通知する場合は、確定したセグメントごとに表示されるverbose=Trueで実行
+                                verbose=True if segment_callback else False,
+                                initial_prompt="日本語の音声を認識します。",
+                                **decode_options
+                            )
+                        streamed = True
             except Exception as e:
                 print(f"最初の試行でエラー: {str(e)}")
                 print("別の方法で再試行します...")
@@ -411,6 +928,7 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
                     language="ja",
                     task="transcribe",
                     fp16=False,
+                    beam_size=decode_options['beam_size'],
                     prompt="日本語の音声を認識します。"
                 )
                 result = model.decode(mel, options)
@@ -423,10 +941,20 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
                     }]
                 }
             
+            if segment_callback and not streamed:
+                # 段階的デコードと再試行の結果は、すべてのセグメントが確定してから通知する
+                for segment in result["segments"]:
+                    segment_callback({'start': segment["start"], 'end': segment["end"], 'text': segment["text"]})
+
             process_time = (datetime.now() - start_time).total_seconds()
+            loop_stats.add_audio(audio_duration)
+            if loop_stats.loops_detected:
+                print(f"✓ 繰り返しで打ち切った窓: {loop_stats.loops_detected}"
+                      f"（節約したトークン: {loop_stats.tokens_saved}）")
             update_progress(progress_callback, 80, f"音声認識が完了しました（所要時間: {process_time:.2f}秒）")
         except Exception as e:
             raise RuntimeError(f"音声認識の実行に失敗しました: {str(e)}")
+        check_cancelled(cancel_event)
         
         # 結果の取得
         text = result["text"]
@@ -457,11 +985,18 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
             dataset_subdir = os.path.join(DATASET_DIR, timestamp)
             os.makedirs(dataset_subdir, exist_ok=True)
             
-            # 音声ファイルをデータセットにコピー
-            import shutil
-            audio_extension = os.path.splitext(audio_file)[1]
-            dataset_audio = os.path.join(dataset_subdir, f'audio{audio_extension}')
-            shutil.copy2(audio_file, dataset_audio)
+            # 音声ファイルを16kHzモノラルのFLACに正規化してデータセットに保存
+            normalized_path = os.path.join(dataset_subdir, DATASET_AUDIO_NAME)
+            try:
+                normalize_audio(audio_file, normalized_path)
+            except Exception as e:
+                print(f"FLACへの変換に失敗したため元のファイルをコピーします: {str(e)}")
+                # find_sample_audioはFLACを優先するため、不完全なFLACが残っていれば削除する
+                if os.path.exists(normalized_path):
+                    os.remove(normalized_path)
+                import shutil
+                audio_extension = os.path.splitext(audio_file)[1]
+                shutil.copy2(audio_file, os.path.join(dataset_subdir, f'audio{audio_extension}'))
             
             # 転記テキストをJSONフォーマットで保存
             dataset_json = os.path.join(dataset_subdir, 'transcript.json')
@@ -470,7 +1005,10 @@ def transcribe_audio(audio_file, model_path=None, progress_callback=None):
                 'segments': segments,
                 'metadata': {
                     'timestamp': timestamp,
-                    'model': MODEL_NAME,
+                    'model': model_path or model_name,
+                    'preset': preset,
+                    'cascade': result.get('cascade'),
+                    'repetition': loop_stats.as_dict() if loop_policy else None,
                     'process_time': process_time,
                     'audio_file': os.path.basename(audio_file)
                 }
@@ -499,16 +1037,41 @@ if __name__ == "__main__":
     try:
         # コマンドライン引数から音声ファイルを取得
         import sys
+        preset = DEFAULT_PRESET
+        cascade = "--cascade" in sys.argv
+        if cascade:
+            # 段階的デコード（低信頼の区間だけを再デコード）
+            sys.argv.remove("--cascade")
+        if "--preset" in sys.argv:
+            # デコード設定のプリセット（fast / balanced / accurate）
+            index = sys.argv.index("--preset")
+            preset = sys.argv[index + 1]
+            del sys.argv[index:index + 2]
+        backend = DEFAULT_BACKEND
+        if "--backend" in sys.argv:
+            # 推論エンジン（eager / torchscript / onnx / compiled）
+            index = sys.argv.index("--backend")
+            backend = sys.argv[index + 1]
+            del sys.argv[index:index + 2]
+        loop_policy = DEFAULT_LOOP_POLICY
+        if "--loop-policy" in sys.argv:
+            # 繰り返し検出時の処理（skip / fallback / off）
+            index = sys.argv.index("--loop-policy")
+            loop_policy = None if sys.argv[index + 1] == "off" else sys.argv[index + 1]
+            del sys.argv[index:index + 2]
         if len(sys.argv) > 1:
             if sys.argv[1] == "--finetune":
                 # ファインチューニングモード
                 print("ファインチューニングを開始します...")
-                model_path = fine_tune_model(MODEL_NAME, DATASET_DIR)
+                # --resume: 中断した学習があればチェックポイントから再開
+                resume_from = find_resumable_run(FINETUNED_DIR) if "--resume" in sys.argv else None
+                model_path = fine_tune_model(MODEL_NAME, DATASET_DIR, resume_from=resume_from)
                 print(f"モデルを保存しました: {model_path}")
             else:
                 # 通常の音声認識モード
                 audio_file = sys.argv[1]
-                result, transcript_file, dataset_dir = transcribe_audio(audio_file)
+                result, transcript_file, dataset_dir = transcribe_audio(
+                    audio_file, preset=preset, cascade=cascade, loop_policy=loop_policy, backend=backend)
                 
                 # アノテーション例の追加
                 timestamp = os.path.basename(dataset_dir)
@@ -523,7 +1086,7 @@ if __name__ == "__main__":
                 print(f"\nアノテーションファイルを作成しました: {annotation_file}")
         else:
             audio_file = os.path.join(PROJECT_DIR, 'Test_audio.wav')
-            transcribe_audio(audio_file)
+            transcribe_audio(audio_file, preset=preset, cascade=cascade, loop_policy=loop_policy, backend=backend)
     except Exception as e:
         print(f"\nエラーが発生しました: {str(e)}")
         traceback.print_exc()
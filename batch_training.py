@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+import queue
+import traceback
+import multiprocessing as mp
+from datetime import datetime
+import torch
+import whisper
+
+from PersonalizedSR import fine_tune_model, DATASET_DIR, MODELS_DIR, MODEL_REGISTRY_PATH
+from model_registry import ModelRegistry
+from job_scheduler import JobScheduler, JobCancelled
+from inference_pool import resolve_checkpoint, load_mmap_model
+from continual_training import plan_user_training, prepare_user_dataset, DEFAULT_REPLAY_RATIO
+from training_checkpoint import find_resumable_run
+from training_memory import estimate_training_bytes, peak_rss_bytes
+
+USERS_DIR = os.path.join(DATASET_DIR, "users")
+
+# fork時に学習プロセスへコピーオンライトで共有する標準モデル
+_SHARED_MODEL = None
+
+
+def list_users(users_dir=USERS_DIR):
+    """登録されているユーザー名の一覧"""
+    if not os.path.isdir(users_dir):
+        return []
+    return sorted(name for name in os.listdir(users_dir) if os.path.isdir(os.path.join(users_dir, name)))
+
+
+def train_user(user_dir, model_dir, plan, resume_from, username, base_model, shared_model, num_threads,
+               progress_callback=None, cancel_event=None, configure_threads=True, **training_options):
+    """1ユーザーの学習データを用意してモデルを学習し、保存先を返す"""
+    dataset_dir, names = prepare_user_dataset(user_dir, plan['samples'])
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return fine_tune_model(
+        plan['base_model'] or base_model,
+        dataset_dir,
+        progress_callback=progress_callback,
+        cancel_event=cancel_event,
+        num_threads=num_threads,
+        configure_threads=configure_threads,
+        resume_from=resume_from,
+        data_snapshot=plan['data_snapshot'],
+        sample_names=names,
+        shared_model=shared_model,
+        output_dir=os.path.join(model_dir, f"model_{timestamp}"),
+        user=username,
+        **training_options)
+
+
+def _train_process(checkpoint_path, num_threads, cancel_event, result_queue, args, training_options):
+    """学習プロセス: スレッド数を設定して1ユーザーのモデルを学習し、進捗と結果をキューで返す"""
+    torch.set_num_threads(num_threads)
+    try:
+        shared_model = _SHARED_MODEL
+        if shared_model is None:
+            # forkできない環境では各プロセスがメモリマップで読み込む（ページキャッシュを共有）
+            shared_model = load_mmap_model(checkpoint_path, MODELS_DIR)
+            shared_model.model_name = args['base_model']
+        callback = lambda progress, status: result_queue.put(('progress', progress, status))
+        model_path = train_user(shared_model=shared_model, num_threads=num_threads, progress_callback=callback,
+                                cancel_event=cancel_event, **args, **training_options)
+        result_queue.put(('done', model_path, None))
+    except JobCancelled:
+        result_queue.put(('cancelled', None, None))
+    except Exception as e:
+        result_queue.put(('error', None, f"{str(e)}\n{traceback.format_exc()}"))
+
+
+def run_in_process(job, context, checkpoint_path, args, progress_callback=None, **training_options):
+    """
+    学習ジョブを子プロセスで実行
+    torch.set_num_threadsはプロセス全体の設定のため、同時に実行するジョブをスレッドで動かすと
+    最後に設定したスレッド数がすべてのジョブに効いてしまう。プロセスに分けてjob.threadsを守る。
+    """
+    cancel_event = context.Event()
+    result_queue = context.Queue()
+    # 学習プロセスは特徴量の計算でさらに子プロセスを使うためデーモンにしない
+    process = context.Process(target=_train_process,
+                              args=(checkpoint_path, job.threads, cancel_event, result_queue, args, training_options))
+    process.start()
+    try:
+        while True:
+            if job.cancelled:
+                cancel_event.set()
+            try:
+                kind, value, detail = result_queue.get(timeout=0.5)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                try:
+                    kind, value, detail = result_queue.get(timeout=0.5)
+                except queue.Empty:
+                    raise RuntimeError(f"学習プロセスが異常終了しました（終了コード {process.exitcode}）")
+            if kind != 'progress':
+                break
+            if progress_callback:
+                progress_callback(value, detail)
+    finally:
+        process.join()
+    if kind == 'cancelled':
+        raise JobCancelled(f"ジョブがキャンセルされました: {job.name}")
+    if kind == 'error':
+        raise RuntimeError(detail)
+    return value
+
+
+def train_users(usernames, base_model="base", parallel=1, cpu_threads=None, memory_budget=None, incremental=True,
+                replay_ratio=DEFAULT_REPLAY_RATIO, users_dir=USERS_DIR, progress_callback=None, cancel_event=None,
+                **training_options):
+    """
+    複数ユーザーのモデルをまとめて学習
+    標準モデルは1回だけ読み込んで全ジョブで共有する（凍結したパラメータは同じテンソルを参照する）。
+    特徴量キャッシュとトークンキャッシュは各ユーザーの録音ごとのため、ユーザー間では再利用されない。
+    ジョブはCPUスレッド数とメモリの見込み量の上限の範囲で最大parallel件を同時に実行する。
+    CPUで2件以上を同時に実行する場合は、ジョブごとのスレッド数を守るため各ジョブを子プロセスで実行する
+    （forkできる環境では標準モデルをコピーオンライトで、それ以外はメモリマップで共有する）。
+    Args:
+        usernames (list): 学習するユーザー名
+        base_model (str): 前回のモデルがないユーザーの学習に使う標準モデル
+        parallel (int): 同時に学習するユーザー数の上限
+        cpu_threads (int): 全ジョブで使うCPUスレッド数（省略時はコア数）
+        memory_budget (int): 同時に実行するジョブのメモリ見込み量の合計の上限（バイト）
+        incremental (bool): 前回のモデルから追加・修正分だけを学習する
+        progress_callback (callable): progress_callback(ユーザー名, 進捗, 状態)
+        cancel_event (threading.Event): 全ジョブのキャンセル
+        **training_options: fine_tune_modelに渡す学習設定（epochs, batch_size など）
+    Returns:
+        dict: {'jobs': ユーザーごとの結果, 'wall_seconds', 'load_seconds', 'peak_rss_bytes'}
+    """
+    start_time = time.perf_counter()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    cpu_threads = cpu_threads or os.cpu_count() or 1
+    threads_per_job = max(1, cpu_threads // max(1, parallel))
+    use_processes = parallel > 1 and device == "cpu"
+
+    # 共有する標準モデルを1回だけ読み込む
+    global _SHARED_MODEL
+    checkpoint_path = None
+    context = None
+    if use_processes:
+        use_fork = 'fork' in mp.get_all_start_methods()
+        context = mp.get_context('fork' if use_fork else 'spawn')
+        checkpoint_path = resolve_checkpoint(base_model, models_dir=MODELS_DIR)
+        shared_model = load_mmap_model(checkpoint_path, MODELS_DIR)
+        if use_fork:
+            _SHARED_MODEL = shared_model
+    else:
+        shared_model = whisper.load_model(base_model, download_root=MODELS_DIR, device=device)
+    # fine_tune_modelが標準モデルと同じモデルかを確かめるのに使う
+    shared_model.model_name = base_model
+    load_seconds = time.perf_counter() - start_time
+    print(f"共有モデルを読み込みました: {base_model}（{load_seconds:.1f}秒）")
+    memory = estimate_training_bytes(
+        shared_model, training_options.get('batch_size', 4), training_options.get('optimizer_name', 'adamw'),
+        training_options.get('train_decoder_blocks'), training_options.get('parameter_groups'),
+        training_options.get('precision', 'fp32'), training_options.get('gradient_checkpointing', False),
+        shared_frozen=True)
+    print(f"1ジョブあたりのメモリ見込み: {memory / 2 ** 20:.0f}MB、同時実行: 最大{parallel}件、"
+          f"1ジョブあたり{threads_per_job}スレッド")
+
+    registry = ModelRegistry(MODEL_REGISTRY_PATH)
+    scheduler = JobScheduler({'training': parallel}, cpu_threads=cpu_threads, memory_budget=memory_budget)
+    jobs = []
+    results = []
+    for username in usernames:
+        user_dir = os.path.join(users_dir, username)
+        model_dir = os.path.join(user_dir, "models")
+        plan = plan_user_training(user_dir, incremental, replay_ratio, active_model=registry.active_model(username))
+        if plan is None:
+            results.append({'user': username, 'status': 'skipped', 'reason': "新しいデータがありません"})
+            continue
+        if not plan['samples']:
+            results.append({'user': username, 'status': 'skipped', 'reason': "学習データがありません"})
+            continue
+        # 中断した学習があればそこから再開する
+        resume_from = find_resumable_run(model_dir)
+        result = {'user': username, 'status': 'queued', 'resumed': resume_from is not None,
+                  'new': plan['new'], 'replay': plan['replay']}
+        results.append(result)
+
+        args = {'user_dir': user_dir, 'model_dir': model_dir, 'plan': plan, 'resume_from': resume_from,
+                'username': username, 'base_model': base_model}
+
+        def train(job, args=args, username=username):
+            callback = None
+            if progress_callback:
+                callback = lambda progress, status: progress_callback(username, progress, status)
+            if use_processes:
+                return run_in_process(job, context, checkpoint_path, args, callback, **training_options)
+            # 同じプロセスで実行する場合はスケジューラが設定したプロセス全体のスレッド数を変えない
+            return train_user(shared_model=shared_model, num_threads=job.threads, configure_threads=False,
+                              progress_callback=callback, cancel_event=job.cancel_event, **args, **training_options)
+
+        job = scheduler.submit(f"学習 ({username})", train, resource='training', threads=threads_per_job,
+                               memory=memory)
+        jobs.append((job, result))
+
+    for job, result in jobs:
+        while not job.wait(0.5):
+            if cancel_event is not None and cancel_event.is_set():
+                for pending, _ in jobs:
+                    scheduler.cancel(pending.id)
+        result.update(status=job.status, model_path=job.result, run_seconds=job.run_time,
+                      queue_seconds=job.queue_time)
+        if job.error is not None:
+            result['error'] = str(job.error)
+    _SHARED_MODEL = None
+
+    return {
+        'jobs': results,
+        'wall_seconds': time.perf_counter() - start_time,
+        'load_seconds': load_seconds,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+if __name__ == "__main__":
+    # 使い方: python batch_training.py [ユーザー名...] [--parallel N] [--threads N] [--memory-gb GB] [--full]
+    #         ユーザー名を省略すると全ユーザーを学習する
+    args = sys.argv[1:]
+    options = {}
+    for flag, key, convert in [('--parallel', 'parallel', int), ('--threads', 'cpu_threads', int),
+                               ('--memory-gb', 'memory_budget', lambda value: int(float(value) * 2 ** 30))]:
+        if flag in args:
+            index = args.index(flag)
+            options[key] = convert(args[index + 1])
+            del args[index:index + 2]
+    if "--full" in args:
+        # 前回のモデルを使わず、全データを標準モデルから学習
+        args.remove("--full")
+        options['incremental'] = False
+    usernames = args or list_users()
+    if not usernames:
+        print("学習するユーザーがいません")
+        sys.exit(1)
+
+    report = train_users(usernames, **options)
+    print("\n=== ユーザーごとの学習結果 ===")
+    total_run_seconds = 0.0
+    for result in report['jobs']:
+        if result['status'] == 'skipped':
+            print(f"- {result['user']}: スキップ（{result['reason']}）")
+            continue
+        total_run_seconds += result['run_seconds']
+        print(f"- {result['user']}: {result['status']}、新しいデータ {result['new']}件 + 既存データ {result['replay']}件、"
+              f"学習 {result['run_seconds']:.1f}秒（待機 {result['queue_seconds']:.1f}秒）"
+              + (f"\n  保存先: {result['model_path']}" if result.get('model_path') else "")
+              + (f"\n  エラー: {result['error']}" if result.get('error') else ""))
+    peak = report['peak_rss_bytes']
+    print(f"全体の所要時間: {report['wall_seconds']:.1f}秒（ジョブの実行時間の合計 {total_run_seconds:.1f}秒、"
+          f"共有モデルの読み込み {report['load_seconds']:.1f}秒）"
+          + (f"、ピークメモリ {peak / 2 ** 20:.0f}MB" if peak else ""))
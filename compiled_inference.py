@@ -0,0 +1,330 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import replace
+import torch
+import torch._dynamo
+import whisper
+from whisper.decoding import DecodingOptions, Inference
+
+from model_export import CrossKV, _attention, decode_with_inference, decoding_task
+from decoding_presets import get_preset, DEFAULT_PRESET
+from repetition_guard import repetition_guard, DEFAULT_LOOP_POLICY
+
+# セルフアテンションのKVキャッシュの長さのバケット（バッチサイズとバケットの組ごとに1回だけコンパイルする）
+CACHE_BUCKETS = (64, 128, 256, 448)
+
+# プロセス内に保持するコンパイル済みのモデルの数（超えたら最後に使われた時刻の古いものから破棄する）
+MAX_COMPILED_MODELS = 2
+
+# コンパイル済みのモデル（プロセス内で使い回し、2回目以降の文字起こしではコンパイルしない）
+# モデルの場所 → (識別子, モデル)。同じ場所のモデルが更新されたら古いものを置き換える
+_compiled_models = OrderedDict()
+_lock = threading.Lock()
+
+
+def cache_buckets(n_text_ctx):
+    """モデルの最大トークン数までのバケット"""
+    return tuple(bucket for bucket in CACHE_BUCKETS if bucket < n_text_ctx) + (n_text_ctx,)
+
+
+class BucketedDecoderStep(torch.nn.Module):
+    """
+    固定長のKVキャッシュを使うデコーダのステップ
+    キャッシュはバケットの長さで確保し、offsetから始まる位置に新しいトークンのK/Vを書き込んで、各トークンは
+    自分の位置以下だけを参照する（因果マスク）。1トークンずつ進める場合は入力の形がバケットで決まるため、
+    トークンが増えるたびに再コンパイルされることがない。
+    入力: tokens (B, n)、offset (1,)、self_k / self_v (L, B, バケット長, D)（その場で更新）、cross_k / cross_v (L, B, 1500, D)
+    出力: logits (B, n, V)
+    """
+
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+        self.n_head = decoder.blocks[0].attn.n_head
+
+    def forward(self, tokens, offset, self_k, self_v, cross_k, cross_v):
+        decoder = self.decoder
+        positions = offset + torch.arange(tokens.shape[1], device=tokens.device)
+        x = decoder.token_embedding(tokens) + decoder.positional_embedding.index_select(0, positions)
+        mask = torch.arange(self_k.shape[2], device=tokens.device).unsqueeze(0) <= positions.unsqueeze(1)
+        for index, block in enumerate(decoder.blocks):
+            h = block.attn_ln(x)
+            self_k[index].index_copy_(1, positions, block.attn.key(h))
+            self_v[index].index_copy_(1, positions, block.attn.value(h))
+            x = x + block.attn.out(_attention(block.attn.query(h), self_k[index], self_v[index], self.n_head, mask))
+            h = block.cross_attn_ln(x)
+            x = x + block.cross_attn.out(_attention(block.cross_attn.query(h), cross_k[index], cross_v[index],
+                                                    self.n_head))
+            x = x + block.mlp(block.mlp_ln(x))
+        x = decoder.ln(x)
+        return (x @ decoder.token_embedding.weight.T).float()
+
+
+class CompiledInference(Inference):
+    """コンパイルしたデコーダのステップでロジットを計算するDecodingTask用の推論（バケット長のKVキャッシュを保持）"""
+
+    def __init__(self, model, initial_token_length):
+        self.model = model
+        self.initial_token_length = initial_token_length
+        self.cache = None
+
+    def logits(self, tokens, audio_features):
+        if self.cache is None:
+            # 最初の呼び出し: クロスアテンションのK/Vを計算し、初期トークン列（プロンプトを含む）を1回で流し込む
+            # （長さが毎回変わり、形ごとにコンパイルすることになるため、コンパイルしていないステップで計算する）
+            cross_k, cross_v = self.model.cross_kv(audio_features)
+            if cross_k.shape[1] != tokens.shape[0]:
+                n_group = tokens.shape[0] // cross_k.shape[1]
+                cross_k = cross_k.repeat_interleave(n_group, dim=1)
+                cross_v = cross_v.repeat_interleave(n_group, dim=1)
+            self.cache = {'length': 0, 'cross_k': cross_k, 'cross_v': cross_v}
+            return self._step(tokens, self.model.prefill_step)
+        return self._step(tokens[:, -1:], self.model.decoder_step)
+
+    def _allocate(self, batch_size, capacity):
+        dims = self.model.dims
+        cache = self.cache
+        self_k = torch.zeros(dims.n_text_layer, batch_size, capacity, dims.n_text_state)
+        self_v = torch.zeros_like(self_k)
+        if 'self_k' in cache:
+            # バケットを1つ大きくして、それまでのK/Vを移す
+            self_k[:, :, :cache['length']] = cache['self_k'][:, :, :cache['length']]
+            self_v[:, :, :cache['length']] = cache['self_v'][:, :, :cache['length']]
+        cache['self_k'], cache['self_v'] = self_k, self_v
+
+    def _step(self, tokens, step):
+        cache = self.cache
+        length = cache['length'] + tokens.shape[1]
+        if 'self_k' not in cache or length > cache['self_k'].shape[2]:
+            self._allocate(tokens.shape[0], next(bucket for bucket in self.model.buckets if bucket >= length))
+        # トークン列から切り出した列はストライドが異なり再コンパイルの原因になるため、連続したテンソルにする
+        tokens = tokens.clone(memory_format=torch.contiguous_format)
+        logits = step(tokens, torch.tensor([cache['length']]), cache['self_k'], cache['self_v'],
+                      cache['cross_k'], cache['cross_v'])
+        cache['length'] = length
+        return logits
+
+    def cleanup_caching(self):
+        self.cache = None
+
+    def rearrange_kv_cache(self, source_indices):
+        if self.cache is not None and source_indices != list(range(len(source_indices))):
+            self.cache['self_k'] = self.cache['self_k'][:, source_indices]
+            self.cache['self_v'] = self.cache['self_v'][:, source_indices]
+
+
+class CompiledWhisper:
+    """
+    エンコーダとデコーダの1ステップをtorch.compileしたWhisperモデル（whisperのtranscribe/decodeと同じ使い方ができる）
+    形を固定してコンパイルし（dynamic=False）、KVキャッシュの長さはバケットに丸めるため、コンパイルはwarmupで
+    バッチサイズとバケットの組ごとに1回だけ行われる。コンパイル結果はTorchInductorのキャッシュにも保存される。
+    初期トークン列の流し込みと言語の判定は、呼び出しごとに形が変わるためコンパイルせずに計算する。
+    """
+    transcribe = whisper.transcribe
+    # 言語の判定はSOTトークンのロジット（下のlogits）から言語トークンを選ぶ
+    detect_language = whisper.decoding.detect_language
+
+    def __init__(self, model):
+        model = model.float().cpu().eval()
+        self.model = model
+        self.dims = model.dims
+        self.is_multilingual = model.is_multilingual
+        self.num_languages = model.num_languages
+        self.device = torch.device('cpu')
+        # DecodingTaskが作るPyTorchInferenceが参照する（ロジットの計算には使わない）
+        self.decoder = model.decoder
+        self.buckets = cache_buckets(model.dims.n_text_ctx)
+        self.compiled_encoder = torch.compile(model.encoder, dynamic=False)
+        self.cross_kv = torch.compile(CrossKV(model.decoder), dynamic=False)
+        self.prefill_step = BucketedDecoderStep(model.decoder)
+        self.decoder_step = torch.compile(self.prefill_step, dynamic=False)
+        self.warmed_up = set()
+        self.warmup_seconds = 0.0
+
+    def warmup(self, batch_sizes=(1,)):
+        """バッチサイズとバケットの組ごとにコンパイルを済ませる（初回の文字起こしでコンパイルしないように）"""
+        dims = self.dims
+        batch_sizes = [size for size in sorted(set(batch_sizes)) if size not in self.warmed_up]
+        if not batch_sizes:
+            return 0.0
+        # バッチサイズとバケットの組の数だけグラフを保持できるよう、再コンパイルの上限を引き上げる
+        needed = len(self.buckets) * (len(self.warmed_up) + len(batch_sizes))
+        for name in ('recompile_limit', 'cache_size_limit'):
+            if hasattr(torch._dynamo.config, name):
+                setattr(torch._dynamo.config, name, max(getattr(torch._dynamo.config, name), needed))
+        start = time.perf_counter()
+        with torch.no_grad():
+            audio_features = self.encoder(torch.zeros(1, dims.n_mels, 2 * dims.n_audio_ctx))
+            for batch_size in batch_sizes:
+                cross_k, cross_v = self.cross_kv(audio_features.repeat(batch_size, 1, 1))
+                tokens = torch.zeros(batch_size, 1, dtype=torch.long)
+                for bucket in self.buckets:
+                    cache = torch.zeros(dims.n_text_layer, batch_size, bucket, dims.n_text_state)
+                    self.decoder_step(tokens, torch.tensor([0]), cache, cache.clone(), cross_k, cross_v)
+                self.warmed_up.add(batch_size)
+        seconds = time.perf_counter() - start
+        self.warmup_seconds += seconds
+        return seconds
+
+    def encoder(self, mel):
+        # transcribeが切り出した30秒の区間はストライドが異なるため、連続したテンソルにしてから渡す
+        return self.compiled_encoder(mel.contiguous())
+
+    def decode(self, mel, options=DecodingOptions(), **kwargs):
+        return decode_with_inference(self, mel, CompiledInference, options, **kwargs)
+
+    def logits(self, tokens, audio_features):
+        """トークン列全体のロジット（コンパイルしていない元のモデルで計算）"""
+        return self.model.logits(tokens, audio_features)
+
+
+def warmup_batch_sizes(decode_options):
+    """デコード設定で使われるバッチサイズ（貪欲法は1、ビームサーチはビーム幅、温度サンプリングはbest_of）"""
+    sizes = {1}
+    for key in ('beam_size', 'best_of'):
+        if decode_options.get(key):
+            sizes.add(decode_options[key])
+    return sorted(sizes)
+
+
+def get_compiled_model(key, load_model, batch_sizes=(1,), location=None):
+    """
+    コンパイル済みのモデルを取得（プロセス内で初めて使うモデルは読み込んでコンパイルし、ウォームアップする）
+    保持するのは場所ごとに最新の1つで、全体でもMAX_COMPILED_MODELS個まで（最後に使われた時刻の古いものから破棄）。
+    Args:
+        key (str): モデルの識別子（元のモデルが更新されたら変わるもの）
+        load_model (callable): 元のPyTorchモデルを読み込む関数
+        batch_sizes (list): ウォームアップするバッチサイズ
+        location (str): モデルの場所（モデルのディレクトリまたは標準モデル名、省略時はkey）
+    Returns:
+        CompiledWhisper: コンパイル済みのモデル
+    """
+    location = location or key
+    with _lock:
+        cached_key, model = _compiled_models.get(location, (None, None))
+        if cached_key != key:
+            # 更新される前のモデルは、新しいモデルを読み込む前に破棄する
+            _compiled_models.pop(location, None)
+            model = None
+            model = CompiledWhisper(load_model())
+            _compiled_models[location] = (key, model)
+        _compiled_models.move_to_end(location)
+        while len(_compiled_models) > MAX_COMPILED_MODELS:
+            evicted, _ = _compiled_models.popitem(last=False)
+            print(f"コンパイル済みのモデルを破棄しました: {evicted}")
+        seconds = model.warmup(batch_sizes)
+    if seconds:
+        print(f"コンパイル（ウォームアップ）が完了しました: バッチサイズ {batch_sizes}、{seconds:.1f}秒")
+    return model
+
+
+def measure_decode(model, mel, options, inference_class=None):
+    """
+    1回のデコードの最初のトークンまでの時間と、その後のトークン生成速度を測定
+    Returns:
+        dict: {'first_token_seconds'（エンコードと初期トークンの処理を含む）, 'tokens', 'token_seconds', 'text'}
+    """
+    task = decoding_task(model, options, inference_class) if inference_class else \
+        whisper.decoding.DecodingTask(model, options)
+    times = []
+    logits = task.inference.logits
+
+    def timed_logits(tokens, audio_features):
+        result = logits(tokens, audio_features)
+        times.append(time.perf_counter())
+        return result
+
+    task.inference.logits = timed_logits
+    start = time.perf_counter()
+    with torch.no_grad():
+        result = task.run(mel.unsqueeze(0))[0]
+    steps = len(times) - 1
+    return {
+        'first_token_seconds': times[0] - start,
+        'tokens': steps,
+        'token_seconds': times[-1] - times[0],
+        'text': result.text,
+    }
+
+
+def production_options(preset=DEFAULT_PRESET, prompt="日本語の音声を認識します。"):
+    """transcribe_audioの各窓の最初のデコードと同じ設定（プリセットの温度0での設定・タイムスタンプあり・プロンプト）"""
+    decode_options = get_preset(preset)
+    return DecodingOptions(language="ja", task="transcribe", fp16=False, temperature=0.0,
+                           beam_size=decode_options['beam_size'], prompt=prompt)
+
+
+def benchmark_compiled(model, audio_files, preset=DEFAULT_PRESET, repeat=2):
+    """
+    eagerとコンパイルしたモデルで同じクリップをデコードし、最初のトークンまでの時間とトークン生成速度を比較
+    transcribe_audioと同じく、presetの設定・初期プロンプト・繰り返し検出でデコードする。前の出力に条件付ける
+    プリセットでは、前のクリップの認識結果をプロンプトに続けて渡す（長い音声の2窓目以降と同じ）。
+    どちらも1回目はウォームアップとして捨て、2回目以降の定常状態の値を平均する。
+    Returns:
+        dict: {'eager', 'compiled', 'warmup_seconds', 'prompt_tokens'（クリップごとのプロンプトのトークン数）}
+    """
+    from dataset_audio import load_dataset_audio
+    from mel_features import batch_log_mel_spectrogram
+    mels = [batch_log_mel_spectrogram([load_dataset_audio(path, 0, 30)], n_mels=model.dims.n_mels)[0]
+            for path in audio_files]
+    options = production_options(preset)
+    compiled = CompiledWhisper(model)
+    warmup_seconds = compiled.warmup(warmup_batch_sizes(get_preset(preset)))
+    report = {'warmup_seconds': warmup_seconds}
+    with repetition_guard(DEFAULT_LOOP_POLICY):
+        # ウォームアップを兼ねて、eagerで各クリップの認識結果を求めてプロンプトを作る
+        texts = [measure_decode(model.eval(), mel, options)['text'] for mel in mels]
+        prompts = [options.prompt] * len(mels)
+        if get_preset(preset)['condition_on_previous_text']:
+            prompts = [options.prompt] + [options.prompt + text for text in texts[:-1]]
+        tokenizer = whisper.tokenizer.get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                                                    language="ja", task="transcribe")
+        report['prompt_tokens'] = [len(tokenizer.encode(" " + prompt.strip())) for prompt in prompts]
+        for name, target, inference_class in [('eager', model.eval(), None),
+                                              ('compiled', compiled, CompiledInference)]:
+            measure_decode(target, mels[0], options, inference_class)
+            runs = [measure_decode(target, mel, replace(options, prompt=prompt), inference_class)
+                    for mel, prompt in zip(mels, prompts) for _ in range(repeat)]
+            report[name] = {
+                'first_token_seconds': sum(run['first_token_seconds'] for run in runs) / len(runs),
+                'tokens_per_second': sum(run['tokens'] for run in runs) / max(1e-9, sum(run['token_seconds']
+                                                                                      for run in runs)),
+                'texts': [run['text'] for run in runs[::repeat]],
+            }
+    return report
+
+
+if __name__ == "__main__":
+    # 使い方: python compiled_inference.py <音声ファイル...> [--model モデルのディレクトリ] [--preset fast|balanced|accurate]
+    from PersonalizedSR import get_runtime_config, load_custom_model, MODELS_DIR
+    args = sys.argv[1:]
+    model_path = None
+    if "--model" in args:
+        index = args.index("--model")
+        model_path = args[index + 1]
+        del args[index:index + 2]
+    preset = DEFAULT_PRESET
+    if "--preset" in args:
+        index = args.index("--preset")
+        preset = args[index + 1]
+        del args[index:index + 2]
+    if not args:
+        print("使い方: python compiled_inference.py <音声ファイル...> [--model モデルのディレクトリ]"
+              " [--preset fast|balanced|accurate]")
+        sys.exit(1)
+    model_name = get_runtime_config()['model_name']
+    model = load_custom_model(model_path, "cpu") if model_path else \
+        whisper.load_model(model_name, download_root=MODELS_DIR, device="cpu")
+    print(f"=== torch.compileの比較（{model_path or model_name}、{len(args)}ファイル、プリセット {preset}） ===")
+    report = benchmark_compiled(model, args, preset)
+    eager, compiled = report['eager'], report['compiled']
+    print(f"- コンパイル（ウォームアップ）: {report['warmup_seconds']:.1f}秒、"
+          f"プロンプト {min(report['prompt_tokens'])}〜{max(report['prompt_tokens'])}トークン")
+    for name, result in [('eager', eager), ('compiled', compiled)]:
+        print(f"- {name}: 最初のトークンまで {result['first_token_seconds'] * 1000:.0f}ms、"
+              f"{result['tokens_per_second']:.1f}トークン/秒")
+    print(f"- 高速化: 最初のトークンまで {eager['first_token_seconds'] / compiled['first_token_seconds']:.2f}倍、"
+          f"トークン生成 {compiled['tokens_per_second'] / eager['tokens_per_second']:.2f}倍、"
+          f"認識結果の一致 {sum(a == b for a, b in zip(eager['texts'], compiled['texts']))}/{len(eager['texts'])}")
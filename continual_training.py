@@ -0,0 +1,190 @@
+import os
+import json
+import math
+import hashlib
+import random
+import shutil
+
+from dataset_audio import normalize_audio, DATASET_AUDIO_NAME
+
+# 追加学習で新しいデータに混ぜる既存データの割合（新しいデータの件数に対する比率）
+DEFAULT_REPLAY_RATIO = 0.3
+# 新しいデータが少ない場合でも混ぜる既存データの最小件数
+MIN_REPLAY_SAMPLES = 2
+# 学習用に正規化したデータの保存先（ユーザーのディレクトリ内）
+TRAINING_DATASET_SUBDIR = 'training_dataset'
+USER_AUDIO_EXTENSIONS = ('.wav', '.mp3', '.m4a')
+
+
+def sample_key(sample):
+    """学習データを識別するキー（ユーザーの音声ファイル名）"""
+    return os.path.basename(sample['audio'])
+
+
+def sample_fingerprint(sample):
+    """音声のサイズと転記テキストのハッシュ（どちらかが変われば修正されたとみなす）"""
+    with open(sample['transcript'], 'rb') as f:
+        transcript_hash = hashlib.sha1(f.read().strip()).hexdigest()
+    return {'audio_bytes': os.path.getsize(sample['audio']), 'transcript_sha1': transcript_hash}
+
+
+def data_snapshot(samples):
+    """
+    学習に使ったデータの一覧（training_info.json に保存し、次回の追加学習で差分を求めるのに使う）
+    Args:
+        samples (list): {'audio', 'transcript'} のリスト
+    Returns:
+        dict: キー → sample_fingerprintの結果
+    """
+    return {sample_key(sample): sample_fingerprint(sample) for sample in samples}
+
+
+def find_latest_user_model(user_model_dir):
+    """
+    ユーザーの最新の学習済みモデル（model.pt と training_info.json があるもの）
+    Returns:
+        tuple: (モデルのディレクトリ, training_info) 見つからなければ (None, None)
+    """
+    if not os.path.isdir(user_model_dir):
+        return None, None
+    for name in sorted(os.listdir(user_model_dir), reverse=True):
+        model_dir = os.path.join(user_model_dir, name)
+        info_path = os.path.join(model_dir, 'training_info.json')
+        if not (os.path.exists(os.path.join(model_dir, 'model.pt')) and os.path.exists(info_path)):
+            continue
+        with open(info_path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        if info.get('training_completed'):
+            return model_dir, info
+    return None, None
+
+
+def load_model_info(model_dir):
+    """モデルのディレクトリとtraining_info（読み込めなければ (None, None)）"""
+    info_path = os.path.join(model_dir, 'training_info.json')
+    if not os.path.exists(info_path):
+        return None, None
+    with open(info_path, 'r', encoding='utf-8') as f:
+        return model_dir, json.load(f)
+
+
+def select_incremental_samples(samples, previous_snapshot, replay_ratio=DEFAULT_REPLAY_RATIO,
+                               min_replay=MIN_REPLAY_SAMPLES, seed=0):
+    """
+    前回のモデル以降に追加・修正されたデータと、忘却を防ぐために混ぜる既存データを選ぶ
+    Args:
+        samples (list): ユーザーの全学習データ（{'audio', 'transcript'}）
+        previous_snapshot (dict): 前回のモデルのdata_snapshot
+        replay_ratio (float): 新しいデータの件数に対する既存データの割合
+        min_replay (int): 混ぜる既存データの最小件数
+        seed (int): 既存データを選ぶ乱数シード
+    Returns:
+        tuple: (新しいデータのリスト, 既存データから選んだリスト)
+    """
+    new_samples = []
+    old_samples = []
+    for sample in samples:
+        if previous_snapshot.get(sample_key(sample)) == sample_fingerprint(sample):
+            old_samples.append(sample)
+        else:
+            new_samples.append(sample)
+    if not new_samples:
+        return [], []
+    num_replay = min(len(old_samples), max(min_replay, math.ceil(len(new_samples) * replay_ratio)))
+    replay_samples = random.Random(seed).sample(old_samples, num_replay)
+    return new_samples, sorted(replay_samples, key=sample_key)
+
+
+def collect_user_samples(user_dir):
+    """ユーザーの録音のうち転記テキストがあるもの（{'audio', 'transcript'} のリスト）"""
+    audio_dir = os.path.join(user_dir, "audio")
+    if not os.path.isdir(audio_dir):
+        return []
+    samples = []
+    for audio_file in sorted(os.listdir(audio_dir)):
+        if not audio_file.endswith(USER_AUDIO_EXTENSIONS):
+            continue
+        transcript_path = os.path.join(user_dir, "transcripts", os.path.splitext(audio_file)[0] + ".txt")
+        if os.path.exists(transcript_path):
+            samples.append({'audio': os.path.join(audio_dir, audio_file), 'transcript': transcript_path})
+    return samples
+
+
+def prepare_user_dataset(user_dir, samples):
+    """
+    学習データをユーザーの training_dataset/ にデータセット形式で用意
+    変更のない録音は前回正規化したFLACをそのまま使うため、ファイルの更新時刻が変わらず
+    同じユーザーの次回の学習で特徴量キャッシュを再利用できる。
+    Args:
+        user_dir (str): ユーザーのディレクトリ
+        samples (list): {'audio', 'transcript'} のリスト
+    Returns:
+        tuple: (データセットのディレクトリ, 学習に使うサンプルのディレクトリ名のリスト)
+    """
+    dataset_dir = os.path.join(user_dir, TRAINING_DATASET_SUBDIR)
+    names = []
+    for sample in samples:
+        name = os.path.splitext(os.path.basename(sample['audio']))[0]
+        sample_dir = os.path.join(dataset_dir, name)
+        os.makedirs(sample_dir, exist_ok=True)
+        audio_path = os.path.join(sample_dir, DATASET_AUDIO_NAME)
+        # 元の音声が更新された場合だけFLACに正規化し直す（エポックごとのffmpeg起動も避ける）
+        if not os.path.exists(audio_path) or os.path.getmtime(sample['audio']) > os.path.getmtime(audio_path):
+            normalize_audio(sample['audio'], audio_path)
+        transcript_path = os.path.join(sample_dir, "transcript.txt")
+        with open(sample['transcript'], 'rb') as f:
+            transcript = f.read()
+        previous = None
+        if os.path.exists(transcript_path):
+            with open(transcript_path, 'rb') as f:
+                previous = f.read()
+        if previous != transcript:
+            with open(transcript_path, 'wb') as f:
+                f.write(transcript)
+        # 認識時のタイムスタンプ付きセグメント（30秒を超える録音をセグメントの境界で分割するのに使う）
+        segments_path = os.path.splitext(sample['transcript'])[0] + ".json"
+        sample_segments_path = os.path.join(sample_dir, "transcript.json")
+        if os.path.exists(segments_path):
+            shutil.copy2(segments_path, sample_segments_path)
+        elif os.path.exists(sample_segments_path):
+            os.remove(sample_segments_path)
+        names.append(name)
+    return dataset_dir, names
+
+
+def plan_user_training(user_dir, incremental=True, replay_ratio=DEFAULT_REPLAY_RATIO, seed=0, samples=None,
+                       active_model=None):
+    """
+    ユーザーの学習内容を決める
+    incrementalがTrueで、前回のモデルに学習データの一覧があれば、そのモデルから追加・修正分と
+    既存データの一部だけを学習する。それ以外はすべてのデータを標準モデルから学習する。
+    Args:
+        samples (list): 学習の候補（省略時はユーザーの転記済みの全データ）
+        active_model (str): モデル登録簿でのユーザーの現在のモデル（省略時は最新のモデルを探す）
+    Returns:
+        dict: {'base_model'（前回のモデル、なければNone）, 'samples', 'new', 'replay', 'data_snapshot'}
+              追加学習で新しいデータがない場合はNone
+    """
+    if samples is None:
+        samples = collect_user_samples(user_dir)
+    previous_snapshot = {}
+    base_model = None
+    new_samples, replay_samples = samples, []
+    if incremental:
+        previous_model, previous_info = load_model_info(active_model) if active_model else \
+            find_latest_user_model(os.path.join(user_dir, "models"))
+        if previous_model and previous_info.get('data_snapshot') is not None:
+            previous_snapshot = previous_info['data_snapshot']
+            new_samples, replay_samples = select_incremental_samples(samples, previous_snapshot, replay_ratio, seed=seed)
+            if not new_samples:
+                return None
+            base_model = previous_model
+    training_samples = new_samples + replay_samples
+    return {
+        'base_model': base_model,
+        'samples': training_samples,
+        'new': len(new_samples),
+        'replay': len(replay_samples),
+        # このモデルが学習したデータの一覧（前回までの分を引き継ぐ）
+        'data_snapshot': {**previous_snapshot, **data_snapshot(training_samples)},
+    }
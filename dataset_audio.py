@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import soundfile as sf
+import whisper
+
+SAMPLE_RATE = whisper.audio.SAMPLE_RATE
+DATASET_AUDIO_NAME = 'audio.flac'
+
+# soundfileでプロセス内デコードできる形式
+NATIVE_FORMATS = ('.flac', '.wav')
+
+
+def normalize_audio(src_path, dst_path):
+    """
+    音声を16kHzモノラルのFLAC（16bit PCM）に変換して保存
+    Args:
+        src_path (str): 元の音声ファイル（.wav/.mp3/.m4aなど）
+        dst_path (str): 保存先のパス
+    Returns:
+        str: 保存したファイルのパス
+    """
+    # 途中で失敗しても書きかけのFLACが残らないよう、一時ファイルに書いてから置き換える
+    temp_path = dst_path + '.tmp'
+    try:
+        # 取り込み時に一度だけffmpegでデコードする
+        audio = whisper.load_audio(src_path)
+        sf.write(temp_path, audio, SAMPLE_RATE, format='FLAC', subtype='PCM_16')
+        os.replace(temp_path, dst_path)
+        return dst_path
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise RuntimeError(f"音声の正規化に失敗: {src_path}: {str(e)}")
+
+
+def load_dataset_audio(audio_path, start=None, end=None):
+    """
+    データセットの音声をfloat32の16kHzモノラル波形として読み込む
+    正規化済みのFLAC/WAVはプロセス内でデコードし、start/endで指定した区間だけをシークして読む。
+    Args:
+        audio_path (str): 音声ファイルのパス
+        start (float): 読み込み開始位置（秒）
+        end (float): 読み込み終了位置（秒）
+    Returns:
+        np.ndarray: 波形データ
+    """
+    if os.path.splitext(audio_path)[1].lower() in NATIVE_FORMATS:
+        with sf.SoundFile(audio_path) as f:
+            if f.samplerate == SAMPLE_RATE:
+                start_frame = int((start or 0) * SAMPLE_RATE)
+                if start_frame:
+                    f.seek(start_frame)
+                frames = -1 if end is None else max(0, int(end * SAMPLE_RATE) - start_frame)
+                audio = f.read(frames, dtype='float32', always_2d=True)
+                return audio.mean(axis=1) if audio.shape[1] > 1 else audio[:, 0]
+
+    # 未変換のファイルはffmpegでデコード
+    audio = whisper.load_audio(audio_path)
+    start_sample = int((start or 0) * SAMPLE_RATE)
+    end_sample = None if end is None else int(end * SAMPLE_RATE)
+    return audio[start_sample:end_sample]
+
+
+def find_sample_audio(sample_dir):
+    """サンプルディレクトリ内の音声ファイル（audio.*）を取得"""
+    audio_files = sorted(f for f in os.listdir(sample_dir) if f.startswith('audio'))
+    if DATASET_AUDIO_NAME in audio_files:
+        return os.path.join(sample_dir, DATASET_AUDIO_NAME)
+    return os.path.join(sample_dir, audio_files[0]) if audio_files else None
+
+
+def normalize_dataset(dataset_dir, keep_original=False):
+    """
+    データセット内の音声をすべてFLACに変換
+    Args:
+        dataset_dir (str): データセットのディレクトリ
+        keep_original (bool): 元のファイルを残すかどうか
+    Returns:
+        list: (元のファイル, 変換後のファイル, 元のサイズ, 変換後のサイズ) のリスト
+    """
+    converted = []
+    for name in sorted(os.listdir(dataset_dir)):
+        sample_dir = os.path.join(dataset_dir, name)
+        if not os.path.isdir(sample_dir):
+            continue
+        audio_path = find_sample_audio(sample_dir)
+        if audio_path is None or os.path.basename(audio_path) == DATASET_AUDIO_NAME:
+            continue
+
+        dst_path = os.path.join(sample_dir, DATASET_AUDIO_NAME)
+        original_size = os.path.getsize(audio_path)
+        normalize_audio(audio_path, dst_path)
+        converted.append((audio_path, dst_path, original_size, os.path.getsize(dst_path)))
+        if not keep_original:
+            os.remove(audio_path)
+        print(f"✓ 変換しました: {audio_path} -> {dst_path}")
+    return converted
+
+
+def benchmark_decode(audio_paths, repeat=3):
+    """
+    ffmpegのサブプロセス起動による読み込みとプロセス内デコードの速度を比較
+    Args:
+        audio_paths (list): 比較に使う正規化済み音声ファイルのリスト
+        repeat (int): 繰り返し回数
+    Returns:
+        dict: 各方式の処理時間とスループット（音声秒数/秒）
+    """
+    audio_seconds = sum(sf.info(path).duration for path in audio_paths) * repeat
+    report = {'audio_seconds': audio_seconds}
+    for label, loader in [('ffmpeg', whisper.load_audio), ('soundfile', load_dataset_audio)]:
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            for path in audio_paths:
+                loader(path)
+        elapsed = time.perf_counter() - start_time
+        report[label] = {'seconds': elapsed, 'throughput': audio_seconds / elapsed}
+    return report
+
+
+def print_report(converted, decode_report):
+    """変換結果とデコード速度のレポートを表示"""
+    if converted:
+        original_total = sum(item[2] for item in converted)
+        flac_total = sum(item[3] for item in converted)
+        print("\n=== ディスク使用量 ===")
+        print(f"- 変換前: {original_total / 1024 / 1024:.2f} MB")
+        print(f"- 変換後: {flac_total / 1024 / 1024:.2f} MB")
+        print(f"- 削減率: {(1 - flac_total / original_total) * 100:.1f}%")
+    if decode_report:
+        print("\n=== デコード速度 ===")
+        for label in ('ffmpeg', 'soundfile'):
+            item = decode_report[label]
+            print(f"- {label}: {item['seconds']:.2f}秒 ({item['throughput']:.1f} 音声秒/秒)")
+        speedup = decode_report['ffmpeg']['seconds'] / decode_report['soundfile']['seconds']
+        print(f"- 高速化: {speedup:.1f}倍")
+
+
+if __name__ == "__main__":
+    from PersonalizedSR import DATASET_DIR
+
+    target_dir = sys.argv[1] if len(sys.argv) > 1 else DATASET_DIR
+    converted = normalize_dataset(target_dir, keep_original="--keep-original" in sys.argv)
+    flac_paths = []
+    for name in sorted(os.listdir(target_dir)):
+        sample_dir = os.path.join(target_dir, name)
+        if os.path.isdir(sample_dir) and os.path.exists(os.path.join(sample_dir, DATASET_AUDIO_NAME)):
+            flac_paths.append(os.path.join(sample_dir, DATASET_AUDIO_NAME))
+    decode_report = benchmark_decode(flac_paths) if flac_paths else None
+    print_report(converted, decode_report)
@@ -0,0 +1,167 @@
+import sys
+import time
+from whisper.audio import SAMPLE_RATE
+
+from decoding_presets import get_preset
+from dataset_audio import load_dataset_audio
+
+# 再デコードの判定基準（Whisperの温度フォールバックと同じ値）
+LOGPROB_THRESHOLD = -1.0
+COMPRESSION_RATIO_THRESHOLD = 2.4
+NO_SPEECH_THRESHOLD = 0.6
+
+# 再デコード区間の前後に付ける余白（秒）
+MARGIN_SECONDS = 0.2
+
+
+def needs_redecode(segment):
+    """
+    セグメントが低信頼・繰り返しかどうかを判定
+    無音と判定された区間（no_speech_probが高く、logprobも低い）は再デコードしない。
+    """
+    if segment['no_speech_prob'] > NO_SPEECH_THRESHOLD and segment['avg_logprob'] < LOGPROB_THRESHOLD:
+        return False
+    return (segment['avg_logprob'] < LOGPROB_THRESHOLD
+            or segment['compression_ratio'] > COMPRESSION_RATIO_THRESHOLD)
+
+
+def group_flagged(segments, flagged):
+    """連続する要再デコードのセグメントを1つの区間にまとめる"""
+    groups = []
+    for index in flagged:
+        if groups and groups[-1][-1] == index - 1:
+            groups[-1].append(index)
+        else:
+            groups.append([index])
+    return groups
+
+
+def _transcribe(model, audio, preset, initial_prompt, **overrides):
+    options = get_preset(preset)
+    options.update(overrides)
+    return model.transcribe(
+        audio,
+        language="ja",
+        task="transcribe",
+        fp16=False,
+        verbose=None,
+        initial_prompt=initial_prompt,
+        **options
+    )
+
+
+def cascade_transcribe(model, audio, accurate_model=None, fast_preset='fast', accurate_preset='accurate',
+                       initial_prompt="日本語の音声を認識します。"):
+    """
+    高速な1段目の結果のうち、低信頼・繰り返しのセグメントだけを高精度設定で再デコード
+    Args:
+        model: 1段目に使うWhisperモデル
+        audio (str or np.ndarray): 音声ファイルのパス、または16kHzの波形
+        accurate_model: 再デコードに使うモデル（ユーザーのファインチューニング済みモデルなど。省略時はmodel）
+        fast_preset (str): 1段目のプリセット
+        accurate_preset (str): 再デコードのプリセット
+        initial_prompt (str): プロンプト
+    Returns:
+        dict: model.transcribeと同じ形式の結果に 'cascade' の統計を追加したもの
+    """
+    if isinstance(audio, str):
+        audio = load_dataset_audio(audio)
+    accurate_model = accurate_model or model
+
+    start_time = time.perf_counter()
+    result = _transcribe(model, audio, fast_preset, initial_prompt)
+    fast_seconds = time.perf_counter() - start_time
+
+    segments = result['segments']
+    flagged = [index for index, segment in enumerate(segments) if needs_redecode(segment)]
+
+    start_time = time.perf_counter()
+    replacements = {}
+    for group in group_flagged(segments, flagged):
+        start = max(0.0, segments[group[0]]['start'] - MARGIN_SECONDS)
+        end = min(len(audio) / SAMPLE_RATE, segments[group[-1]]['end'] + MARGIN_SECONDS)
+        region = audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)]
+        redecoded = _transcribe(accurate_model, region, accurate_preset, initial_prompt,
+                                condition_on_previous_text=False)
+        new_segments = []
+        for segment in redecoded['segments']:
+            segment = dict(segment)
+            segment['start'] += start
+            segment['end'] += start
+            segment['redecoded'] = True
+            new_segments.append(segment)
+        replacements[group[0]] = (group, new_segments)
+    redecode_seconds = time.perf_counter() - start_time
+
+    # 再デコードした区間のセグメントを置き換える
+    merged = []
+    index = 0
+    while index < len(segments):
+        if index in replacements:
+            group, new_segments = replacements[index]
+            merged.extend(new_segments)
+            index = group[-1] + 1
+        else:
+            merged.append(segments[index])
+            index += 1
+    for segment_id, segment in enumerate(merged):
+        segment['id'] = segment_id
+
+    result['segments'] = merged
+    result['text'] = ''.join(segment['text'] for segment in merged)
+    result['cascade'] = {
+        'segments_total': len(segments),
+        'segments_redecoded': len(flagged),
+        'redecode_fraction': len(flagged) / len(segments) if segments else 0.0,
+        'fast_seconds': fast_seconds,
+        'redecode_seconds': redecode_seconds,
+    }
+    return result
+
+
+def benchmark_cascade(model, audio_paths, accurate_model=None, accurate_preset='accurate'):
+    """
+    常に高精度設定でデコードした場合と比較した再デコード率と高速化率を測定
+    Returns:
+        dict: {'redecode_fraction', 'cascade_seconds', 'accurate_seconds', 'speedup'}
+    """
+    accurate_model = accurate_model or model
+    cascade_seconds = 0.0
+    accurate_seconds = 0.0
+    total_segments = 0
+    redecoded_segments = 0
+    for path in audio_paths:
+        audio = load_dataset_audio(path)
+        start_time = time.perf_counter()
+        result = cascade_transcribe(model, audio, accurate_model, accurate_preset=accurate_preset)
+        cascade_seconds += time.perf_counter() - start_time
+        total_segments += result['cascade']['segments_total']
+        redecoded_segments += result['cascade']['segments_redecoded']
+
+        start_time = time.perf_counter()
+        _transcribe(accurate_model, audio, accurate_preset, "日本語の音声を認識します。")
+        accurate_seconds += time.perf_counter() - start_time
+
+    return {
+        'redecode_fraction': redecoded_segments / total_segments if total_segments else 0.0,
+        'cascade_seconds': cascade_seconds,
+        'accurate_seconds': accurate_seconds,
+        'speedup': accurate_seconds / cascade_seconds if cascade_seconds else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    # 使い方: python decoding_cascade.py <音声ファイル...>
+    import whisper
+    from PersonalizedSR import get_runtime_config, MODELS_DIR
+
+    if len(sys.argv) < 2:
+        print("使い方: python decoding_cascade.py <音声ファイル...>")
+        sys.exit(1)
+    model = whisper.load_model(get_runtime_config()['model_name'], download_root=MODELS_DIR)
+    report = benchmark_cascade(model, sys.argv[1:])
+    print("=== 段階的デコードの測定結果 ===")
+    print(f"- 再デコードしたセグメントの割合: {report['redecode_fraction'] * 100:.1f}%")
+    print(f"- 段階的デコード: {report['cascade_seconds']:.2f}秒")
+    print(f"- 常に高精度設定: {report['accurate_seconds']:.2f}秒")
+    print(f"- 高速化: {report['speedup']:.2f}倍")
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+from datetime import datetime
+import soundfile as sf
+
+from evaluation import character_error_rate
+
+# 速度と精度のバランスを切り替えるデコード設定
+PRESETS = {
+    # 貪欲法のみ。温度フォールバックによる再デコードを行わない
+    'fast': {
+        'beam_size': None,
+        'best_of': None,
+        'temperature': (0.0,),
+        'compression_ratio_threshold': None,
+        'logprob_threshold': None,
+        'condition_on_previous_text': False,
+    },
+    # 貪欲法＋短い温度フォールバック。前の出力に条件付けしないことで繰り返しの連鎖を防ぐ
+    'balanced': {
+        'beam_size': None,
+        'best_of': 3,
+        'temperature': (0.0, 0.4, 0.8),
+        'compression_ratio_threshold': 2.4,
+        'logprob_threshold': -1.0,
+        'condition_on_previous_text': False,
+    },
+    # ビームサーチ＋Whisper標準の温度フォールバック
+    'accurate': {
+        'beam_size': 5,
+        'best_of': 5,
+        'temperature': (0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+        'compression_ratio_threshold': 2.4,
+        'logprob_threshold': -1.0,
+        'condition_on_previous_text': True,
+    },
+}
+
+PRESET_LABELS = {
+    'fast': '高速',
+    'balanced': 'バランス',
+    'accurate': '高精度',
+}
+
+DEFAULT_PRESET = 'balanced'
+
+
+def get_preset(name):
+    """プリセット名からmodel.transcribeに渡すオプションを取得"""
+    if name not in PRESETS:
+        raise ValueError(f"未知のプリセットです: {name}（{', '.join(PRESETS)} から選択してください）")
+    return dict(PRESETS[name])
+
+
+def load_corpus(corpus_dir):
+    """
+    評価用コーパス（データセットと同じ構成）を読み込む
+    Returns:
+        list: (音声ファイル, 正解テキスト) のリスト
+    """
+    from dataset_audio import find_sample_audio
+
+    corpus = []
+    for name in sorted(os.listdir(corpus_dir)):
+        sample_dir = os.path.join(corpus_dir, name)
+        transcript_path = os.path.join(sample_dir, 'transcript.txt')
+        if not os.path.isdir(sample_dir) or not os.path.exists(transcript_path):
+            continue
+        audio_path = find_sample_audio(sample_dir)
+        if audio_path:
+            with open(transcript_path, 'r', encoding='utf-8') as f:
+                corpus.append((audio_path, f.read().strip()))
+    return corpus
+
+
+def benchmark_presets(model, corpus, presets=None, initial_prompt=None):
+    """
+    各プリセットの実時間係数（RTF）とCERを測定
+    Args:
+        model: Whisperモデル
+        corpus (list): (音声ファイル, 正解テキスト) のリスト
+        presets (list): 測定するプリセット名（省略時はすべて）
+        initial_prompt (str): transcribeに渡すプロンプト
+    Returns:
+        dict: プリセット名ごとの {'rtf', 'cer', 'audio_seconds', 'process_seconds'}
+    """
+    audio_seconds = sum(sf.info(audio_path).duration for audio_path, _ in corpus)
+    results = {}
+    for name in presets or PRESETS:
+        options = get_preset(name)
+        process_seconds = 0.0
+        errors = []
+        for audio_path, reference in corpus:
+            start_time = time.perf_counter()
+            result = model.transcribe(
+                audio_path,
+                language="ja",
+                task="transcribe",
+                fp16=False,
+                verbose=None,
+                initial_prompt=initial_prompt,
+                **options
+            )
+            process_seconds += time.perf_counter() - start_time
+            errors.append(character_error_rate(reference, result['text']))
+        results[name] = {
+            'rtf': process_seconds / audio_seconds,
+            'cer': sum(errors) / len(errors),
+            'audio_seconds': audio_seconds,
+            'process_seconds': process_seconds,
+        }
+        print(f"✓ {name}: RTF={results[name]['rtf']:.3f} CER={results[name]['cer'] * 100:.1f}%")
+    return results
+
+
+def format_table(results):
+    """測定結果をMarkdownの表に整形"""
+    lines = [
+        "| プリセット | RTF | CER | 音声長(秒) | 処理時間(秒) |",
+        "|---|---|---|---|---|",
+    ]
+    for name, item in results.items():
+        lines.append(f"| {name} ({PRESET_LABELS[name]}) | {item['rtf']:.3f} | {item['cer'] * 100:.1f}% "
+                     f"| {item['audio_seconds']:.1f} | {item['process_seconds']:.1f} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # 使い方: python decoding_presets.py <評価用コーパスのディレクトリ>
+    import whisper
+    from PersonalizedSR import MODEL_NAME, MODELS_DIR, PROJECT_DIR
+
+    if len(sys.argv) < 2:
+        print("使い方: python decoding_presets.py <評価用コーパスのディレクトリ>")
+        sys.exit(1)
+    corpus = load_corpus(sys.argv[1])
+    if not corpus:
+        print("評価用のデータが見つかりません")
+        sys.exit(1)
+
+    model = whisper.load_model(MODEL_NAME, download_root=MODELS_DIR)
+    results = benchmark_presets(model, corpus, initial_prompt="日本語の音声を認識します。")
+    table = format_table(results)
+    print("\n" + table)
+
+    # 測定結果を保存
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_path = os.path.join(PROJECT_DIR, f'preset_benchmark_{timestamp}.json')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({'model': MODEL_NAME, 'corpus': sys.argv[1], 'results': results},
+                  f, ensure_ascii=False, indent=2)
+    print(f"\n測定結果を保存しました: {report_path}")
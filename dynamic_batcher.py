@@ -0,0 +1,186 @@
+import sys
+import time
+import queue
+import random
+import threading
+from concurrent.futures import Future
+import numpy as np
+import torch
+import whisper
+
+from mel_features import batch_log_mel_spectrogram
+
+DEFAULT_OPTIONS = whisper.DecodingOptions(language="ja", task="transcribe", fp16=False)
+
+
+class _Request:
+    def __init__(self, mel, options):
+        self.mel = mel
+        self.options = options
+        self.future = Future()
+
+
+class DynamicBatcher:
+    def __init__(self, model, max_batch_size=8, max_wait_ms=10):
+        """
+        同時に届いた30秒窓をまとめてエンコーダとデコーダに通す動的バッチ処理
+        デコードはWhisperのバッチ対応デコーダで行い、KVキャッシュは系列ごとに保持される。
+        Args:
+            model: Whisperモデル
+            max_batch_size (int): 1バッチの最大窓数
+            max_wait_ms (float): 最初のリクエストからバッチを締め切るまでの最大待ち時間（ミリ秒）
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_sizes = []
+        self._queue = queue.Queue()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """バッチ処理スレッドを起動"""
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """バッチ処理スレッドを停止（キューに残ったリクエストは処理してから終了）"""
+        self._running = False
+        self._queue.put(None)
+        self._thread.join()
+
+    def submit(self, mel, options=None):
+        """
+        ログメル（n_mels, 3000）の窓を登録
+        Returns:
+            Future: DecodingResultを返すFuture
+        """
+        request = _Request(mel, options or DEFAULT_OPTIONS)
+        self._queue.put(request)
+        return request.future
+
+    def submit_audio(self, audio, options=None):
+        """16kHzの波形（30秒以内）を登録"""
+        mel = batch_log_mel_spectrogram([audio], n_mels=self.model.dims.n_mels)[0]
+        return self.submit(mel, options)
+
+    def _collect(self):
+        """最初のリクエストを待ち、締め切りまでに届いたリクエストをまとめる"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                if not self._running and self._queue.empty():
+                    break
+                continue
+            self.batch_sizes.append(len(batch))
+
+            # デコード設定ごとにグループ化（同じ設定のものだけを1回のデコードで処理）
+            groups = {}
+            for index, request in enumerate(batch):
+                groups.setdefault(repr(request.options), []).append(index)
+            try:
+                with torch.no_grad():
+                    mel = torch.stack([request.mel for request in batch]).to(self.model.device)
+                    audio_features = self.model.encoder(mel)
+                    for indices in groups.values():
+                        # エンコーダ出力を渡すとdecode内でのエンコードは省略される
+                        results = self.model.decode(audio_features[indices], batch[indices[0]].options)
+                        for index, result in zip(indices, results):
+                            batch[index].future.set_result(result)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+
+def percentile(values, q):
+    """パーセンタイル値"""
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run_load_test(model, num_clients=8, requests_per_client=4, clip_seconds=5.0,
+                  max_batch_size=8, max_wait_ms=10, options=None, mean_interval=0.05):
+    """
+    合成負荷でレイテンシとスループットを測定
+    Args:
+        model: Whisperモデル
+        num_clients (int): 同時にリクエストを送るクライアント数
+        requests_per_client (int): クライアントあたりのリクエスト数
+        clip_seconds (float): 1クリップの長さ（秒）
+        max_batch_size (int): 最大バッチサイズ
+        max_wait_ms (float): 最大待ち時間（ミリ秒）
+        options: DecodingOptions
+        mean_interval (float): クライアントのリクエスト間隔の平均（秒）
+    Returns:
+        dict: p50/p90/p99レイテンシ（秒）、スループット（リクエスト/秒）、平均バッチサイズ
+    """
+    rng = np.random.default_rng(0)
+    clip = (rng.standard_normal(int(clip_seconds * whisper.audio.SAMPLE_RATE)) * 0.05).astype(np.float32)
+    mel = batch_log_mel_spectrogram([clip], n_mels=model.dims.n_mels)[0]
+    latencies = []
+    lock = threading.Lock()
+    batcher = DynamicBatcher(model, max_batch_size, max_wait_ms).start()
+
+    def client(seed):
+        local_random = random.Random(seed)
+        for _ in range(requests_per_client):
+            time.sleep(local_random.expovariate(1.0 / mean_interval))
+            start_time = time.perf_counter()
+            batcher.submit(mel, options).result()
+            with lock:
+                latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    batcher.close()
+
+    return {
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'throughput': len(latencies) / elapsed,
+        'mean_batch_size': float(np.mean(batcher.batch_sizes)),
+    }
+
+
+if __name__ == "__main__":
+    # 使い方: python dynamic_batcher.py [最大バッチサイズ] [最大待ち時間ms]
+    from PersonalizedSR import get_runtime_config, MODELS_DIR
+
+    max_batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    max_wait_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    model = whisper.load_model(get_runtime_config()['model_name'], download_root=MODELS_DIR)
+
+    print("=== 動的バッチ処理の負荷テスト ===")
+    for label, batch_size in [("バッチなし", 1), ("動的バッチ", max_batch_size)]:
+        report = run_load_test(model, max_batch_size=batch_size, max_wait_ms=max_wait_ms)
+        print(f"- {label}: p50={report['p50'] * 1000:.0f}ms p90={report['p90'] * 1000:.0f}ms "
+              f"p99={report['p99'] * 1000:.0f}ms スループット={report['throughput']:.2f}件/秒 "
+              f"平均バッチ={report['mean_batch_size']:.1f}")
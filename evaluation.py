@@ -0,0 +1,42 @@
+import re
+import unicodedata
+
+# CER計算で無視する記号（句読点・空白）
+_IGNORED_CHARS = re.compile(r"[\s、。，．,.!?！？「」『』（）()・…ー〜~\-\"']")
+
+
+def normalize_text(text):
+    """CER計算用にテキストを正規化（全角・半角の統一と記号の除去）"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    return _IGNORED_CHARS.sub('', text)
+
+
+def edit_distance(reference, hypothesis):
+    """2つの文字列のレーベンシュタイン距離"""
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_char in enumerate(reference, 1):
+        current = [i]
+        for j, hyp_char in enumerate(hypothesis, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ref_char != hyp_char)
+            ))
+        previous = current
+    return previous[-1]
+
+
+def character_error_rate(reference, hypothesis):
+    """
+    文字誤り率（CER）を計算
+    Args:
+        reference (str): 正解テキスト
+        hypothesis (str): 認識結果
+    Returns:
+        float: CER（正解が空の場合は認識結果が空なら0、そうでなければ1）
+    """
+    reference = normalize_text(reference)
+    hypothesis = normalize_text(hypothesis)
+    if not reference:
+        return 0.0 if not hypothesis else 1.0
+    return edit_distance(reference, hypothesis) / len(reference)
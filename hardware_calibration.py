@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import platform
+from datetime import datetime
+import torch
+from whisper.model import ModelDimensions, Whisper
+
+# 各モデルサイズの構成（重みのダウンロードなしで計算量を再現するために使用）
+MODEL_DIMENSIONS = {
+    'tiny': dict(n_audio_state=384, n_audio_head=6, n_audio_layer=4,
+                 n_text_state=384, n_text_head=6, n_text_layer=4),
+    'base': dict(n_audio_state=512, n_audio_head=8, n_audio_layer=6,
+                 n_text_state=512, n_text_head=8, n_text_layer=6),
+    'small': dict(n_audio_state=768, n_audio_head=12, n_audio_layer=12,
+                  n_text_state=768, n_text_head=12, n_text_layer=12),
+    'medium': dict(n_audio_state=1024, n_audio_head=16, n_audio_layer=24,
+                   n_text_state=1024, n_text_head=16, n_text_layer=24),
+}
+CANDIDATE_MODELS = ['tiny', 'base', 'small', 'medium']
+
+# 30秒の窓あたりに生成されるトークン数の目安（日本語の会話音声）
+TOKENS_PER_WINDOW = 100
+WINDOW_SECONDS = 30.0
+DEFAULT_TARGET_RTF = 0.5
+CALIBRATION_FILE = 'calibration.json'
+
+
+def hardware_fingerprint():
+    """キャリブレーション結果の再利用判定に使うハードウェア情報"""
+    fingerprint = {
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.system(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__,
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+    return fingerprint
+
+
+def build_dummy_model(model_name, device):
+    """ランダムな重みで指定サイズのWhisperモデルを構築"""
+    dims = ModelDimensions(n_mels=80, n_audio_ctx=1500, n_vocab=51865, n_text_ctx=448,
+                           **MODEL_DIMENSIONS[model_name])
+    return Whisper(dims).to(device).eval()
+
+
+def thread_candidates(cpu_count):
+    """試すintra-opスレッド数（2の累乗とコア数）"""
+    candidates = []
+    threads = 1
+    while threads < cpu_count:
+        candidates.append(threads)
+        threads *= 2
+    candidates.append(cpu_count)
+    return candidates
+
+
+@torch.no_grad()
+def measure_rtf(model, threads, decode_steps=20):
+    """
+    エンコーダ1回とデコーダのステップ実行時間から30秒窓の実時間係数を推定
+    Args:
+        model: Whisperモデル
+        threads (int): intra-opスレッド数
+        decode_steps (int): 測定するデコーダのステップ数
+    Returns:
+        float: 推定RTF（処理時間/音声長）
+    """
+    torch.set_num_threads(threads)
+    device = next(model.parameters()).device
+    mel = torch.randn(1, model.dims.n_mels, 3000, device=device)
+
+    # ウォームアップ
+    audio_features = model.encoder(mel)
+
+    start_time = time.perf_counter()
+    audio_features = model.encoder(mel)
+    encoder_time = time.perf_counter() - start_time
+
+    kv_cache, hooks = model.install_kv_cache_hooks()
+    try:
+        tokens = torch.zeros(1, 4, dtype=torch.long, device=device)
+        model.decoder(tokens, audio_features, kv_cache=kv_cache)
+        start_time = time.perf_counter()
+        for _ in range(decode_steps):
+            model.decoder(tokens[:, -1:], audio_features, kv_cache=kv_cache)
+        step_time = (time.perf_counter() - start_time) / decode_steps
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    return (encoder_time + step_time * TOKENS_PER_WINDOW) / WINDOW_SECONDS
+
+
+def calibrate(target_rtf=DEFAULT_TARGET_RTF, candidates=None):
+    """
+    ホストのベンチマークを行い、目標RTFを満たす最大のモデルとスレッド数を選択
+    Args:
+        target_rtf (float): 目標とする実時間係数
+        candidates (list): 試すモデルサイズ（小さい順）
+    Returns:
+        dict: キャリブレーション結果
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    cpu_count = os.cpu_count() or 1
+    threads_list = thread_candidates(cpu_count) if device == "cpu" else [1]
+    measurements = {}
+    chosen = None
+
+    for model_name in candidates or CANDIDATE_MODELS:
+        model = build_dummy_model(model_name, device)
+        results = {threads: measure_rtf(model, threads) for threads in threads_list}
+        del model
+        best_threads = min(results, key=results.get)
+        measurements[model_name] = {str(threads): rtf for threads, rtf in results.items()}
+        print(f"✓ {model_name}: 最良RTF={results[best_threads]:.3f}（{best_threads}スレッド）")
+
+        if chosen is None or results[best_threads] <= target_rtf:
+            chosen = (model_name, best_threads, results[best_threads])
+        if results[best_threads] > target_rtf:
+            # これより大きいモデルは目標を満たさない
+            break
+
+    model_name, intra_threads, rtf = chosen
+    return {
+        'fingerprint': hardware_fingerprint(),
+        'target_rtf': target_rtf,
+        'model_name': model_name,
+        'intra_op_threads': intra_threads,
+        # デコードは逐次処理が中心のため、inter-opスレッドは少数に抑える
+        'inter_op_threads': max(1, min(4, cpu_count // intra_threads)),
+        'estimated_rtf': rtf,
+        'measurements': measurements,
+        'timestamp': datetime.now().strftime("%Y%m%d_%H%M%S"),
+    }
+
+
+def load_calibration(project_dir):
+    """保存済みのキャリブレーション結果を読み込む（ハードウェアが変わっていればNone）"""
+    calibration_path = os.path.join(project_dir, CALIBRATION_FILE)
+    if not os.path.exists(calibration_path):
+        return None
+    try:
+        with open(calibration_path, 'r', encoding='utf-8') as f:
+            calibration = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"キャリブレーション結果の読み込みに失敗: {str(e)}")
+        return None
+    if calibration.get('fingerprint') != hardware_fingerprint():
+        print("ハードウェア構成が変わったため再キャリブレーションが必要です")
+        return None
+    return calibration
+
+
+def save_calibration(project_dir, calibration):
+    """キャリブレーション結果を保存"""
+    calibration_path = os.path.join(project_dir, CALIBRATION_FILE)
+    with open(calibration_path, 'w', encoding='utf-8') as f:
+        json.dump(calibration, f, ensure_ascii=False, indent=2)
+    return calibration_path
+
+
+def get_calibration(project_dir, target_rtf=DEFAULT_TARGET_RTF, force=False):
+    """保存済みの結果があれば再利用し、なければキャリブレーションを実行して保存"""
+    calibration = None if force else load_calibration(project_dir)
+    if calibration is None:
+        print("ハードウェアのキャリブレーションを実行中...")
+        calibration = calibrate(target_rtf)
+        path = save_calibration(project_dir, calibration)
+        print(f"✓ キャリブレーション結果を保存しました: {path}")
+    return calibration
+
+
+if __name__ == "__main__":
+    # 使い方: python hardware_calibration.py [目標RTF]
+    from PersonalizedSR import PROJECT_DIR
+
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TARGET_RTF
+    result = get_calibration(PROJECT_DIR, target_rtf=target, force=True)
+    print(f"\nモデル: {result['model_name']}")
+    print(f"intra-opスレッド数: {result['intra_op_threads']}")
+    print(f"inter-opスレッド数: {result['inter_op_threads']}")
+    print(f"推定RTF: {result['estimated_rtf']:.3f}")
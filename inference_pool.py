@@ -0,0 +1,254 @@
+import os
+import sys
+import time
+import queue
+import traceback
+import multiprocessing as mp
+import torch
+import whisper
+from whisper.model import ModelDimensions, Whisper
+
+from decoding_presets import get_preset, DEFAULT_PRESET
+from dataset_audio import load_dataset_audio, SAMPLE_RATE
+from repetition_guard import repetition_guard, DEFAULT_LOOP_POLICY
+from model_delta import is_delta_checkpoint, load_delta_model
+
+# fork時に子プロセスへコピーオンライトで共有するモデル
+_SHARED_MODEL = None
+
+
+def resolve_checkpoint(model_name=None, model_path=None, models_dir=None):
+    """
+    ワーカーがメモリマップで読み込むチェックポイントファイルのパスを取得
+    Args:
+        model_name (str): 標準モデル名（'base' など）
+        model_path (str): ファインチューニング済みモデルのディレクトリ
+        models_dir (str): 標準モデルの保存先
+    Returns:
+        str: チェックポイントファイルのパス
+    """
+    if model_path:
+        return os.path.join(model_path, 'model.pt')
+    checkpoint_path = os.path.join(models_dir, os.path.basename(whisper._MODELS[model_name]))
+    if not os.path.exists(checkpoint_path):
+        # 未ダウンロードの場合は一度ロードしてダウンロードさせる
+        whisper.load_model(model_name, download_root=models_dir, device="cpu")
+    return checkpoint_path
+
+
+def load_mmap_model(checkpoint_path, models_dir=None):
+    """
+    チェックポイントをメモリマップで読み込み、重みをコピーせずにモデルを構築
+    差分形式のモデルは標準モデルをメモリマップで読み込み、差分のあるテンソルだけを新たに作る。
+    """
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True, weights_only=False)
+    if is_delta_checkpoint(checkpoint):
+        base_model = load_mmap_model(resolve_checkpoint(checkpoint['reference'], models_dir=models_dir))
+        return load_delta_model(checkpoint, "cpu", models_dir, base_model).eval()
+    dims = checkpoint['dims']
+    if isinstance(dims, dict):
+        dims = ModelDimensions(**dims)
+    model = Whisper(dims)
+    # assign=Trueでメモリマップされたテンソルをそのままパラメータとして使う
+    model.load_state_dict(checkpoint['model_state_dict'], assign=True)
+    return model.eval()
+
+
+def split_cores(num_workers, threads_per_worker):
+    """ワーカーごとに割り当てるCPUコアの組を作成"""
+    cpu_count = os.cpu_count() or 1
+    cores = []
+    for worker_id in range(num_workers):
+        start = (worker_id * threads_per_worker) % cpu_count
+        cores.append([(start + i) % cpu_count for i in range(threads_per_worker)])
+    return cores
+
+
+def _worker_main(worker_id, cores, threads, checkpoint_path, models_dir, decode_options, job_queue, result_queue):
+    """ワーカープロセス: 共有キューからジョブを取り出して文字起こしを実行"""
+    if hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError as e:
+            print(f"ワーカー{worker_id}: CPUコアの割り当てに失敗: {str(e)}")
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    model = _SHARED_MODEL if _SHARED_MODEL is not None else load_mmap_model(checkpoint_path, models_dir)
+    result_queue.put(('ready', worker_id, None))
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, audio_path = job
+        start_time = time.perf_counter()
+        try:
+            # WAV/FLACはffmpegを起動せずにプロセス内でデコード
+            audio = load_dataset_audio(audio_path)
+            with torch.no_grad(), repetition_guard(DEFAULT_LOOP_POLICY) as loop_stats:
+                result = model.transcribe(
+                    audio,
+                    language="ja",
+                    task="transcribe",
+                    fp16=False,
+                    verbose=None,
+                    initial_prompt="日本語の音声を認識します。",
+                    **decode_options
+                )
+            loop_stats.add_audio(len(audio) / SAMPLE_RATE)
+            result_queue.put(('done', job_id, {
+                'audio_path': audio_path,
+                'text': result['text'],
+                'segments': result['segments'],
+                'elapsed': time.perf_counter() - start_time,
+                'worker_id': worker_id,
+                'repetition': loop_stats.as_dict(),
+            }))
+        except Exception as e:
+            result_queue.put(('error', job_id, {
+                'audio_path': audio_path,
+                'error': f"{str(e)}\n{traceback.format_exc()}",
+                'worker_id': worker_id,
+            }))
+
+
+class InferencePool:
+    def __init__(self, checkpoint_path, num_workers=None, threads_per_worker=None, preset=DEFAULT_PRESET,
+                 models_dir=None):
+        """
+        CPUコアごとにワーカープロセスを割り当てる推論プール
+        forkが使える環境では親プロセスで読み込んだ重みをコピーオンライトで共有し、
+        それ以外ではチェックポイントを各ワーカーがメモリマップで読み込む（ページキャッシュを共有）。
+        Args:
+            checkpoint_path (str): チェックポイントファイル（resolve_checkpointで取得）
+            num_workers (int): ワーカー数
+            threads_per_worker (int): ワーカーあたりのスレッド数
+            preset (str): デコード設定のプリセット
+            models_dir (str): 差分形式のモデルの基準となる標準モデルの保存先
+        """
+        cpu_count = os.cpu_count() or 1
+        self.checkpoint_path = checkpoint_path
+        self.models_dir = models_dir
+        self.num_workers = num_workers or max(1, cpu_count // 4)
+        self.threads_per_worker = threads_per_worker or max(1, cpu_count // self.num_workers)
+        self.decode_options = get_preset(preset)
+        self.use_fork = 'fork' in mp.get_all_start_methods()
+        self._context = mp.get_context('fork' if self.use_fork else 'spawn')
+        self._job_queue = None
+        self._result_queue = None
+        self._workers = []
+        self._next_job_id = 0
+
+    def start(self):
+        """ワーカープロセスを起動し、全ワーカーの準備完了まで待機"""
+        global _SHARED_MODEL
+        if self.use_fork:
+            _SHARED_MODEL = load_mmap_model(self.checkpoint_path, self.models_dir)
+        self._job_queue = self._context.Queue()
+        self._result_queue = self._context.Queue()
+        cores = split_cores(self.num_workers, self.threads_per_worker)
+        for worker_id in range(self.num_workers):
+            process = self._context.Process(
+                target=_worker_main,
+                args=(worker_id, cores[worker_id], self.threads_per_worker, self.checkpoint_path, self.models_dir,
+                      self.decode_options, self._job_queue, self._result_queue),
+                daemon=True
+            )
+            process.start()
+            self._workers.append(process)
+
+        ready = 0
+        while ready < self.num_workers:
+            kind, _, _ = self._get_result()
+            if kind == 'ready':
+                ready += 1
+        print(f"✓ 推論プールを起動しました（{self.num_workers}ワーカー × {self.threads_per_worker}スレッド）")
+        return self
+
+    def _get_result(self):
+        """結果キューから取り出す（ワーカーの異常終了を検知）"""
+        while True:
+            try:
+                return self._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self._workers):
+                    raise RuntimeError("推論プールのワーカーがすべて終了しました")
+
+    def submit(self, audio_path):
+        """ジョブを共有キューに追加し、ジョブIDを返す"""
+        job_id = self._next_job_id
+        self._next_job_id += 1
+        self._job_queue.put((job_id, audio_path))
+        return job_id
+
+    def map(self, audio_paths):
+        """
+        複数の音声ファイルを文字起こしし、入力順に結果を返す
+        Returns:
+            list: 各ファイルの結果（失敗した場合は 'error' を含む辞書）
+        """
+        job_ids = [self.submit(path) for path in audio_paths]
+        results = {}
+        while len(results) < len(job_ids):
+            kind, job_id, payload = self._get_result()
+            if kind in ('done', 'error'):
+                results[job_id] = payload
+        return [results[job_id] for job_id in job_ids]
+
+    def close(self):
+        """ワーカープロセスを停止"""
+        global _SHARED_MODEL
+        for _ in self._workers:
+            self._job_queue.put(None)
+        for process in self._workers:
+            process.join()
+        self._workers = []
+        _SHARED_MODEL = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def benchmark_pool(checkpoint_path, audio_paths, worker_counts=(1, 2, 4, 8), preset=DEFAULT_PRESET):
+    """
+    ワーカー数ごとのスループット（ファイル/時間）を測定
+    Returns:
+        dict: ワーカー数ごとの {'seconds', 'files_per_hour', 'threads_per_worker'}
+    """
+    cpu_count = os.cpu_count() or 1
+    report = {}
+    for num_workers in worker_counts:
+        threads = max(1, cpu_count // num_workers)
+        with InferencePool(checkpoint_path, num_workers, threads, preset) as pool:
+            start_time = time.perf_counter()
+            results = pool.map(audio_paths)
+            elapsed = time.perf_counter() - start_time
+        errors = sum(1 for result in results if 'error' in result)
+        report[num_workers] = {
+            'seconds': elapsed,
+            'files_per_hour': len(audio_paths) / elapsed * 3600,
+            'threads_per_worker': threads,
+            'errors': errors,
+        }
+        print(f"- {num_workers}ワーカー × {threads}スレッド: "
+              f"{report[num_workers]['files_per_hour']:.1f} ファイル/時間 ({elapsed:.1f}秒)")
+    return report
+
+
+if __name__ == "__main__":
+    # 使い方: python inference_pool.py <音声ファイル...>
+    from PersonalizedSR import get_runtime_config, MODELS_DIR
+
+    if len(sys.argv) < 2:
+        print("使い方: python inference_pool.py <音声ファイル...>")
+        sys.exit(1)
+    checkpoint = resolve_checkpoint(get_runtime_config()['model_name'], models_dir=MODELS_DIR)
+    print("=== 推論プールのスループット測定 ===")
+    benchmark_pool(checkpoint, sys.argv[1:])
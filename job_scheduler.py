@@ -0,0 +1,210 @@
+import threading
+import heapq
+import itertools
+import os
+import time
+import traceback
+
+# リソースごとの同時実行数（推論スロットと学習スロット）
+DEFAULT_RESOURCE_LIMITS = {
+    'inference': 1,
+    'training': 1,
+}
+
+STATUS_LABELS = {
+    'queued': '待機中',
+    'running': '実行中',
+    'completed': '完了',
+    'failed': 'エラー',
+    'cancelled': 'キャンセル',
+}
+
+
+class JobCancelled(Exception):
+    """ジョブがキャンセルされたことを示す例外"""
+
+
+class Job:
+    def __init__(self, job_id, name, func, resource, priority, threads, memory=0):
+        """
+        スケジューラで管理されるジョブ
+        Args:
+            job_id (int): ジョブID
+            name (str): 表示名
+            func (callable): 実行する関数（引数にJobを受け取る）
+            resource (str): 使用するリソース名（'inference' / 'training'）
+            priority (int): 優先度（小さいほど優先）
+            threads (int): ジョブに割り当てるCPUスレッド数（同時実行数の判断と、子プロセスやONNX Runtimeのセッションに使う）
+            memory (int): ジョブが使う見込みのメモリ量（バイト）
+        """
+        self.id = job_id
+        self.name = name
+        self.func = func
+        self.resource = resource
+        self.priority = priority
+        self.threads = threads
+        self.memory = memory
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._finished = threading.Event()
+
+    def cancel(self):
+        """キャンセルを要求（実行中のジョブは次のチェックポイントで停止）"""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        """キャンセルが要求されていればJobCancelledを送出"""
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"ジョブがキャンセルされました: {self.name}")
+
+    def wait(self, timeout=None):
+        """ジョブが終了するまで待つ"""
+        return self._finished.wait(timeout)
+
+    @property
+    def queue_time(self):
+        """待機時間（秒）"""
+        end = self.started_at or self.finished_at or time.monotonic()
+        return end - self.submitted_at
+
+    @property
+    def run_time(self):
+        """実行時間（秒）"""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def status_label(self):
+        return STATUS_LABELS.get(self.status, self.status)
+
+
+class JobScheduler:
+    def __init__(self, resource_limits=None, cpu_threads=None, memory_budget=None):
+        """
+        優先度付きキューとリソース別の同時実行数制限を持つジョブスケジューラ
+        Args:
+            resource_limits (dict): リソース名ごとの同時実行数
+            cpu_threads (int): 全ジョブで共有するCPUスレッド数の上限
+            memory_budget (int): 同時に実行するジョブのメモリ見込み量の合計の上限（バイト、Noneなら制限なし）
+        """
+        self.resource_limits = dict(resource_limits or DEFAULT_RESOURCE_LIMITS)
+        self.cpu_threads = cpu_threads or os.cpu_count() or 1
+        self.memory_budget = memory_budget
+        self.jobs = []
+        self._queues = {resource: [] for resource in self.resource_limits}
+        self._running = {resource: 0 for resource in self.resource_limits}
+        self._threads_in_use = 0
+        self._memory_in_use = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # torch.set_num_threadsはプロセス全体の設定のため、ジョブごとには変えない
+        # （同じプロセスで同時に動くジョブのスレッド数を上書きしてしまう）。同時に実行するジョブの
+        # スレッド数の合計の上限を一度だけ設定し、job.threadsを守る必要がある処理は子プロセスで実行する
+        try:
+            import torch
+            torch.set_num_threads(self.cpu_threads)
+        except ImportError:
+            pass
+
+    def submit(self, name, func, resource='inference', priority=0, threads=None, memory=0):
+        """
+        ジョブをキューに追加
+        Args:
+            name (str): 表示名
+            func (callable): func(job) の形で呼び出される処理
+            resource (str): 使用するリソース名
+            priority (int): 優先度（小さいほど優先）
+            threads (int): 要求するCPUスレッド数（省略時は4）
+            memory (int): ジョブが使う見込みのメモリ量（バイト）
+        Returns:
+            Job: 登録されたジョブ
+        """
+        if resource not in self.resource_limits:
+            raise ValueError(f"未知のリソースです: {resource}")
+        threads = min(threads or 4, self.cpu_threads)
+        with self._lock:
+            job = Job(next(self._ids), name, func, resource, priority, threads, memory)
+            self.jobs.append(job)
+            heapq.heappush(self._queues[resource], (priority, job.id, job))
+            self._dispatch()
+        return job
+
+    def cancel(self, job_id):
+        """ジョブをキャンセル（待機中なら即座に、実行中なら協調的に停止）"""
+        with self._lock:
+            for job in self.jobs:
+                if job.id == job_id and job.status in ('queued', 'running'):
+                    job.cancel()
+                    if job.status == 'queued':
+                        job.status = 'cancelled'
+                        job.finished_at = time.monotonic()
+                        job._finished.set()
+                    return True
+        return False
+
+    def active_jobs(self):
+        """待機中・実行中のジョブ一覧"""
+        with self._lock:
+            return [job for job in self.jobs if job.status in ('queued', 'running')]
+
+    def clear_finished(self):
+        """終了したジョブを一覧から削除"""
+        with self._lock:
+            self.jobs = [job for job in self.jobs if job.status in ('queued', 'running')]
+
+    def _dispatch(self):
+        """実行可能なジョブを開始（ロック取得済みで呼び出すこと）"""
+        for resource, queue in self._queues.items():
+            while queue and self._running[resource] < self.resource_limits[resource]:
+                _, _, job = queue[0]
+                if job.status != 'queued':
+                    # キャンセル済みのジョブを破棄
+                    heapq.heappop(queue)
+                    continue
+                if self._threads_in_use + job.threads > self.cpu_threads and self._threads_in_use > 0:
+                    break
+                # 実行中のジョブがなければメモリの上限を超えるジョブも実行する（待ち続けないように）
+                if (self.memory_budget and self._memory_in_use > 0
+                        and self._memory_in_use + job.memory > self.memory_budget):
+                    break
+                heapq.heappop(queue)
+                self._running[resource] += 1
+                self._threads_in_use += job.threads
+                self._memory_in_use += job.memory
+                job.status = 'running'
+                job.started_at = time.monotonic()
+                thread = threading.Thread(target=self._run, args=(job,), daemon=True)
+                thread.start()
+
+    def _run(self, job):
+        """ワーカースレッドでジョブを実行"""
+        try:
+            job.check_cancelled()
+            job.result = job.func(job)
+            job.status = 'completed'
+        except Exception as e:
+            if job.cancelled:
+                job.status = 'cancelled'
+            else:
+                job.status = 'failed'
+                job.error = e
+                print(f"ジョブの実行中にエラー ({job.name}): {str(e)}")
+                traceback.print_exc()
+        finally:
+            with self._lock:
+                job.finished_at = time.monotonic()
+                self._running[job.resource] -= 1
+                self._threads_in_use -= job.threads
+                self._memory_in_use -= job.memory
+                self._dispatch()
+            job._finished.set()
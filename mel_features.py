@@ -0,0 +1,247 @@
+import os
+import sys
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import whisper
+from whisper.audio import N_FFT, HOP_LENGTH, mel_filters
+
+from dataset_audio import load_dataset_audio
+
+# デバイスごとの窓関数のキャッシュ
+_WINDOWS = {}
+
+# 特徴量キャッシュの容量の上限の既定値（30秒窓1件あたり約1MB）
+DEFAULT_CACHE_BYTES = 2 * 2 ** 30
+
+
+def hann_window(device):
+    """キャッシュ済みのハン窓を取得"""
+    key = str(device)
+    if key not in _WINDOWS:
+        _WINDOWS[key] = torch.hann_window(N_FFT).to(device)
+    return _WINDOWS[key]
+
+
+def batch_log_mel_spectrogram(audios, n_mels=80, device=None, pad_or_trim=True):
+    """
+    複数の音声のログメルスペクトログラムを一括で計算
+    STFTはバッチ全体で1回実行し、その後の処理はwhisper.log_mel_spectrogramと同じ演算順序で行う。
+    Args:
+        audios (list or torch.Tensor): 波形のリスト、または (B, N) のテンソル
+        n_mels (int): メルフィルタ数
+        device (str): 計算に使うデバイス
+        pad_or_trim (bool): 各波形を30秒に揃えるかどうか
+    Returns:
+        torch.Tensor: (B, n_mels, n_frames) のログメルスペクトログラム
+    """
+    if not torch.is_tensor(audios):
+        clips = []
+        for audio in audios:
+            if not torch.is_tensor(audio):
+                audio = torch.from_numpy(np.asarray(audio, dtype=np.float32))
+            clips.append(whisper.pad_or_trim(audio) if pad_or_trim else audio)
+        if len({clip.shape[-1] for clip in clips}) > 1:
+            raise ValueError("pad_or_trim=False の場合はすべての波形の長さを揃えてください")
+        audios = torch.stack(clips)
+    elif pad_or_trim:
+        audios = whisper.pad_or_trim(audios)
+    if device is not None:
+        audios = audios.to(device)
+
+    window = hann_window(audios.device)
+    stft = torch.stft(audios, N_FFT, HOP_LENGTH, window=window, return_complex=True)
+    magnitudes = stft[..., :-1].abs() ** 2
+
+    filters = mel_filters(audios.device, n_mels)
+    # 参照実装と同じ2次元の行列積をクリップごとに適用
+    mel_spec = torch.stack([filters @ magnitude for magnitude in magnitudes])
+
+    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+    log_spec = torch.maximum(log_spec, log_spec.amax(dim=(-2, -1), keepdim=True) - 8.0)
+    log_spec = (log_spec + 4.0) / 4.0
+    return log_spec
+
+
+def verify_against_reference(audios, n_mels=80):
+    """
+    whisper.log_mel_spectrogram との一致を確認
+    Returns:
+        tuple: (完全一致したかどうか, 最大絶対誤差)
+    """
+    batch = batch_log_mel_spectrogram(audios, n_mels=n_mels)
+    max_diff = 0.0
+    identical = True
+    for audio, mel in zip(audios, batch):
+        reference = whisper.log_mel_spectrogram(whisper.pad_or_trim(np.asarray(audio, dtype=np.float32)), n_mels)
+        identical = identical and torch.equal(reference, mel)
+        max_diff = max(max_diff, (reference - mel).abs().max().item())
+    return identical, max_diff
+
+
+def feature_cache_key(audio_path, n_mels=80):
+    """音声ファイルのパス・更新時刻・サイズから特徴量キャッシュのキーを作成"""
+    stat = os.stat(audio_path)
+    source = f"{os.path.abspath(audio_path)}|{stat.st_mtime_ns}|{stat.st_size}|{n_mels}"
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def load_window_audio(pieces):
+    """
+    学習用の窓を構成する音声区間を読み込んで連結
+    Args:
+        pieces (list): (音声ファイル, 開始秒, 終了秒) のリスト
+    Returns:
+        np.ndarray: 連結した波形
+    """
+    return np.concatenate([load_dataset_audio(path, start, end) for path, start, end in pieces])
+
+
+def window_cache_key(pieces, n_mels=80):
+    """窓を構成する音声ファイルと区間から特徴量キャッシュのキーを作成"""
+    source = '|'.join(f"{feature_cache_key(path, n_mels)}:{start:.3f}-{end:.3f}" for path, start, end in pieces)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class FeatureCache:
+    def __init__(self, cache_dir, n_mels=80, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        30秒窓のログメルスペクトログラムをファイルに保存するキャッシュ
+        キーは音声ファイルのパスと更新時刻を含むため、録音し直したファイルの古い特徴量は使われなくなる。
+        合計サイズがmax_bytesを超えたら、最後に使われた時刻（ファイルの更新時刻）の古いものから削除する。
+        Args:
+            cache_dir (str): キャッシュの保存先
+            n_mels (int): メルフィルタ数
+            max_bytes (int): 容量の上限（Noneなら削除しない）
+        """
+        self.cache_dir = cache_dir
+        self.n_mels = n_mels
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _load(cache_path):
+        """特徴量を読み込み、使用した時刻として更新時刻を記録する（なければNone）"""
+        try:
+            mel = torch.from_numpy(np.load(cache_path))
+            os.utime(cache_path)
+        except FileNotFoundError:
+            # 他の学習ジョブの容量調整で削除された場合
+            return None
+        except (OSError, ValueError, EOFError) as e:
+            # 壊れたファイルはキャッシュにないものとして扱い、次回の事前計算で作り直す
+            print(f"特徴量キャッシュを読み込めないため削除します: {cache_path} ({str(e)})")
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+            return None
+        return mel
+
+    def window_path_for(self, pieces):
+        return os.path.join(self.cache_dir, window_cache_key(pieces, self.n_mels) + '.npy')
+
+    def get_window(self, pieces):
+        """複数の音声区間を連結した窓のキャッシュ済み特徴量を読み込む（なければNone）"""
+        return self._load(self.window_path_for(pieces))
+
+    def prune(self, keep=()):
+        """
+        合計サイズが上限を超えている間、最後に使われた時刻の古い特徴量から削除
+        Args:
+            keep (iterable): 削除しないキャッシュファイルのパス（実行中の学習で使うもの）
+        Returns:
+            int: 削除したファイル数
+        """
+        if self.max_bytes is None:
+            return 0
+        keep = set(keep)
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            if entry.path not in keep:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def build_windows(self, windows, batch_size=16, workers=None):
+        """
+        キャッシュされていない窓（音声区間のリスト）の特徴量を計算して保存
+        Args:
+            windows (list): 窓ごとの (音声ファイル, 開始秒, 終了秒) のリスト
+            batch_size (int): 1回のSTFTで処理する窓の数
+            workers (int): プロセス数の上限（学習ジョブのスレッド数。Noneの場合はCPUコア数、1なら同一プロセスで実行）
+        Returns:
+            int: 新たに計算した窓の数
+        """
+        todo = [pieces for pieces in windows if not os.path.exists(self.window_path_for(pieces))]
+        if todo:
+            chunks = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+            workers = min(len(chunks), workers or os.cpu_count() or 1)
+
+            if workers <= 1:
+                for chunk in chunks:
+                    _compute_window_chunk(chunk, self.cache_dir, self.n_mels, 0)
+            else:
+                # 各ワーカーはスレッド1本で動かし、プロセス数で並列化する
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(_compute_window_chunk, chunks, [self.cache_dir] * len(chunks),
+                                      [self.n_mels] * len(chunks), [1] * len(chunks)))
+        self.prune(keep=[self.window_path_for(pieces) for pieces in windows])
+        return len(todo)
+
+def _compute_window_chunk(windows, cache_dir, n_mels, num_threads):
+    """ワーカープロセスで窓の音声区間を読み込んで連結し、ログメルを一括計算して保存"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    audios = [load_window_audio(pieces) for pieces in windows]
+    mels = batch_log_mel_spectrogram(audios, n_mels=n_mels)
+    for pieces, mel in zip(windows, mels):
+        cache_path = os.path.join(cache_dir, window_cache_key(pieces, n_mels) + '.npy')
+        # 中断や並行して読み込むジョブに書き込み途中のファイルを見せないよう、一時ファイルから置き換える
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.save(f, mel.numpy())
+        os.replace(temp_path, cache_path)
+    return len(windows)
+
+
+if __name__ == "__main__":
+    # 使い方: python mel_features.py <音声ファイル...>
+    paths = sys.argv[1:]
+    if not paths:
+        print("使い方: python mel_features.py <音声ファイル...>")
+        sys.exit(1)
+    audios = [load_dataset_audio(path) for path in paths]
+
+    start_time = time.perf_counter()
+    for audio in audios:
+        whisper.log_mel_spectrogram(whisper.pad_or_trim(audio))
+    sequential_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    batch_log_mel_spectrogram(audios)
+    batch_time = time.perf_counter() - start_time
+
+    identical, max_diff = verify_against_reference(audios)
+    print(f"- 1件ずつ: {sequential_time:.3f}秒")
+    print(f"- 一括処理: {batch_time:.3f}秒")
+    print(f"- 参照実装との一致: {'完全一致' if identical else f'最大誤差 {max_diff:.2e}'}")
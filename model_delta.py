@@ -0,0 +1,325 @@
+import os
+import io
+import sys
+import time
+import zlib
+import torch
+import whisper
+from whisper.model import ModelDimensions, Whisper, AudioEncoder, TextDecoder
+
+DELTA_FORMAT = 'delta-v1'
+# 差分を省略・量子化するときに許す誤差（重みのRMSに対する比）
+DEFAULT_TOLERANCE = 1e-4
+INT8_MAX = 127
+ZLIB_LEVEL = 6
+
+
+def is_delta_checkpoint(checkpoint):
+    """標準モデルからの差分形式のチェックポイントかどうか"""
+    return isinstance(checkpoint, dict) and checkpoint.get('format') == DELTA_FORMAT
+
+
+def _as_rows(tensor):
+    # 2次元以上は先頭の次元を行とし、1次元のテンソルは全体を1行として扱う
+    return tensor.reshape(tensor.shape[0], -1) if tensor.dim() > 1 else tensor.reshape(1, -1)
+
+
+def encode_delta(delta, weight, tolerance=DEFAULT_TOLERANCE):
+    """
+    1つのテンソルの差分を符号化
+    最大絶対値が許容誤差（重みのRMS×tolerance）以下の行は省き、残りの行は行ごとのスケールでint8に量子化する。
+    int8では誤差が許容誤差を超える場合はfp16、それでも超える場合はfp32のまま保存する。
+    Args:
+        delta (Tensor): 学習後の重み - 標準モデルの重み
+        weight (Tensor): 学習後の重み（許容誤差の基準）
+    Returns:
+        dict: 符号化した差分（すべての行を省略できる場合はNone）
+    """
+    rows = _as_rows(delta.detach().float().cpu())
+    threshold = tolerance * weight.detach().float().pow(2).mean().sqrt().item()
+    row_max = rows.abs().amax(dim=1)
+    keep = row_max > threshold
+    if not keep.any():
+        return None
+    kept = rows[keep]
+    entry = {'shape': list(delta.shape), 'rows': None if keep.all() else keep.nonzero().flatten().to(torch.int32)}
+    scale = row_max[keep] / INT8_MAX
+    quantized = torch.round(kept / scale[:, None]).to(torch.int8)
+    if (quantized.float() * scale[:, None] - kept).abs().max().item() <= threshold:
+        entry.update(dtype='int8', values=quantized, scale=scale)
+    elif (kept.half().float() - kept).abs().max().item() <= threshold:
+        entry.update(dtype='float16', values=kept.half(), scale=None)
+    else:
+        entry.update(dtype='float32', values=kept, scale=None)
+    return entry
+
+
+def decode_delta(entry):
+    """encode_deltaで符号化した差分をfp32のテンソルに戻す"""
+    shape = entry['shape']
+    values = entry['values'].float()
+    if entry['dtype'] == 'int8':
+        values = values * entry['scale'][:, None]
+    if entry['rows'] is not None:
+        rows = torch.zeros(shape[0] if len(shape) > 1 else 1, values.shape[1])
+        rows[entry['rows'].long()] = values
+        values = rows
+    return values.reshape(shape)
+
+
+def delta_reference(reference, names, previous=None, models_dir=None):
+    """
+    差分の基準（標準モデル名と学習で変わるテンソル）を控える
+    標準モデルの重みは保存時にメモリマップで読むため、学習中に重みの複製は持たない。
+    namesのテンソルは保存時に標準モデルとの差分を求め直し（元のモデルが差分形式でも、その差分は
+    標準モデルに対する差分に含まれる）、それ以外で前回の差分があるテンソルはその差分をそのまま引き継ぐ。
+    どちらにもないテンソルは標準モデルと同じとみなす。
+    Args:
+        reference (str): 標準モデル名
+        names (list): 学習で変わるテンソルの名前
+        previous (dict): 元のモデルの差分（read_delta_entriesの結果）
+        models_dir (str): 標準モデルの保存先
+    Returns:
+        dict: {'reference', 'names', 'carry', 'models_dir'}
+    """
+    previous = previous or {}
+    names = list(names)
+    carry = {name: entry for name, entry in previous.items() if name not in names}
+    return {'reference': reference, 'names': names, 'carry': carry, 'models_dir': models_dir}
+
+
+def delta_checkpoint(model, reference, tolerance=DEFAULT_TOLERANCE):
+    """
+    モデルを標準モデルからの差分形式のチェックポイントにする
+    標準モデルのチェックポイントはメモリマップで読み、学習したテンソルの分だけを参照する。
+    Args:
+        model: 学習後のモデル
+        reference (dict): delta_referenceの結果
+    Returns:
+        dict: torch.saveで保存するチェックポイント
+    """
+    # inference_poolはこのモジュールを使うため、ここで読み込む
+    from inference_pool import resolve_checkpoint
+    stock = torch.load(resolve_checkpoint(reference['reference'], models_dir=reference['models_dir']),
+                       map_location="cpu", mmap=True, weights_only=False)['model_state_dict']
+    entries = dict(reference['carry'])
+    state = model.state_dict()
+    for name in reference['names']:
+        value = state[name].detach().float().cpu()
+        entry = encode_delta(value - stock[name].float(), value, tolerance)
+        if entry is None:
+            entries.pop(name, None)
+        else:
+            entries[name] = entry
+    del stock
+    stats = {'tensors': len(entries), 'total_tensors': len(state),
+             'int8': 0, 'float16': 0, 'float32': 0, 'stored_values': 0, 'total_values': 0}
+    for name, entry in entries.items():
+        stats[entry['dtype']] += 1
+        stats['stored_values'] += entry['values'].numel()
+    stats['total_values'] = sum(value.numel() for value in state.values())
+    buffer = io.BytesIO()
+    torch.save(entries, buffer)
+    return {
+        'format': DELTA_FORMAT,
+        'reference': reference['reference'],
+        'dims': model.dims,
+        'tolerance': tolerance,
+        'stats': stats,
+        # 量子化した値は偏りが大きいため、さらに可逆圧縮する
+        'entries': zlib.compress(buffer.getvalue(), ZLIB_LEVEL),
+    }
+
+
+def read_delta_entries(checkpoint):
+    """差分形式のチェックポイントからテンソルごとの差分を取り出す"""
+    return torch.load(io.BytesIO(zlib.decompress(checkpoint['entries'])), map_location="cpu", weights_only=False)
+
+
+def checkpoint_reference(model_file):
+    """
+    保存済みのモデルの基準となる標準モデルと差分
+    Returns:
+        tuple: (標準モデル名, 差分) 差分形式でなければ (None, None)
+    """
+    checkpoint = torch.load(model_file, map_location="cpu", mmap=True, weights_only=False)
+    if not is_delta_checkpoint(checkpoint):
+        return None, None
+    return checkpoint['reference'], read_delta_entries(checkpoint)
+
+
+def _meta_whisper(dims):
+    """
+    重みを確保せずにWhisperモデルを構築（Whisper.__init__と同じ構成をmetaデバイスで作る）
+    重みはload_state_dict(assign=True)ですべて置き換えるため、乱数での初期化を省く。
+    Whisper.__init__はalignment_headsをスパース化するがmetaデバイスでは使えないため、エンコーダと
+    デコーダだけを作る（alignment_headsは呼び出し側で設定する）。
+    """
+    model = Whisper.__new__(Whisper)
+    torch.nn.Module.__init__(model)
+    model.dims = dims
+    with torch.device("meta"):
+        model.encoder = AudioEncoder(dims.n_mels, dims.n_audio_ctx, dims.n_audio_state, dims.n_audio_head,
+                                     dims.n_audio_layer)
+        model.decoder = TextDecoder(dims.n_vocab, dims.n_text_ctx, dims.n_text_state, dims.n_text_head,
+                                    dims.n_text_layer)
+    return model
+
+
+def load_delta_model(checkpoint, device, models_dir=None, base_model=None):
+    """
+    差分形式のチェックポイントからモデルを復元
+    base_modelに常駐している標準モデル（checkpointの基準と同じモデル）を渡すと、差分のないテンソルはそのモデルと
+    共有し、差分のあるテンソルだけを新たに作る（共有した重みを書き換えないよう推論にだけ使う）。
+    省略時は標準モデルを読み込み、その重みに差分を加える。
+    """
+    entries = read_delta_entries(checkpoint)
+    if base_model is None:
+        model = whisper.load_model(checkpoint['reference'], download_root=models_dir, device=device)
+        state = model.state_dict()
+        with torch.no_grad():
+            for name, entry in entries.items():
+                state[name].add_(decode_delta(entry).to(state[name].device, state[name].dtype))
+        return model
+
+    dims = checkpoint['dims']
+    if isinstance(dims, dict):
+        dims = ModelDimensions(**dims)
+    state = {}
+    for name, value in base_model.state_dict().items():
+        if name in entries:
+            value = value + decode_delta(entries[name]).to(value.device, value.dtype)
+        state[name] = value
+    model = _meta_whisper(dims)
+    model.load_state_dict(state, assign=True)
+    # state_dictに含まれないバッファ（デコーダのマスク・alignment_heads）は標準モデルのものを使う
+    for name, buffer in base_model.named_buffers():
+        if name not in state:
+            module_name, _, buffer_name = name.rpartition('.')
+            model.get_submodule(module_name).register_buffer(buffer_name, buffer, persistent=False)
+    return model
+
+
+def _load_full(checkpoint, device):
+    model = Whisper(checkpoint['dims'])
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.to(device)
+
+
+def _dataset_mels(dataset_dir, n_mels, limit):
+    """評価用に、データセットのサンプル（先頭30秒）のログメルと転記テキストを読み込む"""
+    from dataset_audio import find_sample_audio, load_dataset_audio
+    from mel_features import batch_log_mel_spectrogram
+    mels, texts = [], []
+    for name in sorted(os.listdir(dataset_dir))[:limit]:
+        sample_dir = os.path.join(dataset_dir, name)
+        transcript_path = os.path.join(sample_dir, 'transcript.txt')
+        if not os.path.isdir(sample_dir) or not os.path.exists(transcript_path):
+            continue
+        audio_path = find_sample_audio(sample_dir)
+        if audio_path is None:
+            continue
+        with open(transcript_path, 'r', encoding='utf-8') as f:
+            texts.append(f.read().strip())
+        mels.append(batch_log_mel_spectrogram([load_dataset_audio(audio_path, 0, 30)], n_mels=n_mels)[0])
+    return mels, texts
+
+
+def compare_models(model_dir, reference=None, dataset_dir=None, models_dir=None, tolerance=DEFAULT_TOLERANCE,
+                   limit=20):
+    """
+    完全な形式で保存したモデルを差分形式に変換し、サイズ・読み込み時間・精度を比較
+    差分形式のファイルは model_dir/model.delta.pt に保存する（model.pt は変更しない）。
+    Args:
+        model_dir (str): ファインチューニング済みモデルのディレクトリ
+        reference (str): 基準にする標準モデル名（省略時は training_info.json の base_model）
+        dataset_dir (str): 精度の比較に使うデータセット（省略時は重みの誤差だけを比較）
+    Returns:
+        dict: 比較結果
+    """
+    from training_controller import evaluate_cer
+    model_file = os.path.join(model_dir, 'model.pt')
+    if reference is None:
+        import json
+        with open(os.path.join(model_dir, 'training_info.json'), 'r', encoding='utf-8') as f:
+            reference = json.load(f).get('base_model')
+    if reference not in whisper.available_models():
+        raise ValueError(f"基準にする標準モデルを指定してください: {reference}")
+
+    start = time.perf_counter()
+    checkpoint = torch.load(model_file, map_location="cpu", weights_only=False)
+    if is_delta_checkpoint(checkpoint):
+        raise ValueError(f"既に差分形式です: {model_file}")
+    full_model = _load_full(checkpoint, "cpu")
+    full_seconds = time.perf_counter() - start
+
+    base_model = whisper.load_model(reference, download_root=models_dir, device="cpu")
+    names = list(base_model.state_dict().keys())
+    delta_file = os.path.join(model_dir, 'model.delta.pt')
+    state = delta_checkpoint(full_model, delta_reference(reference, names, models_dir=models_dir), tolerance)
+    torch.save(state, delta_file)
+
+    start = time.perf_counter()
+    delta_model = load_delta_model(torch.load(delta_file, map_location="cpu", weights_only=False), "cpu", models_dir)
+    delta_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    load_delta_model(torch.load(delta_file, map_location="cpu", weights_only=False), "cpu", models_dir, base_model)
+    resident_seconds = time.perf_counter() - start
+
+    full_state = full_model.state_dict()
+    max_error = max((full_state[name].float() - value.float()).abs().max().item()
+                    for name, value in delta_model.state_dict().items())
+    result = {
+        'reference': reference,
+        'full_bytes': os.path.getsize(model_file),
+        'delta_bytes': os.path.getsize(delta_file),
+        'full_load_seconds': full_seconds,
+        'delta_load_seconds': delta_seconds,
+        'resident_load_seconds': resident_seconds,
+        'max_weight_error': max_error,
+        'stats': state['stats'],
+        'delta_file': delta_file,
+    }
+    if dataset_dir:
+        mels, texts = _dataset_mels(dataset_dir, full_model.dims.n_mels, limit)
+        result['samples'] = len(mels)
+        result['full_cer'] = evaluate_cer(full_model, mels, texts)
+        result['delta_cer'] = evaluate_cer(delta_model, mels, texts)
+    return result
+
+
+if __name__ == "__main__":
+    # 使い方: python model_delta.py <モデルのディレクトリ> [データセットのディレクトリ] [--reference 標準モデル名] [--replace]
+    #         --replace を指定すると model.pt を差分形式に置き換える
+    from PersonalizedSR import MODELS_DIR
+    args = sys.argv[1:]
+    reference = None
+    if "--reference" in args:
+        index = args.index("--reference")
+        reference = args[index + 1]
+        del args[index:index + 2]
+    replace = "--replace" in args
+    if replace:
+        args.remove("--replace")
+    if not args:
+        print("使い方: python model_delta.py <モデルのディレクトリ> [データセットのディレクトリ] [--reference 標準モデル名] [--replace]")
+        sys.exit(1)
+
+    result = compare_models(args[0], reference, args[1] if len(args) > 1 else None, MODELS_DIR)
+    stats = result['stats']
+    print(f"=== 差分形式の比較（基準: {result['reference']}） ===")
+    print(f"- サイズ: {result['full_bytes'] / 2 ** 20:.1f}MB → {result['delta_bytes'] / 2 ** 20:.1f}MB"
+          f"（{result['full_bytes'] / result['delta_bytes']:.1f}分の1）")
+    print(f"- 差分を保存したテンソル: {stats['tensors']} / {stats['total_tensors']}"
+          f"（int8 {stats['int8']}、fp16 {stats['float16']}、fp32 {stats['float32']}）、"
+          f"保存した値 {stats['stored_values'] / stats['total_values'] * 100:.1f}%")
+    print(f"- 読み込み時間: 完全な形式 {result['full_load_seconds']:.2f}秒、"
+          f"差分形式 {result['delta_load_seconds']:.2f}秒（標準モデルの読み込みを含む）、"
+          f"常駐する標準モデルに適用 {result['resident_load_seconds']:.2f}秒")
+    print(f"- 重みの最大誤差: {result['max_weight_error']:.2e}")
+    if 'full_cer' in result:
+        print(f"- CER（{result['samples']}件）: 完全な形式 {result['full_cer']:.4f}、差分形式 {result['delta_cer']:.4f}"
+              f"（差 {result['delta_cer'] - result['full_cer']:+.4f}）")
+    if replace:
+        os.replace(result['delta_file'], os.path.join(args[0], 'model.pt'))
+        print("model.pt を差分形式に置き換えました")
@@ -0,0 +1,544 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import hashlib
+import warnings
+import importlib.util
+import multiprocessing as mp
+import numpy as np
+import torch
+import torch.nn.functional as F
+import whisper
+import whisper.decoding
+from whisper.decoding import DecodingOptions, Inference
+
+from decoding_presets import get_preset, DEFAULT_PRESET
+
+EXPORT_FORMATS = ('torchscript', 'onnx')
+# transcribe_audioで選べる推論エンジン（'eager' はPyTorchのモデルをそのまま使い、'compiled' はtorch.compileする）
+INFERENCE_BACKENDS = ('eager', 'compiled') + EXPORT_FORMATS
+DEFAULT_BACKEND = 'eager'
+# 以前のバージョンがファインチューニング済みモデルのディレクトリ内に書き出していた場所
+LEGACY_EXPORT_SUBDIR = 'exported'
+# ファインチューニング済みモデルを書き出す場所（exported_root内、元のモデルの識別情報ごと）
+FINETUNED_EXPORT_SUBDIR = 'finetuned'
+EXPORT_INFO_FILE = 'export_info.json'
+# 2: デコーダのステップが複数トークンを因果マスク付きで受け取る（初期トークン列を1回で流し込む）
+EXPORT_VERSION = 2
+FILE_EXTENSIONS = {'torchscript': '.pt', 'onnx': '.onnx'}
+# 書き出すグラフ（エンコーダ、クロスアテンションのK/V、KVキャッシュを入出力に持つデコーダのステップ）
+GRAPHS = ('encoder', 'cross_kv', 'decoder_step')
+
+
+def _attention(q, k, v, n_head, mask=None):
+    """マルチヘッドアテンション（q: (B, n, D)、k, v: (B, T, D)、maskはTrueの位置だけを参照する）"""
+    batch, length, width = q.shape
+    q = q.view(batch, length, n_head, -1).transpose(1, 2)
+    k = k.view(batch, k.shape[1], n_head, -1).transpose(1, 2)
+    v = v.view(batch, v.shape[1], n_head, -1).transpose(1, 2)
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    return out.transpose(1, 2).reshape(batch, length, width)
+
+
+class CrossKV(torch.nn.Module):
+    """エンコーダ出力から全デコーダブロックのクロスアテンションのK/Vを計算（1回のエンコードにつき1回）"""
+
+    def __init__(self, decoder):
+        super().__init__()
+        self.blocks = decoder.blocks
+
+    def forward(self, audio_features):
+        keys = [block.cross_attn.key(audio_features) for block in self.blocks]
+        values = [block.cross_attn.value(audio_features) for block in self.blocks]
+        return torch.stack(keys), torch.stack(values)
+
+
+class DecoderStep(torch.nn.Module):
+    """
+    KVキャッシュを明示的に入出力するデコーダのステップ
+    各系列のn個のトークンを受け取り、ロジットとnトークン分伸ばしたセルフアテンションのK/Vを返す。
+    新しいトークンどうしは因果マスクで自分より前だけを参照するため、初期トークン列（プロンプトを含む）は
+    1回の呼び出しで流し込み、その後は1トークンずつ進める。
+    入力: tokens (B, n)、offset (1,)（過去のトークン数）、self_k / self_v (L, B, T, D)、cross_k / cross_v (L, B, 1500, D)
+    出力: logits (B, n, V)、self_k / self_v (L, B, T + n, D)
+    """
+
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+        self.n_head = decoder.blocks[0].attn.n_head
+
+    def forward(self, tokens, offset, self_k, self_v, cross_k, cross_v):
+        decoder = self.decoder
+        # 位置は形から求める（トレースしたグラフでトークン数と過去の長さを可変にするため、テンソルの演算で作る）
+        positions = offset + torch.ones_like(tokens[0]).cumsum(0) - 1
+        past_positions = torch.ones_like(self_k[0, 0, :, 0], dtype=torch.long).cumsum(0) - 1
+        mask = torch.cat([past_positions, positions]).unsqueeze(0) <= positions.unsqueeze(1)
+        x = decoder.token_embedding(tokens) + decoder.positional_embedding.index_select(0, positions)
+        new_keys, new_values = [], []
+        for index, block in enumerate(decoder.blocks):
+            h = block.attn_ln(x)
+            k = torch.cat([self_k[index], block.attn.key(h)], dim=1)
+            v = torch.cat([self_v[index], block.attn.value(h)], dim=1)
+            x = x + block.attn.out(_attention(block.attn.query(h), k, v, self.n_head, mask))
+            new_keys.append(k)
+            new_values.append(v)
+            h = block.cross_attn_ln(x)
+            x = x + block.cross_attn.out(_attention(block.cross_attn.query(h), cross_k[index], cross_v[index],
+                                                    self.n_head))
+            x = x + block.mlp(block.mlp_ln(x))
+        x = decoder.ln(x)
+        logits = (x @ decoder.token_embedding.weight.T).float()
+        return logits, torch.stack(new_keys), torch.stack(new_values)
+
+
+def _example_inputs(model, batch_size=2, past=3, length=2):
+    """トレース・書き出し用の入力例"""
+    dims = model.dims
+    mel = torch.zeros(1, dims.n_mels, 2 * dims.n_audio_ctx)
+    audio_features = torch.zeros(batch_size, dims.n_audio_ctx, dims.n_audio_state)
+    cache = torch.zeros(dims.n_text_layer, batch_size, past, dims.n_text_state)
+    cross = torch.zeros(dims.n_text_layer, batch_size, dims.n_audio_ctx, dims.n_text_state)
+    step = (torch.zeros(batch_size, length, dtype=torch.long), torch.tensor([past]), cache, cache.clone(), cross,
+            cross.clone())
+    return {'encoder': (mel,), 'cross_kv': (audio_features,), 'decoder_step': step}
+
+
+def _graph_modules(model):
+    return {'encoder': model.encoder, 'cross_kv': CrossKV(model.decoder), 'decoder_step': DecoderStep(model.decoder)}
+
+
+def source_signature(model_path=None, model_name=None):
+    """書き出し元のモデルの識別情報（model.ptが更新されたら書き出し直す）"""
+    if model_path:
+        model_file = os.path.join(model_path, 'model.pt')
+        return {'model_path': os.path.abspath(model_path), 'bytes': os.path.getsize(model_file),
+                'mtime': os.path.getmtime(model_file)}
+    return {'model_name': model_name}
+
+
+def export_dir_for(model_path=None, model_name=None, exported_root=None):
+    """
+    書き出したモデルの保存先（exported_root内）
+    ファインチューニング済みモデルは元のモデルの識別情報ごとのディレクトリに書き出し、モデルのディレクトリ
+    （差分形式で小さく保存している）には置かない。標準モデルはモデル名のディレクトリに書き出す。
+    """
+    if model_path:
+        digest = hashlib.sha1(json.dumps(source_signature(model_path), sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(exported_root, FINETUNED_EXPORT_SUBDIR,
+                            f"{os.path.basename(os.path.normpath(model_path))}_{digest[:12]}")
+    return os.path.join(exported_root, model_name)
+
+
+def remove_stale_exports(model_path, export_dir):
+    """
+    同じファインチューニング済みモデルの古い書き出し（model.ptが更新される前のもの）と、
+    以前のバージョンがモデルのディレクトリ内に書き出したものを削除
+    """
+    legacy_dir = os.path.join(model_path, LEGACY_EXPORT_SUBDIR)
+    if os.path.isdir(legacy_dir):
+        shutil.rmtree(legacy_dir, ignore_errors=True)
+    parent = os.path.dirname(export_dir)
+    model_path = os.path.abspath(model_path)
+    for name in os.listdir(parent):
+        other = os.path.join(parent, name)
+        if other == export_dir or not os.path.isdir(other):
+            continue
+        for info_name in os.listdir(other):
+            if not info_name.endswith(EXPORT_INFO_FILE):
+                continue
+            try:
+                with open(os.path.join(other, info_name), 'r', encoding='utf-8') as f:
+                    source = json.load(f).get('source') or {}
+            except (OSError, ValueError):
+                continue
+            if source.get('model_path') == model_path:
+                shutil.rmtree(other, ignore_errors=True)
+            break
+
+
+def export_model(model, export_dir, export_format='torchscript', source=None):
+    """
+    モデルをエンコーダ・クロスアテンションのK/V・デコーダのステップのグラフに書き出す
+    TorchScriptはトレースした後にfreezeして推論用に最適化し、ONNXは系列長・トークン数・バッチサイズを可変の軸にして書き出す。
+    Args:
+        model: Whisperモデル
+        export_dir (str): 保存先のディレクトリ
+        export_format (str): 'torchscript' または 'onnx'
+        source (dict): 書き出し元のモデルの識別情報（source_signatureの結果）
+    Returns:
+        dict: 書き出し情報（export_info.json の内容）
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"不明な書き出し形式です: {export_format}（{', '.join(EXPORT_FORMATS)}）")
+    os.makedirs(export_dir, exist_ok=True)
+    model = model.float().cpu().eval()
+    modules = _graph_modules(model)
+    examples = _example_inputs(model)
+    if export_format == 'onnx' and importlib.util.find_spec('onnx') is None:
+        raise RuntimeError("ONNX形式で書き出すにはonnxが必要です（pip install onnx）")
+    start = time.perf_counter()
+    # TorchScriptの非推奨警告と、エンコーダの入力長の確認がトレースで定数になる旨の警告は表示しない
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for name in GRAPHS:
+            path = os.path.join(export_dir, name + FILE_EXTENSIONS[export_format])
+            if export_format == 'torchscript':
+                traced = torch.jit.trace(modules[name].eval(), examples[name], check_trace=False)
+                torch.jit.save(torch.jit.optimize_for_inference(torch.jit.freeze(traced)), path)
+            else:
+                _export_onnx(modules[name], examples[name], name, path)
+    info = {
+        'version': EXPORT_VERSION,
+        'format': export_format,
+        'dims': model.dims.__dict__,
+        'is_multilingual': model.is_multilingual,
+        'num_languages': model.num_languages,
+        'source': source,
+        'export_seconds': time.perf_counter() - start,
+    }
+    with open(os.path.join(export_dir, f'{export_format}_{EXPORT_INFO_FILE}'), 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    return info
+
+
+_ONNX_IO = {
+    'encoder': (['mel'], ['audio_features'], {'mel': {0: 'batch'}, 'audio_features': {0: 'batch'}}),
+    'cross_kv': (['audio_features'], ['cross_k', 'cross_v'],
+                 {'audio_features': {0: 'batch'}, 'cross_k': {1: 'batch'}, 'cross_v': {1: 'batch'}}),
+    'decoder_step': (['tokens', 'offset', 'self_k', 'self_v', 'cross_k', 'cross_v'],
+                     ['logits', 'new_self_k', 'new_self_v'],
+                     {'tokens': {0: 'batch', 1: 'tokens'}, 'self_k': {1: 'batch', 2: 'past'},
+                      'self_v': {1: 'batch', 2: 'past'}, 'cross_k': {1: 'batch'}, 'cross_v': {1: 'batch'},
+                      'logits': {0: 'batch', 1: 'tokens'},
+                      'new_self_k': {1: 'batch', 2: 'length'}, 'new_self_v': {1: 'batch', 2: 'length'}}),
+}
+
+
+def _export_onnx(module, example, name, path):
+    input_names, output_names, dynamic_axes = _ONNX_IO[name]
+    torch.onnx.export(module.eval(), example, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=17, dynamo=False)
+
+
+class _TorchScriptGraphs:
+    def __init__(self, export_dir):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            self.graphs = {name: torch.jit.load(os.path.join(export_dir, name + FILE_EXTENSIONS['torchscript']))
+                           for name in GRAPHS}
+
+    def run(self, name, *inputs):
+        return self.graphs[name](*inputs)
+
+
+class _OnnxGraphs:
+    def __init__(self, export_dir, num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("ONNX形式のモデルを実行するにはonnxruntimeが必要です（pip install onnxruntime）")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.sessions = {
+            name: onnxruntime.InferenceSession(os.path.join(export_dir, name + FILE_EXTENSIONS['onnx']), options,
+                                               providers=['CPUExecutionProvider'])
+            for name in GRAPHS}
+
+    def run(self, name, *inputs):
+        session = self.sessions[name]
+        feeds = {arg.name: value.numpy() for arg, value in zip(session.get_inputs(), inputs)}
+        outputs = [torch.from_numpy(output) for output in session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class ExportedInference(Inference):
+    """書き出したデコーダのステップでロジットを計算するDecodingTask用の推論（KVキャッシュを自前で保持）"""
+
+    def __init__(self, model, initial_token_length):
+        self.model = model
+        self.initial_token_length = initial_token_length
+        self.cache = None
+
+    def logits(self, tokens, audio_features):
+        if self.cache is None:
+            # 最初の呼び出し: クロスアテンションのK/Vを計算し、初期トークン列（プロンプトを含む）を1回で流し込む
+            cross_k, cross_v = self.model.graphs.run('cross_kv', audio_features)
+            if cross_k.shape[1] != tokens.shape[0]:
+                # ビームサーチではトークン列だけがビーム数分に複製されているため、K/Vも揃える
+                n_group = tokens.shape[0] // cross_k.shape[1]
+                cross_k = cross_k.repeat_interleave(n_group, dim=1)
+                cross_v = cross_v.repeat_interleave(n_group, dim=1)
+            dims = self.model.dims
+            empty = torch.zeros(dims.n_text_layer, tokens.shape[0], 0, dims.n_text_state)
+            self.cache = {'self_k': empty, 'self_v': empty, 'cross_k': cross_k, 'cross_v': cross_v}
+            return self._step(tokens)
+        return self._step(tokens[:, -1:])
+
+    def _step(self, tokens):
+        cache = self.cache
+        offset = torch.tensor([cache['self_k'].shape[2]])
+        logits, cache['self_k'], cache['self_v'] = self.model.graphs.run(
+            'decoder_step', tokens, offset, cache['self_k'], cache['self_v'], cache['cross_k'], cache['cross_v'])
+        return logits
+
+    def cleanup_caching(self):
+        self.cache = None
+
+    def rearrange_kv_cache(self, source_indices):
+        # ビームサーチの並べ替えは同じ音声のビーム内に限られるため、クロスアテンションのK/Vは並べ替え不要
+        if self.cache is not None and source_indices != list(range(len(source_indices))):
+            self.cache['self_k'] = self.cache['self_k'][:, source_indices]
+            self.cache['self_v'] = self.cache['self_v'][:, source_indices]
+
+
+def decoding_task(model, options, inference_class):
+    """ロジットの計算をinference_classに置き換えたDecodingTask（繰り返し検出の差し替えも引き継ぐ）"""
+    task = whisper.decoding.DecodingTask(model, options)
+    task.inference = inference_class(model, len(task.initial_tokens))
+    if hasattr(task.decoder, 'inference'):
+        task.decoder.inference = task.inference
+    return task
+
+
+def decode_with_inference(model, mel, inference_class, options=DecodingOptions(), **kwargs):
+    """whisper.decoding.decodeと同じ処理を、ロジットの計算をinference_classに置き換えて実行"""
+    single = mel.ndim == 2
+    if single:
+        mel = mel.unsqueeze(0)
+    if kwargs:
+        from dataclasses import replace
+        options = replace(options, **kwargs)
+    with torch.no_grad():
+        result = decoding_task(model, options, inference_class).run(mel)
+    return result[0] if single else result
+
+
+class _ExportedEncoder:
+    def __init__(self, graphs):
+        self.graphs = graphs
+
+    def __call__(self, mel):
+        return self.graphs.run('encoder', mel.float())
+
+
+class _ExportedDecoder:
+    # DecodingTaskが作るPyTorchInferenceが参照する（KVキャッシュは明示的に受け渡すため、フックするブロックはない）
+    blocks = ()
+
+
+class ExportedWhisper:
+    """
+    書き出したグラフで推論するWhisperモデル（whisperのtranscribe/decodeと同じ使い方ができる）
+    デコードはwhisper.decoding.DecodingTask（繰り返し検出を有効にしている場合はその差し替え）を使い、
+    ロジットの計算だけを書き出したデコーダのステップに置き換える。
+    """
+    transcribe = whisper.transcribe
+    # 言語の判定はSOTトークンのロジット（下のlogits）から言語トークンを選ぶ
+    detect_language = whisper.decoding.detect_language
+
+    def __init__(self, export_dir, export_format='torchscript', num_threads=None):
+        with open(os.path.join(export_dir, f'{export_format}_{EXPORT_INFO_FILE}'), 'r', encoding='utf-8') as f:
+            self.info = json.load(f)
+        self.dims = whisper.model.ModelDimensions(**self.info['dims'])
+        self.is_multilingual = self.info['is_multilingual']
+        self.num_languages = self.info['num_languages']
+        self.device = torch.device('cpu')
+        self.graphs = _TorchScriptGraphs(export_dir) if export_format == 'torchscript' \
+            else _OnnxGraphs(export_dir, num_threads)
+        self.encoder = _ExportedEncoder(self.graphs)
+        self.decoder = _ExportedDecoder()
+
+    def decode(self, mel, options=DecodingOptions(), **kwargs):
+        return decode_with_inference(self, mel, ExportedInference, options, **kwargs)
+
+    def logits(self, tokens, audio_features):
+        """トークン列全体のロジット（KVキャッシュを使わず、デコーダのステップ1回で計算）"""
+        cross_k, cross_v = self.graphs.run('cross_kv', audio_features)
+        empty = torch.zeros(self.dims.n_text_layer, tokens.shape[0], 0, self.dims.n_text_state)
+        logits, _, _ = self.graphs.run('decoder_step', tokens, torch.tensor([0]), empty, empty, cross_k, cross_v)
+        return logits
+
+
+def load_exported_model(model_path=None, model_name=None, export_format='torchscript', exported_root=None,
+                        models_dir=None, num_threads=None, load_model=None, registry=None):
+    """
+    書き出したモデルを読み込む（未書き出し、または元のモデルが更新されていれば書き出してから読み込む）
+    Args:
+        model_path (str): ファインチューニング済みモデルのディレクトリ（省略時は標準モデル）
+        model_name (str): 標準モデル名
+        load_model (callable): 書き出し元のPyTorchモデルを読み込む関数（省略時は標準モデルを読み込む）
+        registry (ModelRegistry): ファインチューニング済みモデルを書き出したとき、その大きさを記録する
+                                  モデル登録簿（容量の上限に含め、モデルと一緒に削除する）
+    Returns:
+        ExportedWhisper: 書き出したモデル
+    """
+    export_dir = export_dir_for(model_path, model_name, exported_root)
+    source = source_signature(model_path, model_name)
+    info_path = os.path.join(export_dir, f'{export_format}_{EXPORT_INFO_FILE}')
+    info = None
+    if os.path.exists(info_path):
+        with open(info_path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+    if info is None or info.get('version') != EXPORT_VERSION or info.get('source') != source:
+        print(f"モデルを{export_format}形式で書き出しています: {export_dir}")
+        if load_model is not None:
+            model = load_model()
+        else:
+            model = whisper.load_model(model_name, download_root=models_dir, device="cpu")
+        info = export_model(model, export_dir, export_format, source)
+        print(f"書き出しが完了しました（{info['export_seconds']:.1f}秒）")
+        del model
+        if model_path:
+            remove_stale_exports(model_path, export_dir)
+            if registry is not None:
+                registry.record_export(model_path, export_dir)
+    return ExportedWhisper(export_dir, export_format, num_threads)
+
+
+def _measure_backend(backend, audio_files, model_path, model_name, exported_root, models_dir, num_threads, preset,
+                     results):
+    """1つの推論エンジンで全クリップを文字起こしし、読み込み時間・処理時間・ピークメモリを測定（別プロセスで実行）"""
+    from training_memory import peak_rss_bytes
+    from dataset_audio import load_dataset_audio
+    from repetition_guard import repetition_guard, DEFAULT_LOOP_POLICY
+    torch.set_num_threads(num_threads)
+    try:
+        start = time.perf_counter()
+        if backend == 'eager':
+            if model_path:
+                from PersonalizedSR import load_custom_model
+                model = load_custom_model(model_path, "cpu")
+            else:
+                model = whisper.load_model(model_name, download_root=models_dir, device="cpu")
+        else:
+            model = load_exported_model(model_path, model_name, backend, exported_root, models_dir, num_threads)
+        load_seconds = time.perf_counter() - start
+        audios = [load_dataset_audio(path) for path in audio_files]
+        # 1回目は初期化の時間を含むため、ウォームアップとして短い無音を1回処理する
+        model.transcribe(np.zeros(16000, dtype=np.float32), language="ja", fp16=False, verbose=None)
+        texts, seconds = [], []
+        for audio in audios:
+            start = time.perf_counter()
+            # transcribe_audioと同じ設定（プリセット・初期プロンプト・繰り返し検出）で測定する
+            with repetition_guard(DEFAULT_LOOP_POLICY):
+                result = model.transcribe(audio, language="ja", task="transcribe", fp16=False, verbose=None,
+                                          initial_prompt="日本語の音声を認識します。", **get_preset(preset))
+            seconds.append(time.perf_counter() - start)
+            texts.append(result['text'])
+        results.put({'load_seconds': load_seconds, 'seconds': seconds, 'texts': texts,
+                     'audio_seconds': sum(len(audio) for audio in audios) / whisper.audio.SAMPLE_RATE,
+                     'peak_rss_bytes': peak_rss_bytes()})
+    except Exception as e:
+        results.put({'error': str(e)})
+
+
+def benchmark_backends(audio_files, model_path=None, model_name='base', backends=('eager',) + EXPORT_FORMATS,
+                       exported_root=None, models_dir=None, num_threads=None, preset=DEFAULT_PRESET):
+    """
+    推論エンジンごとに同じクリップを文字起こしし、処理時間・ピークメモリ・認識結果の一致を比較
+    デコードはtranscribe_audioと同じく、presetの設定と初期プロンプトで行う。
+    最大常駐メモリはプロセス単位でしか取れないため、推論エンジンごとに別プロセスで測定する。
+    書き出していないモデルは測定の前に書き出す（書き出しの時間は読み込み時間に含めない）。
+    Returns:
+        dict: 推論エンジン → 測定結果（'eager'との文字単位の不一致率 'text_mismatch' を含む）
+    """
+    from evaluation import character_error_rate
+    num_threads = num_threads or os.cpu_count() or 1
+    context = mp.get_context('spawn')
+    report = {}
+    for backend in backends:
+        if backend in EXPORT_FORMATS:
+            try:
+                load_model = None
+                if model_path:
+                    from PersonalizedSR import load_custom_model
+                    load_model = lambda: load_custom_model(model_path, "cpu")
+                load_exported_model(model_path, model_name, backend, exported_root, models_dir, num_threads,
+                                    load_model)
+            except RuntimeError as e:
+                report[backend] = {'error': str(e)}
+                continue
+        results = context.Queue()
+        process = context.Process(target=_measure_backend, args=(
+            backend, audio_files, model_path, model_name, exported_root, models_dir, num_threads, preset, results))
+        process.start()
+        while True:
+            try:
+                report[backend] = results.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    report[backend] = {'error': f"測定プロセスが異常終了しました（終了コード {process.exitcode}）"}
+                    break
+        process.join()
+    eager = report.get('eager')
+    for backend, result in report.items():
+        if eager and 'texts' in eager and 'texts' in result:
+            mismatches = [character_error_rate(a, b) for a, b in zip(eager['texts'], result['texts'])]
+            result['text_mismatch'] = sum(mismatches) / len(mismatches) if mismatches else 0.0
+    return report
+
+
+if __name__ == "__main__":
+    # 使い方: python model_export.py --export [モデルのディレクトリ] [--format torchscript|onnx]
+    #         python model_export.py <音声ファイル...> [--model モデルのディレクトリ] [--format torchscript|onnx]
+    #                                [--preset fast|balanced|accurate]
+    from PersonalizedSR import get_runtime_config, load_custom_model, MODELS_DIR, EXPORTED_DIR, MODEL_REGISTRY_PATH
+    from model_registry import ModelRegistry
+    args = sys.argv[1:]
+    export_format = None
+    if "--format" in args:
+        index = args.index("--format")
+        export_format = args[index + 1]
+        del args[index:index + 2]
+    preset = DEFAULT_PRESET
+    if "--preset" in args:
+        index = args.index("--preset")
+        preset = args[index + 1]
+        del args[index:index + 2]
+    model_path = None
+    if "--model" in args:
+        index = args.index("--model")
+        model_path = args[index + 1]
+        del args[index:index + 2]
+    model_name = get_runtime_config()['model_name']
+
+    if "--export" in args:
+        args.remove("--export")
+        model_path = args[0] if args else model_path
+        export_dir = export_dir_for(model_path, model_name, EXPORTED_DIR)
+        model = load_custom_model(model_path, "cpu") if model_path else \
+            whisper.load_model(model_name, download_root=MODELS_DIR, device="cpu")
+        info = export_model(model, export_dir, export_format or 'torchscript',
+                            source_signature(model_path, model_name))
+        if model_path:
+            remove_stale_exports(model_path, export_dir)
+            ModelRegistry(MODEL_REGISTRY_PATH).record_export(model_path, export_dir)
+        print(f"{info['format']}形式で書き出しました: {export_dir}（{info['export_seconds']:.1f}秒）")
+        sys.exit(0)
+
+    if not args:
+        print("使い方: python model_export.py <音声ファイル...> [--model モデルのディレクトリ] [--format torchscript|onnx]"
+              " [--preset fast|balanced|accurate]")
+        sys.exit(1)
+    backends = ('eager', export_format) if export_format else ('eager',) + EXPORT_FORMATS
+    print(f"=== 推論エンジンの比較（{model_path or model_name}、{len(args)}ファイル、プリセット {preset}） ===")
+    report = benchmark_backends(args, model_path, model_name, backends, EXPORTED_DIR, MODELS_DIR, preset=preset)
+    eager = report.get('eager', {})
+    for backend, result in report.items():
+        if 'error' in result:
+            print(f"- {backend}: 測定できませんでした（{result['error']}）")
+            continue
+        total = sum(result['seconds'])
+        speedup = f"（eager比 {sum(eager['seconds']) / total:.2f}倍）" if 'seconds' in eager and backend != 'eager' else ""
+        peak = result['peak_rss_bytes']
+        print(f"- {backend}: 読み込み {result['load_seconds']:.2f}秒、処理時間 {total:.2f}秒{speedup}、"
+              f"RTF {total / result['audio_seconds']:.3f}、"
+              f"ピークメモリ {f'{peak / 2 ** 20:.0f}MB' if peak else '取得不可'}"
+              + (f"、eagerとの不一致 {result['text_mismatch'] * 100:.2f}%" if backend != 'eager' else ""))
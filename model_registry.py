@@ -0,0 +1,336 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+REGISTRY_FILE = 'model_registry.json'
+# 学習済みモデルに使うディスク容量の上限の既定値
+DEFAULT_QUOTA_BYTES = 20 * 2 ** 30
+
+_lock = threading.Lock()
+
+
+@contextmanager
+def registry_lock(registry_path):
+    """
+    登録簿の読み込み・変更・保存の間、他のスレッドと他のプロセス（一括学習の学習プロセスなど）を待たせる
+    登録簿の横に置いたロックファイルをOSのファイルロックで排他する。
+    """
+    with _lock:
+        with open(registry_path + '.lock', 'a+b') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCKは約10秒で諦めるため、取得できるまで繰り返す
+                        continue
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def directory_bytes(path):
+    """ディレクトリ内のファイルサイズの合計"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def entry_bytes(entry):
+    """モデルのディスク上のサイズ（モデルのディレクトリと、そのモデルを書き出したグラフの合計）"""
+    return entry['bytes'] + sum(entry.get('exports', {}).values())
+
+
+def snapshot_digest(snapshot):
+    """学習データの一覧のハッシュ（同じデータで学習したモデルかどうかの比較に使う）"""
+    return hashlib.sha1(json.dumps(snapshot, sort_keys=True).encode('utf-8')).hexdigest() if snapshot else None
+
+
+class ModelRegistry:
+    def __init__(self, registry_path):
+        """
+        学習済みモデルの登録簿
+        モデルごとの系譜（ベースモデル・学習データ・評価値）とユーザーごとの現在・1つ前のモデルを
+        JSONファイルに記録し、推論に使うモデルをディレクトリを走査せずに取得できるようにする。
+        Args:
+            registry_path (str): 登録簿のファイル
+        """
+        self.registry_path = registry_path
+        self.models = {}
+        self.users = {}
+        self._mtime = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.registry_path):
+            return
+        try:
+            self._mtime = os.path.getmtime(self.registry_path)
+            with open(self.registry_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"モデル登録簿の読み込みに失敗しました: {str(e)}")
+            return
+        self.models = data.get('models', {})
+        self.users = data.get('users', {})
+
+    def _save(self):
+        # 書き込み途中で中断されても登録簿が壊れないよう、一時ファイルから置き換える
+        temp_path = self.registry_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'models': self.models, 'users': self.users}, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.registry_path)
+        self._mtime = os.path.getmtime(self.registry_path)
+
+    def _refresh(self):
+        """他のプロセス・インスタンスが登録簿を更新していれば読み直す"""
+        if os.path.exists(self.registry_path) and os.path.getmtime(self.registry_path) != self._mtime:
+            self._load()
+
+    @staticmethod
+    def model_id(model_dir, user=None):
+        return f"{user or '_shared'}/{os.path.basename(os.path.normpath(model_dir))}"
+
+    def register(self, model_dir, user=None, activate=True):
+        """
+        学習済みモデルを登録（training_info.json から系譜と評価値を読み取る）
+        Args:
+            model_dir (str): モデルのディレクトリ
+            user (str): ユーザー名（共有のモデルはNone）
+            activate (bool): ユーザーの現在のモデルにする（それまでのモデルは1つ前のモデルになる）
+        Returns:
+            str: モデルID
+        """
+        with open(os.path.join(model_dir, 'training_info.json'), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        model_id = self.model_id(model_dir, user)
+        base_model = info.get('base_model')
+        now = time.time()
+        with registry_lock(self.registry_path):
+            self._load()
+            # 登録し直すモデルは保存し直されているため、以前の書き出しは使えない
+            for export_dir in self.models.get(model_id, {}).get('exports', {}):
+                shutil.rmtree(export_dir, ignore_errors=True)
+            parent = None
+            if base_model and os.path.isdir(base_model):
+                parent = next((key for key, entry in self.models.items()
+                               if os.path.normpath(entry['path']) == os.path.normpath(base_model)), None)
+            self.models[model_id] = {
+                'path': os.path.abspath(model_dir),
+                'user': user,
+                'base_model': base_model,
+                'parent': parent,
+                'created': info.get('timestamp'),
+                'data_samples': len(info.get('data_snapshot') or {}),
+                'data_digest': snapshot_digest(info.get('data_snapshot')),
+                'metrics': {'best_cer': info.get('best_cer'), 'final_loss': info.get('final_loss')},
+                'bytes': directory_bytes(model_dir),
+                # モデルを推論用に書き出したグラフのディレクトリ → サイズ（record_exportで記録）
+                'exports': {},
+                'registered_at': now,
+                'last_used': now,
+            }
+            if user and activate:
+                state = self.users.setdefault(user, {'active': None, 'previous': None})
+                if state['active'] != model_id:
+                    state['previous'], state['active'] = state['active'], model_id
+            self._save()
+        return model_id
+
+    def record_export(self, model_dir, export_dir):
+        """
+        モデルを書き出したグラフのサイズを記録（容量の上限に含め、モデルを削除するときに一緒に削除する）
+        モデルのディレクトリのサイズも測り直し、既に削除された以前の書き出しは記録から外す。
+        Returns:
+            bool: 記録した場合True（登録されていないモデルならFalse）
+        """
+        path = os.path.normpath(os.path.abspath(model_dir))
+        with registry_lock(self.registry_path):
+            self._load()
+            entry = next((entry for entry in self.models.values() if os.path.normpath(entry['path']) == path), None)
+            if entry is None:
+                return False
+            exports = {other: size for other, size in entry.get('exports', {}).items() if os.path.isdir(other)}
+            exports[os.path.abspath(export_dir)] = directory_bytes(export_dir)
+            entry['exports'] = exports
+            entry['bytes'] = directory_bytes(path)
+            self._save()
+        return True
+
+    def active_model(self, user):
+        """ユーザーの現在のモデルのディレクトリ（なければNone）"""
+        self._refresh()
+        model_id = self.users.get(user, {}).get('active')
+        entry = self.models.get(model_id)
+        if entry is None or not os.path.isdir(entry['path']):
+            return None
+        return entry['path']
+
+    def touch(self, model_dir, user=None):
+        """モデルを使用した時刻を記録（容量超過時に使われていないモデルから削除する）"""
+        model_id = self.model_id(model_dir, user)
+        with registry_lock(self.registry_path):
+            self._load()
+            if model_id in self.models:
+                self.models[model_id]['last_used'] = time.time()
+                self._save()
+
+    def rollback(self, user):
+        """
+        ユーザーの現在のモデルを1つ前のモデルに戻す
+        Returns:
+            str: 戻した後のモデルのディレクトリ（1つ前のモデルがなければNone）
+        """
+        with registry_lock(self.registry_path):
+            self._load()
+            state = self.users.get(user)
+            if not state or not state.get('previous') or state['previous'] not in self.models:
+                return None
+            state['active'], state['previous'] = state['previous'], state['active']
+            self._save()
+            return self.models[state['active']]['path']
+
+    def lineage(self, model_id):
+        """モデルの系譜（自分から順に親をたどったモデルIDのリスト）"""
+        chain = []
+        while model_id in self.models and model_id not in chain:
+            chain.append(model_id)
+            model_id = self.models[model_id]['parent']
+        return chain
+
+    def protected(self):
+        """削除しないモデル（各ユーザーの現在・1つ前のモデルと、検証CERが最良のモデル）"""
+        keep = set()
+        for state in self.users.values():
+            keep.update(model_id for model_id in (state.get('active'), state.get('previous')) if model_id)
+        best = {}
+        for model_id, entry in self.models.items():
+            cer = entry['metrics'].get('best_cer')
+            if cer is None:
+                continue
+            owner = entry['user']
+            if owner not in best or cer < self.models[best[owner]]['metrics']['best_cer']:
+                best[owner] = model_id
+        keep.update(best.values())
+        return keep
+
+    def enforce_quota(self, quota_bytes=DEFAULT_QUOTA_BYTES):
+        """
+        合計サイズが上限を超えている間、保護されていないモデルを最後に使われた時刻の古い順に削除
+        Returns:
+            list: 削除したモデルID
+        """
+        evicted = []
+        with registry_lock(self.registry_path):
+            self._load()
+            # ディスクから消えたモデルは登録簿からも外す（書き出したグラフも削除する）
+            for model_id in [key for key, entry in self.models.items() if not os.path.isdir(entry['path'])]:
+                for export_dir in self.models.pop(model_id).get('exports', {}):
+                    shutil.rmtree(export_dir, ignore_errors=True)
+            total = sum(entry_bytes(entry) for entry in self.models.values())
+            keep = self.protected()
+            candidates = sorted((entry['last_used'], model_id) for model_id, entry in self.models.items()
+                                if model_id not in keep)
+            for _, model_id in candidates:
+                if total <= quota_bytes:
+                    break
+                entry = self.models[model_id]
+                size = entry_bytes(entry)
+                for path in list(entry.get('exports', {})) + [entry['path']]:
+                    shutil.rmtree(path, ignore_errors=True)
+                entry['exports'] = {path: directory_bytes(path) for path in entry.get('exports', {})
+                                    if os.path.exists(path)}
+                if os.path.exists(entry['path']):
+                    # Windowsではメモリマップ中のファイルを削除できない（使用中のモデルは残して次回に回す）
+                    entry['bytes'] = directory_bytes(entry['path'])
+                    total -= size - entry_bytes(entry)
+                    print(f"モデルを削除できませんでした（使用中の可能性があります）: {entry['path']}")
+                    continue
+                del self.models[model_id]
+                total -= size - sum(entry['exports'].values())
+                evicted.append(model_id)
+            for other in self.models.values():
+                if other['parent'] in evicted:
+                    other['parent'] = None
+            self._save()
+        return evicted
+
+    def total_bytes(self):
+        return sum(entry_bytes(entry) for entry in self.models.values())
+
+    def scan(self, users_dir, finetuned_dir=None):
+        """
+        既存のモデルディレクトリを走査して未登録のモデルを登録（登録簿を導入する前のモデルの取り込み）
+        各ユーザーの現在のモデルが未設定なら、最も新しいモデルを現在のモデルにする。
+        Returns:
+            int: 新たに登録したモデル数
+        """
+        added = 0
+        locations = []
+        if os.path.isdir(users_dir):
+            locations += [(name, os.path.join(users_dir, name, 'models')) for name in sorted(os.listdir(users_dir))]
+        if finetuned_dir:
+            locations.append((None, finetuned_dir))
+        for user, models_dir in locations:
+            if not os.path.isdir(models_dir):
+                continue
+            for name in sorted(os.listdir(models_dir)):
+                model_dir = os.path.join(models_dir, name)
+                if (self.model_id(model_dir, user) in self.models
+                        or not os.path.exists(os.path.join(model_dir, 'training_info.json'))):
+                    continue
+                with open(os.path.join(model_dir, 'training_info.json'), 'r', encoding='utf-8') as f:
+                    if not json.load(f).get('training_completed'):
+                        continue
+                activate = bool(user) and not self.users.get(user, {}).get('active')
+                self.register(model_dir, user, activate=activate)
+                added += 1
+        return added
+
+
+if __name__ == "__main__":
+    # 使い方: python model_registry.py [--scan] [--gc 上限GB] [--rollback ユーザー名]
+    from PersonalizedSR import MODEL_REGISTRY_PATH, DATASET_DIR, FINETUNED_DIR
+    registry = ModelRegistry(MODEL_REGISTRY_PATH)
+    args = sys.argv[1:]
+    if "--scan" in args:
+        print(f"{registry.scan(os.path.join(DATASET_DIR, 'users'), FINETUNED_DIR)}件のモデルを登録しました")
+    if "--rollback" in args:
+        user = args[args.index("--rollback") + 1]
+        path = registry.rollback(user)
+        print(f"{user} のモデルを戻しました: {path}" if path else f"{user} には1つ前のモデルがありません")
+    if "--gc" in args:
+        quota = int(float(args[args.index("--gc") + 1]) * 2 ** 30)
+        evicted = registry.enforce_quota(quota)
+        print(f"{len(evicted)}件のモデルを削除しました" + "".join(f"\n- {model_id}" for model_id in evicted))
+
+    print(f"=== 登録済みモデル（合計 {registry.total_bytes() / 2 ** 30:.2f}GB） ===")
+    for user, state in sorted(registry.users.items()):
+        print(f"- {user}: 現在 {state['active']}、1つ前 {state['previous']}")
+    for model_id, entry in sorted(registry.models.items()):
+        cer = entry['metrics'].get('best_cer')
+        print(f"  {model_id}: {entry_bytes(entry) / 2 ** 20:.0f}MB、CER {cer if cer is not None else '-'}、"
+              f"系譜 {' ← '.join(registry.lineage(model_id))}")
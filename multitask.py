@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import torch
+import whisper
+from whisper.audio import N_FRAMES, HOP_LENGTH, SAMPLE_RATE
+from whisper.tokenizer import get_tokenizer
+
+from dataset_audio import load_dataset_audio
+from mel_features import batch_log_mel_spectrogram
+
+WINDOW_SECONDS = N_FRAMES * HOP_LENGTH / SAMPLE_RATE
+TIME_PRECISION = 0.02
+
+# 既定の出力: 日本語の文字起こしと英語翻訳
+DEFAULT_TARGETS = [
+    {'name': 'ja', 'task': 'transcribe', 'language': 'ja'},
+    {'name': 'en', 'task': 'translate', 'language': 'ja'},
+]
+
+
+def format_timestamp(seconds, separator=','):
+    """字幕用のタイムスタンプ（HH:MM:SS,mmm）"""
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+
+class SubtitleWriter:
+    def __init__(self, path, subtitle_format='srt'):
+        """
+        セグメントが確定するたびに追記していく字幕ファイル
+        Args:
+            path (str): 出力ファイルのパス
+            subtitle_format (str): 'srt' または 'vtt'
+        """
+        if subtitle_format not in ('srt', 'vtt'):
+            raise ValueError(f"未対応の字幕形式です: {subtitle_format}")
+        self.path = path
+        self.format = subtitle_format
+        self.index = 0
+        self._file = open(path, 'w', encoding='utf-8')
+        if subtitle_format == 'vtt':
+            self._file.write("WEBVTT\n\n")
+        self._file.flush()
+
+    def write_segment(self, segment):
+        """セグメントを1件書き込み、すぐにディスクへ反映"""
+        text = segment['text'].strip()
+        if not text:
+            return
+        self.index += 1
+        separator = ',' if self.format == 'srt' else '.'
+        start = format_timestamp(segment['start'], separator)
+        end = format_timestamp(segment['end'], separator)
+        if self.format == 'srt':
+            self._file.write(f"{self.index}\n")
+        self._file.write(f"{start} --> {end}\n{text}\n\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def parse_segments(tokenizer, tokens, time_offset, window_duration):
+    """
+    タイムスタンプトークンを含むデコード結果をセグメントに分割
+    Args:
+        tokenizer: Whisperのトークナイザ
+        tokens (list): デコードされたトークン列
+        time_offset (float): 窓の開始時刻（秒）
+        window_duration (float): 窓の長さ（秒）
+    Returns:
+        tuple: ({'start', 'end', 'text'} のリスト, 確定した位置（窓の先頭からの秒）)
+               終了タイムスタンプのない末尾は窓の境界で途切れている可能性があるため、
+               whisper.transcribeと同様に最後のタイムスタンプまでを確定とし、残りは次の窓で読み直す。
+    """
+    segments = []
+    start = None
+    last_end = 0.0
+    text_tokens = []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            timestamp = (token - tokenizer.timestamp_begin) * TIME_PRECISION
+            if text_tokens:
+                # 開始タイムスタンプがない場合は直前のセグメントの終わりから始まる
+                segments.append({
+                    'start': time_offset + (start if start is not None else last_end),
+                    'end': time_offset + timestamp,
+                    'text': tokenizer.decode(text_tokens),
+                })
+                text_tokens = []
+                start = None
+                last_end = timestamp
+            else:
+                start = timestamp
+        elif token < tokenizer.eot:
+            text_tokens.append(token)
+    if segments and (text_tokens or start is not None):
+        # 途中で終わったセグメント（または開始タイムスタンプだけ）は次の窓で読み直す
+        return segments, (start if not text_tokens and start is not None else last_end)
+    if text_tokens:
+        # タイムスタンプがまったくない場合は窓の終わりまでとする
+        segments.append({
+            'start': time_offset + (start if start is not None else last_end),
+            'end': time_offset + window_duration,
+            'text': tokenizer.decode(text_tokens),
+        })
+    return segments, window_duration
+
+
+def transcribe_multitask(model, audio, targets=None, subtitle_dir=None, subtitle_formats=('srt', 'vtt'),
+                         segment_callback=None, initial_prompt="日本語の音声を認識します。"):
+    """
+    30秒窓ごとにエンコーダを1回だけ実行し、同じ音声特徴量から複数のタスク・言語をデコード
+    次の窓は、各ターゲットの最後の完結したタイムスタンプのうち最も手前の位置から始める。
+    Args:
+        model: Whisperモデル
+        audio (str or np.ndarray): 音声ファイルのパス、または16kHzの波形
+        targets (list): {'name', 'task', 'language'} のリスト
+        subtitle_dir (str): 字幕の出力先（Noneなら字幕を出力しない）
+        subtitle_formats (tuple): 出力する字幕形式
+        segment_callback (callable): segment_callback(target_name, segment) の形で確定したセグメントを通知
+        initial_prompt (str): 文字起こしタスクに渡すプロンプト
+    Returns:
+        dict: {'outputs': {name: {'text', 'segments'}}, 'stats': {...}, 'subtitles': [...]}
+    """
+    targets = targets or DEFAULT_TARGETS
+    if isinstance(audio, str):
+        base_name = os.path.splitext(os.path.basename(audio))[0]
+        audio = load_dataset_audio(audio)
+    else:
+        base_name = 'audio'
+    duration = len(audio) / SAMPLE_RATE
+
+    outputs = {target['name']: {'text': '', 'segments': []} for target in targets}
+    writers = {}
+    if subtitle_dir:
+        os.makedirs(subtitle_dir, exist_ok=True)
+        for target in targets:
+            writers[target['name']] = [
+                SubtitleWriter(os.path.join(subtitle_dir, f"{base_name}.{target['name']}.{subtitle_format}"),
+                               subtitle_format)
+                for subtitle_format in subtitle_formats
+            ]
+
+    decode_options = {}
+    for target in targets:
+        tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                                  language=target['language'], task=target['task'])
+        options = whisper.DecodingOptions(
+            task=target['task'],
+            language=target['language'],
+            fp16=False,
+            without_timestamps=False,
+            prompt=initial_prompt if target['task'] == 'transcribe' else None,
+        )
+        decode_options[target['name']] = (tokenizer, options)
+
+    stats = {'encoder_passes': 0, 'decoder_passes': 0, 'encoder_seconds': 0.0, 'decoder_seconds': 0.0}
+    window_samples = int(WINDOW_SECONDS * SAMPLE_RATE)
+    # ターゲットごとに出力済みの位置（秒）
+    done = {target['name']: 0.0 for target in targets}
+    window_start = 0
+    try:
+        while window_start < max(len(audio), 1):
+            window = audio[window_start:window_start + window_samples]
+            time_offset = window_start / SAMPLE_RATE
+            window_duration = len(window) / SAMPLE_RATE
+            consumed = window_duration
+
+            mel = batch_log_mel_spectrogram([window], n_mels=model.dims.n_mels).to(model.device)
+            start_time = time.perf_counter()
+            with torch.no_grad():
+                audio_features = model.encoder(mel)
+            stats['encoder_seconds'] += time.perf_counter() - start_time
+            stats['encoder_passes'] += 1
+
+            for target in targets:
+                tokenizer, options = decode_options[target['name']]
+                start_time = time.perf_counter()
+                # エンコーダ出力を渡すため、decode内で再エンコードされない
+                result = model.decode(audio_features, options)[0]
+                stats['decoder_seconds'] += time.perf_counter() - start_time
+                stats['decoder_passes'] += 1
+
+                segments, target_consumed = parse_segments(tokenizer, result.tokens, time_offset, window_duration)
+                if target_consumed > 0:
+                    consumed = min(consumed, target_consumed)
+                for segment in segments:
+                    # 他のターゲットに合わせて読み直した区間のうち、出力済みのセグメントは除く
+                    if (segment['start'] + segment['end']) / 2 < done[target['name']]:
+                        continue
+                    done[target['name']] = segment['end']
+                    segment['end'] = min(segment['end'], duration)
+                    outputs[target['name']]['segments'].append(segment)
+                    for writer in writers.get(target['name'], []):
+                        writer.write_segment(segment)
+                    if segment_callback:
+                        segment_callback(target['name'], segment)
+
+            # エンコーダ出力を共有するため、最も手前で途切れたターゲットの確定位置まで進める
+            window_start += max(1, int(round(consumed * SAMPLE_RATE)))
+    finally:
+        for target_writers in writers.values():
+            for writer in target_writers:
+                writer.close()
+
+    for output in outputs.values():
+        output['text'] = ''.join(segment['text'] for segment in output['segments'])
+    return {
+        'outputs': outputs,
+        'stats': stats,
+        'subtitles': [writer.path for target_writers in writers.values() for writer in target_writers],
+    }
+
+
+if __name__ == "__main__":
+    # 使い方: python multitask.py <音声ファイル> [字幕の出力先]
+    from PersonalizedSR import get_runtime_config, MODELS_DIR, TRANSCRIPTS_DIR
+
+    if len(sys.argv) < 2:
+        print("使い方: python multitask.py <音声ファイル> [字幕の出力先]")
+        sys.exit(1)
+    model = whisper.load_model(get_runtime_config()['model_name'], download_root=MODELS_DIR)
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else TRANSCRIPTS_DIR
+    result = transcribe_multitask(
+        model, sys.argv[1], subtitle_dir=output_dir,
+        segment_callback=lambda name, segment: print(
+            f"[{name}] [{segment['start']:.2f}s -> {segment['end']:.2f}s] {segment['text']}")
+    )
+    stats = result['stats']
+    print(f"\nエンコーダ: {stats['encoder_passes']}回 ({stats['encoder_seconds']:.2f}秒)")
+    print(f"デコーダ: {stats['decoder_passes']}回 ({stats['decoder_seconds']:.2f}秒)")
+    for path in result['subtitles']:
+        print(f"字幕を保存しました: {path}")
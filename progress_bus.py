@@ -0,0 +1,114 @@
+import queue
+import threading
+import traceback
+
+# UIの更新間隔（ミリ秒）
+DEFAULT_REFRESH_MS = 100
+
+
+class ProgressBus:
+    def __init__(self, refresh_ms=DEFAULT_REFRESH_MS):
+        """
+        ワーカースレッドからTkメインループへのイベントバス
+        進捗はチャンネルごとに最新値だけを保持し、ログ・途中結果・状態の変化はキューで順番に渡す。
+        Args:
+            refresh_ms (int): Tk側でイベントを処理する間隔（ミリ秒）
+        """
+        self.refresh_ms = refresh_ms
+        self._latest_progress = {}
+        self._progress_lock = threading.Lock()
+        self._events = queue.SimpleQueue()
+        self._handlers = {'progress': [], 'log': [], 'partial': [], 'model_saved': [], 'dataset_changed': [],
+                          'error': []}
+        self._root = None
+
+    def subscribe(self, kind, handler):
+        """
+        イベントハンドラを登録（Tkのメインスレッドで呼び出される）
+        Args:
+            kind (str): 'progress' / 'log' / 'partial' / 'model_saved' / 'dataset_changed' / 'error'
+            handler (callable): progress: handler(channel, value, status)
+                                log: handler(channel, text)
+                                partial: handler(channel, text, final)
+                                model_saved: handler(channel, model_path)
+                                dataset_changed: handler(channel)
+                                error: handler(channel, message)
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"未知のイベント種別です: {kind}")
+        self._handlers[kind].append(handler)
+
+    def progress(self, channel, value, status):
+        """進捗を通知（どのスレッドからでも呼び出し可能）"""
+        with self._progress_lock:
+            self._latest_progress[channel] = (value, status)
+
+    def log(self, channel, message):
+        """ログメッセージを通知"""
+        self._events.put(('log', channel, (message,)))
+
+    def partial(self, channel, text, final=False):
+        """
+        途中結果を通知
+        Args:
+            text (str): 確定したセグメントのテキスト（final=Trueなら全体の結果）
+            final (bool): 全体の結果（それまでの途中結果を置き換える）
+        """
+        self._events.put(('partial', channel, (text, final)))
+
+    def model_saved(self, channel, model_path):
+        """学習したモデルの保存を通知"""
+        self._events.put(('model_saved', channel, (model_path,)))
+
+    def dataset_changed(self, channel):
+        """学習データの追加を通知"""
+        self._events.put(('dataset_changed', channel, ()))
+
+    def error(self, channel, message):
+        """
+        エラーを通知（Tk側でダイアログを表示する）
+        Args:
+            message (str): 表示するメッセージ（例外オブジェクトではなく整形済みの文字列を渡す）
+        """
+        self._events.put(('error', channel, (message,)))
+
+    def callback(self, channel):
+        """transcribe_audio / fine_tune_model に渡すprogress_callbackを作成"""
+        def progress_callback(value, status):
+            self.progress(channel, value, status)
+        return progress_callback
+
+    def start(self, root):
+        """Tkのメインループでイベントの定期処理を開始"""
+        self._root = root
+        self._root.after(self.refresh_ms, self._drain)
+
+    def _drain(self):
+        """溜まったイベントをまとめて処理"""
+        with self._progress_lock:
+            latest, self._latest_progress = self._latest_progress, {}
+
+        try:
+            for channel, (value, status) in latest.items():
+                for handler in self._handlers['progress']:
+                    self._call(handler, channel, value, status)
+
+            # 1回の処理で扱うイベント数を制限してUIの停止を防ぐ
+            for _ in range(1000):
+                try:
+                    kind, channel, args = self._events.get_nowait()
+                except queue.Empty:
+                    break
+                for handler in self._handlers[kind]:
+                    self._call(handler, channel, *args)
+        finally:
+            # ハンドラで例外が起きてもイベントの定期処理を止めない
+            self._root.after(self.refresh_ms, self._drain)
+
+    @staticmethod
+    def _call(handler, *args):
+        try:
+            handler(*args)
+        except Exception as e:
+            print(f"イベントハンドラでエラーが発生しました: {str(e)}")
+            traceback.print_exc()
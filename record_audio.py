@@ -2,6 +2,7 @@ import sounddevice as sd
 import numpy as np
 import wave
 import os
+import threading
 from datetime import datetime
 
 class AudioRecorder:
@@ -63,10 +64,210 @@ class AudioRecorder:
         print(f"録音を保存しました: {filename}")
         return filename
 
+class RingBuffer:
+    def __init__(self, capacity, channels, dtype=np.int16):
+        """
+        単一の書き込み側と単一の読み出し側で使うロックフリーのリングバッファ
+        書き込み位置は書き込み側だけが、読み出し位置は読み出し側だけが更新する。
+        Args:
+            capacity (int): 保持できるフレーム数
+            channels (int): チャンネル数
+        """
+        self.capacity = capacity
+        self.buffer = np.zeros((capacity, channels), dtype=dtype)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.dropped_frames = 0
+
+    def available(self):
+        """読み出し可能なフレーム数"""
+        return self.write_pos - self.read_pos
+
+    def write(self, frames):
+        """フレームを書き込む（空きが足りない分は破棄して数える）"""
+        space = self.capacity - (self.write_pos - self.read_pos)
+        n = min(len(frames), space)
+        if n < len(frames):
+            self.dropped_frames += len(frames) - n
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = frames[:first]
+        self.buffer[:n - first] = frames[first:n]
+        self.write_pos += n
+
+    def read(self):
+        """読み出し可能なフレームをすべて取り出す"""
+        n = self.available()
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        data = np.concatenate([self.buffer[start:start + first], self.buffer[:n - first]])
+        self.read_pos += n
+        return data
+
+class StreamingRecorder:
+    def __init__(self, sample_rate=16000, channels=1, buffer_seconds=10, compression=None):
+        """
+        入力ストリームのコールバックで受け取った音声を逐次ファイルに書き出す録音クラス
+        録音時間を事前に決める必要がなく、メモリ使用量は録音の長さに依存しない。
+        Args:
+            sample_rate (int): サンプリングレート（デフォルト: 16000 Hz）
+            channels (int): チャンネル数（デフォルト: 1 - モノラル）
+            buffer_seconds (float): リングバッファの長さ（秒）
+            compression (str): None ならWAV、'flac' ならFLACで保存
+        """
+        if compression not in (None, 'flac'):
+            raise ValueError(f"未対応の圧縮形式です: {compression}")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.buffer_seconds = buffer_seconds
+        self.compression = compression
+        self.filename = None
+        self.is_recording = False
+        self.frames_written = 0
+        # 入力ストリームが報告した入力オーバーフローの回数と最後の状態
+        self.input_overflows = 0
+        self.last_status = None
+        self._ring = None
+        self._stream = None
+        self._writer = None
+        # 書き込みスレッドで起きた例外（stopで送出する）
+        self._write_error = None
+        self._stop_event = threading.Event()
+
+    def _callback(self, indata, frames, time_info, status):
+        """オーディオスレッドから呼ばれるコールバック（バッファへのコピーのみ行う）"""
+        if status:
+            # 表示はオーディオスレッドの外（stop）で行う
+            self.last_status = str(status)
+            if status.input_overflow:
+                self.input_overflows += 1
+        self._ring.write(indata)
+
+    def _write_loop(self, sound_file):
+        """書き込みスレッド: バッファに溜まったフレームをファイルに書き出す"""
+        try:
+            while not self._stop_event.wait(0.1) or self._ring.available():
+                if self._ring.available():
+                    data = self._ring.read()
+                    sound_file.write(data)
+                    self.frames_written += len(data)
+        except Exception as e:
+            # ディスクの空き不足などで書き込めなくなった場合は、録音を止めたときに呼び出し側へ伝える
+            self._write_error = e
+        finally:
+            try:
+                sound_file.close()
+            except Exception as e:
+                if self._write_error is None:
+                    self._write_error = e
+
+    def start(self, output_dir="recordings"):
+        """
+        録音を開始
+        Args:
+            output_dir (str): 保存先ディレクトリ
+        Returns:
+            str: 書き込み先ファイルのパス
+        """
+        import soundfile as sf
+
+        if self.is_recording:
+            raise RuntimeError("既に録音中です")
+
+        os.makedirs(output_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        extension = 'flac' if self.compression == 'flac' else 'wav'
+        self.filename = os.path.join(output_dir, f"recording_{timestamp}.{extension}")
+
+        sound_file = sf.SoundFile(
+            self.filename, mode='w',
+            samplerate=self.sample_rate,
+            channels=self.channels,
+            format=extension.upper(),
+            subtype='PCM_16'
+        )
+        self._ring = RingBuffer(int(self.buffer_seconds * self.sample_rate), self.channels)
+        self.frames_written = 0
+        self.input_overflows = 0
+        self.last_status = None
+        self._write_error = None
+        self._stop_event.clear()
+        self._writer = threading.Thread(target=self._write_loop, args=(sound_file,), daemon=True)
+        self._writer.start()
+
+        self._stream = None
+        try:
+            self._stream = sd.InputStream(
+                samplerate=self.sample_rate,
+                channels=self.channels,
+                dtype=np.int16,
+                callback=self._callback
+            )
+            self._stream.start()
+        except Exception:
+            # 書き込みスレッドを止めてファイルを閉じ、空のファイルを残さない
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+            self._stop_event.set()
+            self._writer.join()
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            raise
+        self.is_recording = True
+        print(f"録音を開始しました: {self.filename}")
+        return self.filename
+
+    def stop(self):
+        """
+        録音を停止し、残りのデータを書き出してファイルを閉じる
+        書き込みスレッドでファイルへの書き込みに失敗していた場合は、その例外を送出する。
+        Returns:
+            str: 保存したファイルのパス
+        """
+        if not self.is_recording:
+            raise ValueError("録音中ではありません")
+
+        self._stream.stop()
+        self._stream.close()
+        self._stop_event.set()
+        self._writer.join()
+        self.is_recording = False
+        if self._write_error is not None:
+            print(f"録音の書き込みに失敗しました: {self.filename} ({str(self._write_error)})")
+            raise self._write_error
+
+        duration = self.frames_written / self.sample_rate
+        print(f"録音を保存しました: {self.filename} ({duration:.1f}秒)")
+        if self._ring.dropped_frames:
+            print(f"警告: バッファ溢れにより {self._ring.dropped_frames} フレームが失われました")
+        if self.input_overflows:
+            print(f"警告: 入力オーバーフローが {self.input_overflows} 回発生しました（{self.last_status}）")
+        elif self.last_status:
+            print(f"警告: 入力ストリームの状態: {self.last_status}")
+        return self.filename
+
 def main():
     """
     テスト用のメイン関数
     """
+    import sys
+    
+    if "--stream" in sys.argv:
+        # Enterキーを押すまで録音し続けるモード
+        recorder = StreamingRecorder(compression='flac' if "--flac" in sys.argv else None)
+        try:
+            recorder.start()
+            input("Enterキーで録音を停止します...")
+        except KeyboardInterrupt:
+            print("\n録音を中断しました")
+        except Exception as e:
+            print(f"エラーが発生しました: {str(e)}")
+        finally:
+            if recorder.is_recording:
+                recorder.stop()
+        return
+    
     recorder = AudioRecorder()
     
     try:
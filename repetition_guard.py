@@ -0,0 +1,294 @@
+import sys
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+from dataclasses import replace
+import whisper.decoding
+from whisper.decoding import DecodingTask, LogitFilter, compression_ratio
+
+# 繰り返しと判定する条件: 同じn-gramがmin_repeats回以上、かつ合計min_spanトークン以上続く
+MAX_NGRAM = 16
+MIN_REPEATS = 3
+MIN_SPAN = 16
+
+# 'fallback' で温度フォールバックを発生させるための圧縮率（Whisperの既定の閾値2.4より大きい値）
+LOOP_COMPRESSION_RATIO = 10.0
+
+LOOP_POLICIES = ('skip', 'fallback')
+DEFAULT_LOOP_POLICY = 'fallback'
+
+# スレッドごとの設定（transcribeを実行しているスレッドでのみ有効にする）
+_local = threading.local()
+_install_lock = threading.Lock()
+
+
+def find_loop(tokens, max_ngram=MAX_NGRAM, min_repeats=MIN_REPEATS, min_span=MIN_SPAN):
+    """
+    トークン列の末尾が同じn-gramの繰り返しになっているかを判定
+    Args:
+        tokens (list): テキストトークン列（タイムスタンプを除く）
+    Returns:
+        tuple: 繰り返しがあれば (n-gramの長さ, 繰り返し回数)、なければNone
+    """
+    length = len(tokens)
+    for n in range(1, max_ngram + 1):
+        repeats = max(min_repeats, math.ceil(min_span / n))
+        span = n * repeats
+        if span > length:
+            break
+        # 末尾のn-gramとその直前が一致しない場合は比較を省略
+        if tokens[-1] != tokens[-1 - n]:
+            continue
+        tail = tokens[-n:]
+        if tokens[-span:] == tail * repeats:
+            return n, repeats
+    return None
+
+
+def trim_loop(tokens, eot, loop):
+    """
+    デコード結果から繰り返し部分を取り除き、最初の1回分だけを残す
+    Args:
+        tokens (list): デコード結果のトークン列（タイムスタンプを含む）
+        eot (int): テキストトークンの上限（これ以上はタイムスタンプ等の特殊トークン）
+        loop (tuple): find_loopの戻り値
+    Returns:
+        list: 繰り返しを除いたトークン列
+    """
+    n, repeats = loop
+    positions = [index for index, token in enumerate(tokens) if token < eot]
+    keep = len(positions) - n * (repeats - 1)
+    return tokens[:positions[keep]]
+
+
+class RepetitionStats:
+    def __init__(self):
+        """繰り返し検出による打ち切りの統計"""
+        self._lock = threading.Lock()
+        self.windows = 0
+        self.loops_detected = 0
+        self.tokens_generated = 0
+        self.tokens_saved = 0
+        self.audio_seconds = 0.0
+
+    def add_audio(self, seconds):
+        """処理した音声の長さを記録（1時間あたりの換算に使用）"""
+        with self._lock:
+            self.audio_seconds += seconds
+
+    def record(self, windows=0, loops=0, generated=0, saved=0):
+        with self._lock:
+            self.windows += windows
+            self.loops_detected += loops
+            self.tokens_generated += generated
+            self.tokens_saved += saved
+
+    def tokens_saved_per_hour(self):
+        """音声1時間あたりに節約したデコーダのトークン数"""
+        if self.audio_seconds <= 0:
+            return 0.0
+        return self.tokens_saved / self.audio_seconds * 3600
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'windows': self.windows,
+                'loops_detected': self.loops_detected,
+                'tokens_generated': self.tokens_generated,
+                'tokens_saved': self.tokens_saved,
+                'audio_seconds': self.audio_seconds,
+                'tokens_saved_per_hour': self.tokens_saved_per_hour(),
+            }
+
+
+class RepetitionFilter(LogitFilter):
+    def __init__(self, eot, sample_begin):
+        """
+        デコードのステップごとに末尾の繰り返しを検出し、検出した系列にEOTを強制するフィルタ
+        （統計はビーム・候補ごとではなく窓ごとに GuardedDecodingTask.run で記録する）
+        Args:
+            eot (int): EOTトークン
+            sample_begin (int): 生成部分の開始位置
+        """
+        self.eot = eot
+        self.sample_begin = sample_begin
+
+    def apply(self, logits, tokens):
+        for row, sequence in enumerate(tokens.tolist()):
+            if sequence[-1] == self.eot:
+                # 終了済みの系列
+                continue
+            generated = sequence[self.sample_begin:]
+            text_tokens = [token for token in generated if token < self.eot]
+            if find_loop(text_tokens) is None:
+                continue
+            logits[row] = -math.inf
+            logits[row, self.eot] = 0
+
+
+class GuardedDecodingTask(DecodingTask):
+    """repetition_guardの中で実行されたときだけ繰り返し検出フィルタを追加するDecodingTask"""
+
+    def __init__(self, model, options):
+        super().__init__(model, options)
+        self.guard_config = getattr(_local, 'config', None)
+        if self.guard_config is not None:
+            self.logit_filters.append(RepetitionFilter(self.tokenizer.eot, self.sample_begin))
+
+    def run(self, mel):
+        results = super().run(mel)
+        if self.guard_config is None:
+            return results
+        stats = self.guard_config['stats']
+        policy = self.guard_config['policy']
+        eot = self.tokenizer.eot
+        # 温度フォールバックでは同じ窓のメルで再デコードされるため、窓と繰り返しは最初の1回だけ数える
+        # （decodeがunsqueezeした別のテンソルになるため、参照を保持したメルとメモリの位置で比較する）
+        previous = self.guard_config.get('mel')
+        new_window = previous is None or previous.data_ptr() != mel.data_ptr() or previous.shape != mel.shape
+        if new_window:
+            self.guard_config['mel'] = mel
+            self.guard_config['looped'] = set()
+        looped = self.guard_config['looped']
+        guarded = []
+        for index, result in enumerate(results):
+            stats.record(windows=1 if new_window else 0, generated=len(result.tokens))
+            loop = find_loop([token for token in result.tokens if token < eot])
+            if loop is not None:
+                if index not in looped:
+                    # ビーム・候補の数によらず、選ばれた結果で打ち切った分を窓ごとに1回だけ記録
+                    looped.add(index)
+                    stats.record(loops=1, saved=max(0, self.sample_len - len(result.tokens)))
+                tokens = trim_loop(result.tokens, eot, loop)
+                text = self.tokenizer.decode(tokens).strip()
+                # 'skip' は切り詰めた結果をそのまま使い、窓の残りを読み飛ばす
+                # 'fallback' は圧縮率を大きくして次の温度での再デコードを促す
+                ratio = LOOP_COMPRESSION_RATIO if policy == 'fallback' else compression_ratio(text)
+                result = replace(result, tokens=tokens, text=text, compression_ratio=ratio)
+            guarded.append(result)
+        return guarded
+
+
+def install():
+    """whisper.decoding.decodeが使うDecodingTaskを差し替える（複数回呼んでも1回だけ）"""
+    with _install_lock:
+        if whisper.decoding.DecodingTask is not GuardedDecodingTask:
+            whisper.decoding.DecodingTask = GuardedDecodingTask
+
+
+@contextmanager
+def repetition_guard(policy=DEFAULT_LOOP_POLICY, stats=None):
+    """
+    このブロック内（同じスレッド）のデコードで繰り返し検出を有効にする
+    Args:
+        policy (str): 'skip'（切り詰めて次へ進む）または 'fallback'（温度フォールバックで再デコード）
+        stats (RepetitionStats): 統計の記録先（省略時は新規作成）
+    Yields:
+        RepetitionStats: 統計
+    """
+    if policy not in LOOP_POLICIES:
+        raise ValueError(f"不明な繰り返し処理方法です: {policy}（{', '.join(LOOP_POLICIES)}）")
+    install()
+    stats = stats or RepetitionStats()
+    previous = getattr(_local, 'config', None)
+    _local.config = {'policy': policy, 'stats': stats}
+    try:
+        yield stats
+    finally:
+        _local.config = previous
+
+
+def scan_history(users_json, tokenizer):
+    """
+    保存済みの認識結果（users.json）から繰り返しを探し、打ち切りで節約できたトークン数を推定
+    Returns:
+        dict: {'outputs', 'outputs_with_loops', 'tokens_total', 'tokens_in_loops'}
+    """
+    with open(users_json, 'r', encoding='utf-8') as f:
+        users = json.load(f).get('users', {})
+    report = {'outputs': 0, 'outputs_with_loops': 0, 'tokens_total': 0, 'tokens_in_loops': 0}
+    for user in users.values():
+        for entry in user.get('history', []):
+            tokens = tokenizer.encode(entry.get('output_text', ''))
+            report['outputs'] += 1
+            report['tokens_total'] += len(tokens)
+            # 繰り返しを検出したら続く繰り返しまで読み進め、最初の1回を除いた分を数える
+            looping = 0
+            start = 0
+            end = 1
+            while end <= len(tokens):
+                loop = find_loop(tokens[start:end])
+                if loop is None:
+                    end += 1
+                    continue
+                n, repeats = loop
+                loop_start = end - n * repeats
+                while end + n <= len(tokens) and tokens[end:end + n] == tokens[end - n:end]:
+                    end += n
+                looping += end - loop_start - n
+                start = end
+                end += 1
+            if looping:
+                report['outputs_with_loops'] += 1
+                report['tokens_in_loops'] += looping
+    return report
+
+
+def benchmark_guard(model, audio_paths, policy=DEFAULT_LOOP_POLICY, preset='fast'):
+    """
+    繰り返し検出の有無で文字起こし時間と生成トークン数を比較
+    Returns:
+        dict: {'baseline_seconds', 'guarded_seconds', 'stats'}
+    """
+    from dataset_audio import load_dataset_audio, SAMPLE_RATE
+    from decoding_cascade import _transcribe
+
+    baseline_seconds = 0.0
+    guarded_seconds = 0.0
+    stats = RepetitionStats()
+    for path in audio_paths:
+        audio = load_dataset_audio(path)
+        start_time = time.perf_counter()
+        _transcribe(model, audio, preset, "日本語の音声を認識します。")
+        baseline_seconds += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        with repetition_guard(policy, stats):
+            _transcribe(model, audio, preset, "日本語の音声を認識します。")
+        guarded_seconds += time.perf_counter() - start_time
+        stats.add_audio(len(audio) / SAMPLE_RATE)
+    return {
+        'baseline_seconds': baseline_seconds,
+        'guarded_seconds': guarded_seconds,
+        'stats': stats.as_dict(),
+    }
+
+
+if __name__ == "__main__":
+    # 使い方: python repetition_guard.py <音声ファイル...>
+    #         python repetition_guard.py --scan <users.json>
+    import whisper
+    from whisper.tokenizer import get_tokenizer
+    from PersonalizedSR import get_runtime_config, MODELS_DIR
+
+    if len(sys.argv) < 2:
+        print("使い方: python repetition_guard.py <音声ファイル...>")
+        print("        python repetition_guard.py --scan <users.json>")
+        sys.exit(1)
+    if sys.argv[1] == "--scan":
+        report = scan_history(sys.argv[2], get_tokenizer(True, language="ja", task="transcribe"))
+        print("=== 保存済みの認識結果の繰り返し ===")
+        print(f"- 繰り返しを含む結果: {report['outputs_with_loops']}/{report['outputs']}")
+        print(f"- 繰り返し部分のトークン: {report['tokens_in_loops']}/{report['tokens_total']}")
+        sys.exit(0)
+
+    model = whisper.load_model(get_runtime_config()['model_name'], download_root=MODELS_DIR)
+    report = benchmark_guard(model, sys.argv[1:])
+    stats = report['stats']
+    print("=== 繰り返し検出の測定結果 ===")
+    print(f"- 検出なし: {report['baseline_seconds']:.2f}秒")
+    print(f"- 検出あり: {report['guarded_seconds']:.2f}秒")
+    print(f"- 検出した繰り返し: {stats['loops_detected']}回（{stats['windows']}窓）")
+    print(f"- 節約したトークン: {stats['tokens_saved']}（音声1時間あたり {stats['tokens_saved_per_hour']:.0f}）")
@@ -1,7 +1,16 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, scrolledtext, messagebox
-import threading
-from PersonalizedSR import transcribe_audio, fine_tune_model, DATASET_DIR, FINETUNED_DIR
+from PersonalizedSR import (transcribe_audio, fine_tune_model, get_runtime_config, DATASET_DIR, FINETUNED_DIR,
+                            MODEL_REGISTRY_PATH)
+from model_registry import ModelRegistry
+from job_scheduler import JobScheduler
+from progress_bus import ProgressBus
+from decoding_presets import PRESETS, PRESET_LABELS, DEFAULT_PRESET
+from model_export import INFERENCE_BACKENDS, DEFAULT_BACKEND
+from training_checkpoint import find_resumable_run
+from training_controller import LR_SCHEDULES, DEFAULT_LR_SCHEDULE
+from continual_training import plan_user_training, prepare_user_dataset, DEFAULT_REPLAY_RATIO, TRAINING_DATASET_SUBDIR
+from training_memory import OPTIMIZERS, DEFAULT_OPTIMIZER, PRECISIONS, DEFAULT_PRECISION
 import os
 import sys
 import json
@@ -52,6 +61,19 @@ class SpeechRecognitionApp:
         # ユーザー管理
         self.user_manager = UserManager()
         
+        # ジョブスケジューラ（推論スロットと学習スロットを分離）
+        # 学習と文字起こしは同じプロセスのスレッドで動くため、プロセス全体のスレッド数は両スロットの合計にする
+        self.inference_threads = min(get_runtime_config()['intra_op_threads'], os.cpu_count() or 1)
+        self.training_threads = max(1, (os.cpu_count() or 1) - self.inference_threads)
+        self.scheduler = JobScheduler(cpu_threads=self.inference_threads + self.training_threads)
+        
+        # ワーカースレッドからの進捗・ログはイベントバス経由でUIに反映
+        self.bus = ProgressBus()
+        
+        # 学習済みモデルの登録簿（登録簿の導入前に学習したモデルも取り込む）
+        self.registry = ModelRegistry(MODEL_REGISTRY_PATH)
+        self.registry.scan(self.user_manager.users_dir, FINETUNED_DIR)
+        
         # スタイル設定
         style = ttk.Style()
         style.configure('Custom.TButton', padding=5)
@@ -78,7 +100,21 @@ class SpeechRecognitionApp:
         self.tab_control.add(training_tab, text='モデル学習')
         self.setup_training_tab(training_tab)
         
+        # ジョブ一覧タブ
+        jobs_tab = ttk.Frame(self.tab_control)
+        self.tab_control.add(jobs_tab, text='ジョブ')
+        self.setup_jobs_tab(jobs_tab)
+        
         self.tab_control.pack(expand=True, fill=tk.BOTH)
+        self.refresh_job_list()
+        
+        self.bus.subscribe('progress', self.on_progress_event)
+        self.bus.subscribe('log', self.on_log_event)
+        self.bus.subscribe('partial', self.on_partial_event)
+        self.bus.subscribe('model_saved', self.on_model_saved_event)
+        self.bus.subscribe('dataset_changed', self.on_dataset_changed_event)
+        self.bus.subscribe('error', self.on_error_event)
+        self.bus.start(self.root)
 
     def setup_user_frame(self):
         """ユーザー選択フレームの設定"""
@@ -95,8 +131,31 @@ class SpeechRecognitionApp:
         ttk.Button(user_frame, text="新規ユーザー", 
                   command=self.create_new_user).pack(side=tk.LEFT, padx=5)
         
+        # 文字起こしに使うモデル（ユーザーの現在のモデル）
+        self.active_model_var = tk.StringVar()
+        ttk.Label(user_frame, textvariable=self.active_model_var).pack(side=tk.LEFT, padx=10)
+        ttk.Button(user_frame, text="前のモデルに戻す",
+                  command=self.rollback_model).pack(side=tk.LEFT, padx=5)
+        self.refresh_active_model()
+        
         self.user_combo.bind('<<ComboboxSelected>>', self.on_user_selected)
 
+    def refresh_active_model(self):
+        """ユーザーの現在のモデルを表示"""
+        model_path = self.registry.active_model(self.user_manager.current_user)
+        self.active_model_var.set(f"使用モデル: {os.path.basename(model_path) if model_path else '標準モデル'}")
+
+    def rollback_model(self):
+        """ユーザーの現在のモデルを1つ前のモデルに戻す"""
+        if not self.user_manager.current_user:
+            return
+        model_path = self.registry.rollback(self.user_manager.current_user)
+        if model_path is None:
+            messagebox.showinfo("情報", "1つ前のモデルがありません")
+            return
+        self.refresh_active_model()
+        self.bus.log('training', f"使用するモデルを戻しました: {model_path}")
+
     def refresh_user_list(self):
         """ユーザー一覧を更新"""
         self.user_manager.load_users()
@@ -128,6 +187,7 @@ class SpeechRecognitionApp:
     def on_user_selected(self, event):
         """ユーザーが選択されたときの処理"""
         self.user_manager.current_user = self.user_var.get()
+        self.refresh_active_model()
         self.refresh_dataset_list()
         self.refresh_training_list()
 
@@ -148,6 +208,24 @@ class SpeechRecognitionApp:
                               command=self.browse_file, style='Custom.TButton')
         browse_btn.pack(side=tk.LEFT, padx=5)
         
+        # デコード設定のプリセット
+        ttk.Label(file_frame, text="速度:").pack(side=tk.LEFT, padx=(10, 0))
+        self.preset_names = {PRESET_LABELS[name]: name for name in PRESETS}
+        self.preset_var = tk.StringVar(value=PRESET_LABELS[DEFAULT_PRESET])
+        preset_combo = ttk.Combobox(file_frame, textvariable=self.preset_var,
+                                  values=list(self.preset_names), state='readonly', width=10)
+        preset_combo.pack(side=tk.LEFT, padx=5)
+        
+        self.cascade_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(file_frame, text="段階的デコード",
+                       variable=self.cascade_var).pack(side=tk.LEFT, padx=5)
+        
+        # 推論エンジン（torchscript / onnx は書き出したグラフでCPU推論）
+        ttk.Label(file_frame, text="推論エンジン:").pack(side=tk.LEFT, padx=(10, 0))
+        self.backend_var = tk.StringVar(value=DEFAULT_BACKEND)
+        ttk.Combobox(file_frame, textvariable=self.backend_var, values=list(INFERENCE_BACKENDS),
+                     state='readonly', width=11).pack(side=tk.LEFT, padx=5)
+        
         # 実行ボタン
         self.process_btn = ttk.Button(main_frame, text="文字起こし開始", 
                                     command=self.start_processing, style='Custom.TButton')
@@ -392,25 +470,178 @@ class SpeechRecognitionApp:
         lr_entry = ttk.Entry(lr_frame, textvariable=self.lr_var, width=10)
         lr_entry.pack(side=tk.LEFT, padx=5)
         
+        # 学習率スケジュール（ウォームアップ後に減衰）
+        schedule_frame = ttk.Frame(settings_frame)
+        schedule_frame.pack(fill=tk.X)
+        ttk.Label(schedule_frame, text="学習率スケジュール:").pack(side=tk.LEFT)
+        self.schedule_var = tk.StringVar(value=DEFAULT_LR_SCHEDULE)
+        ttk.Combobox(schedule_frame, textvariable=self.schedule_var, values=LR_SCHEDULES,
+                     state='readonly', width=10).pack(side=tk.LEFT, padx=5)
+        
+        # 勾配累積（メモリを増やさずに実効バッチサイズを大きくする）
+        accumulation_frame = ttk.Frame(settings_frame)
+        accumulation_frame.pack(fill=tk.X)
+        ttk.Label(accumulation_frame, text="勾配累積ステップ数:").pack(side=tk.LEFT)
+        self.accumulation_var = tk.StringVar(value="1")
+        accumulation_entry = ttk.Entry(accumulation_frame, textvariable=self.accumulation_var, width=10)
+        accumulation_entry.pack(side=tk.LEFT, padx=5)
+        
+        # オプティマイザ（adafactorは状態を分解して持つためメモリが少ない）
+        optimizer_frame = ttk.Frame(settings_frame)
+        optimizer_frame.pack(fill=tk.X)
+        ttk.Label(optimizer_frame, text="オプティマイザ:").pack(side=tk.LEFT)
+        self.optimizer_var = tk.StringVar(value=DEFAULT_OPTIMIZER)
+        ttk.Combobox(optimizer_frame, textvariable=self.optimizer_var, values=OPTIMIZERS,
+                     state='readonly', width=10).pack(side=tk.LEFT, padx=5)
+        
+        # 学習する層（上位のデコーダブロックだけを学習してメモリを抑える、空欄なら全体）
+        layers_frame = ttk.Frame(settings_frame)
+        layers_frame.pack(fill=tk.X)
+        ttk.Label(layers_frame, text="学習するデコーダブロック数:").pack(side=tk.LEFT)
+        self.decoder_blocks_var = tk.StringVar(value="")
+        decoder_blocks_entry = ttk.Entry(layers_frame, textvariable=self.decoder_blocks_var, width=10)
+        decoder_blocks_entry.pack(side=tk.LEFT, padx=5)
+        ttk.Label(layers_frame, text="（空欄なら全体）").pack(side=tk.LEFT)
+        
+        # 計算精度（bf16は学習が速く、メモリも少ない）
+        precision_frame = ttk.Frame(settings_frame)
+        precision_frame.pack(fill=tk.X)
+        ttk.Label(precision_frame, text="計算精度:").pack(side=tk.LEFT)
+        self.precision_var = tk.StringVar(value=DEFAULT_PRECISION)
+        ttk.Combobox(precision_frame, textvariable=self.precision_var, values=PRECISIONS,
+                     state='readonly', width=10).pack(side=tk.LEFT, padx=5)
+        
+        # 勾配チェックポイント（活性化を再計算してメモリを節約、学習は遅くなる）
+        self.checkpointing_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(settings_frame, text="勾配チェックポイントでメモリを節約（学習は遅くなります）",
+                        variable=self.checkpointing_var).pack(anchor=tk.W, pady=(5, 0))
+        
+        # 追加学習（前回のモデルから、前回以降に追加・修正したデータだけを学習）
+        self.incremental_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(settings_frame,
+                        text="前回のモデルから追加学習（未選択なら全データから追加・修正分を自動で選択）",
+                        variable=self.incremental_var).pack(anchor=tk.W, pady=(5, 0))
+        
+        # 中断した学習の再開
+        self.resume_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(settings_frame, text="中断した学習があればチェックポイントから再開",
+                        variable=self.resume_var).pack(anchor=tk.W, pady=(5, 0))
+        
         # 学習ボタン
         self.train_btn = ttk.Button(main_frame, text="学習開始", 
                                   command=self.start_training, style='Custom.TButton')
         self.train_btn.pack(pady=10)
         
         # 進捗表示
-        self.progress_var = tk.DoubleVar()
-        self.progress = ttk.Progressbar(main_frame, variable=self.progress_var, 
-                                      maximum=100, length=300)
-        self.progress.pack(pady=(0, 5))
-        
-        self.status_var = tk.StringVar()
-        self.status_var.set("学習データを選択してください")
-        status_label = ttk.Label(main_frame, textvariable=self.status_var)
+        self.train_progress_var = tk.DoubleVar()
+        self.train_progress = ttk.Progressbar(main_frame, variable=self.train_progress_var, 
+                                            maximum=100, length=300)
+        self.train_progress.pack(pady=(0, 5))
+        
+        self.train_status_var = tk.StringVar()
+        self.train_status_var.set("学習データを選択してください")
+        status_label = ttk.Label(main_frame, textvariable=self.train_status_var)
         status_label.pack(pady=(0, 10))
 
+    def setup_jobs_tab(self, parent):
+        """ジョブ一覧タブの設定"""
+        main_frame = ttk.Frame(parent, style='Custom.TFrame')
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        list_frame = ttk.LabelFrame(main_frame, text="ジョブ一覧", padding=10)
+        list_frame.pack(fill=tk.BOTH, expand=True)
+        
+        self.job_tree = ttk.Treeview(list_frame,
+                                   columns=('id', 'name', 'resource', 'status', 'queue_time', 'run_time'),
+                                   show='headings')
+        self.job_tree.heading('id', text='ID')
+        self.job_tree.heading('name', text='ジョブ')
+        self.job_tree.heading('resource', text='リソース')
+        self.job_tree.heading('status', text='状態')
+        self.job_tree.heading('queue_time', text='待機時間')
+        self.job_tree.heading('run_time', text='実行時間')
+        self.job_tree.column('id', width=40)
+        self.job_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        scrollbar = ttk.Scrollbar(list_frame, orient=tk.VERTICAL,
+                                command=self.job_tree.yview)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.job_tree.config(yscrollcommand=scrollbar.set)
+        
+        button_frame = ttk.Frame(main_frame)
+        button_frame.pack(fill=tk.X, pady=10)
+        ttk.Button(button_frame, text="キャンセル",
+                  command=self.cancel_selected_job).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="終了したジョブを消去",
+                  command=self.scheduler.clear_finished).pack(side=tk.LEFT, padx=5)
+        
+        # ログ表示
+        log_frame = ttk.LabelFrame(main_frame, text="ログ", padding=10)
+        log_frame.pack(fill=tk.BOTH, expand=True)
+        self.log_text = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, height=10)
+        self.log_text.pack(fill=tk.BOTH, expand=True)
+
+    def refresh_job_list(self):
+        """ジョブ一覧を定期的に更新"""
+        selection = self.job_tree.selection()
+        selected_ids = [self.job_tree.item(item_id)['values'][0] for item_id in selection]
+        self.job_tree.delete(*self.job_tree.get_children())
+        for job in list(self.scheduler.jobs):
+            item_id = self.job_tree.insert('', 'end', values=(
+                job.id,
+                job.name,
+                job.resource,
+                job.status_label,
+                f"{job.queue_time:.1f}秒",
+                f"{job.run_time:.1f}秒"
+            ))
+            if job.id in selected_ids:
+                self.job_tree.selection_add(item_id)
+        self.root.after(500, self.refresh_job_list)
+
+    def cancel_selected_job(self):
+        """選択されたジョブをキャンセル"""
+        for item_id in self.job_tree.selection():
+            job_id = self.job_tree.item(item_id)['values'][0]
+            self.scheduler.cancel(job_id)
+
     def start_training(self):
         """モデルの学習を開始"""
+        if not self.user_manager.current_user:
+            messagebox.showerror("エラー", "ユーザーを選択してください")
+            return
+        user_dir = self.user_manager.get_user_dir()
+        username = self.user_manager.current_user
+        user_model_dir = os.path.join(user_dir, "models")
+        
+        # 中断した学習は中断時の設定と学習データで再開する（選択中のデータと設定は使わないため確認する）
+        resume_from = find_resumable_run(user_model_dir) if self.resume_var.get() else None
+        if resume_from:
+            answer = messagebox.askyesnocancel(
+                "学習の再開",
+                f"中断した学習があります: {os.path.basename(resume_from)}\n\n"
+                "「はい」: 中断時の設定と学習データで再開します（選択中のデータと学習設定は使いません）\n"
+                "「いいえ」: 選択中のデータと学習設定で新しく学習します")
+            if answer is None:
+                return
+            if answer:
+                self.submit_training(lambda job: fine_tune_model(
+                    "base",
+                    os.path.join(user_dir, TRAINING_DATASET_SUBDIR),
+                    progress_callback=self.bus.callback('training'),
+                    cancel_event=job.cancel_event,
+                    num_threads=job.threads,
+                    configure_threads=False,
+                    resume_from=resume_from,
+                    user=username
+                ))
+                return
+        
+        incremental = self.incremental_var.get()
         selected = self.train_tree.selection()
+        if not selected and incremental:
+            # 追加学習では全データから前回のモデル以降の差分を選ぶ
+            selected = self.train_tree.get_children()
         if not selected:
             messagebox.showwarning("警告", "学習に使用するデータを選択してください")
             return
@@ -419,12 +650,18 @@ class SpeechRecognitionApp:
             epochs = int(self.epoch_var.get())
             batch_size = int(self.batch_var.get())
             learning_rate = float(self.lr_var.get())
+            accumulation_steps = int(self.accumulation_var.get())
+            if accumulation_steps < 1:
+                raise ValueError
+            decoder_blocks = self.decoder_blocks_var.get().strip()
+            train_decoder_blocks = int(decoder_blocks) if decoder_blocks else None
+            if train_decoder_blocks is not None and train_decoder_blocks < 1:
+                raise ValueError
         except ValueError:
             messagebox.showerror("エラー", "学習パラメータの値が不正です")
             return
         
         # 選択されたデータの音声ファイルとテキストファイルを取得
-        user_dir = self.user_manager.get_user_dir()
         training_data = []
         
         for item_id in selected:
@@ -446,60 +683,81 @@ class SpeechRecognitionApp:
             messagebox.showerror("エラー", "有効な学習データがありません")
             return
         
-        self.train_btn.config(state=tk.DISABLED)
-        self.status_var.set("学習を準備中...")
-        self.progress_var.set(0)
+        # 追加学習: ユーザーの最新モデルから始め、新しいデータに既存データを一部混ぜて忘却を防ぐ
+        plan = plan_user_training(user_dir, incremental, DEFAULT_REPLAY_RATIO, samples=training_data,
+                                  active_model=self.registry.active_model(username))
+        if plan is None:
+            messagebox.showinfo("情報", "前回のモデル以降に追加・修正されたデータがありません")
+            return
+        if plan['base_model']:
+            self.bus.log('training', f"追加学習: {os.path.basename(plan['base_model'])} から、"
+                                     f"新しいデータ {plan['new']}件 + 既存データ {plan['replay']}件を学習します")
+        
+        lr_schedule = self.schedule_var.get()
+        optimizer_name = self.optimizer_var.get()
+        precision = self.precision_var.get()
+        gradient_checkpointing = self.checkpointing_var.get()
+        
+        def train(job):
+            # 学習データをFLACに正規化して用意（変更のない録音は前回の変換結果と特徴量キャッシュを再利用）
+            dataset_dir, sample_names = prepare_user_dataset(user_dir, plan['samples'])
+            
+            # モデルの学習（ユーザーのmodels/に直接保存）
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            return fine_tune_model(
+                plan['base_model'] or "base",
+                dataset_dir,
+                epochs=epochs,
+                batch_size=batch_size,
+                learning_rate=learning_rate,
+                lr_schedule=lr_schedule,
+                accumulation_steps=accumulation_steps,
+                optimizer_name=optimizer_name,
+                train_decoder_blocks=train_decoder_blocks,
+                precision=precision,
+                gradient_checkpointing=gradient_checkpointing,
+                progress_callback=self.bus.callback('training'),
+                cancel_event=job.cancel_event,
+                num_threads=job.threads,
+                configure_threads=False,
+                data_snapshot=plan['data_snapshot'],
+                sample_names=sample_names,
+                output_dir=os.path.join(user_model_dir, f"model_{timestamp}"),
+                user=username
+            )
         
-        def train():
+        self.submit_training(train)
+
+    def submit_training(self, run):
+        """
+        学習ジョブを登録
+        Args:
+            run (callable): run(job) で学習を実行し、保存したモデルのディレクトリを返す関数
+        """
+        self.train_status_var.set("学習を準備中...")
+        self.train_progress_var.set(0)
+        
+        def train(job):
             try:
-                # 学習用の一時データセットを作成
-                temp_dataset_dir = os.path.join(user_dir, "temp_dataset")
-                os.makedirs(temp_dataset_dir, exist_ok=True)
-                
-                # データをコピー
-                for i, data in enumerate(training_data):
-                    data_dir = os.path.join(temp_dataset_dir, f"data_{i}")
-                    os.makedirs(data_dir, exist_ok=True)
-                    
-                    # 音声ファイルをコピー
-                    shutil.copy2(data['audio'], 
-                               os.path.join(data_dir, "audio" + os.path.splitext(data['audio'])[1]))
-                    
-                    # テキストファイルをコピー
-                    shutil.copy2(data['transcript'], 
-                               os.path.join(data_dir, "transcript.txt"))
+                final_model_path = run(job)
+                self.bus.model_saved('training', final_model_path)
                 
-                # モデルの学習
-                model_path = fine_tune_model(
-                    "base",
-                    temp_dataset_dir,
-                    epochs=epochs,
-                    batch_size=batch_size,
-                    learning_rate=learning_rate
-                )
-                
-                # 学習済みモデルをユーザーディレクトリに移動
-                user_model_dir = os.path.join(user_dir, "models")
-                os.makedirs(user_model_dir, exist_ok=True)
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                final_model_path = os.path.join(user_model_dir, f"model_{timestamp}")
-                shutil.move(model_path, final_model_path)
-                
-                # 一時データセットを削除
-                shutil.rmtree(temp_dataset_dir)
-                
-                self.root.after(0, lambda: self.status_var.set(
-                    f"学習が完了しました: {final_model_path}"))
+                self.bus.progress('training', 100, f"学習が完了しました: {final_model_path}")
+                self.bus.log('training', f"学習済みモデルを保存しました: {final_model_path}")
                 
             except Exception as e:
-                self.root.after(0, lambda: messagebox.showerror(
-                    "エラー", f"学習中にエラーが発生しました: {str(e)}"))
-            finally:
-                self.root.after(0, lambda: self.train_btn.config(state=tk.NORMAL))
-                self.root.after(0, lambda: self.progress_var.set(100))
-        
-        thread = threading.Thread(target=train)
-        thread.start()
+                if job.cancelled:
+                    self.bus.progress('training', 100, "学習がキャンセルされました（次回の学習開始時に再開できます）")
+                else:
+                    # eはexceptブロックを出ると消えるため、ここでメッセージにしてから渡す
+                    error_message = f"学習中にエラーが発生しました: {str(e)}"
+                    self.bus.log('training', error_message)
+                    self.bus.error('training', error_message)
+                raise
+        
+        self.scheduler.submit(
+            f"学習 ({self.user_manager.current_user})", train,
+            resource='training', threads=self.training_threads)
 
     def browse_file(self):
         file_path = filedialog.askopenfilename(
@@ -512,10 +770,42 @@ class SpeechRecognitionApp:
             self.file_path.set(file_path)
             self.status_var.set("ファイルが選択されました")
 
-    def update_progress(self, progress, status):
-        self.progress_var.set(progress)
-        self.status_var.set(status)
-        self.root.update_idletasks()
+    def on_progress_event(self, channel, progress, status):
+        """進捗イベントをUIに反映（メインスレッドで実行）"""
+        if channel == 'training':
+            self.train_progress_var.set(progress)
+            self.train_status_var.set(status)
+        else:
+            self.progress_var.set(progress)
+            self.status_var.set(status)
+
+    def on_log_event(self, channel, message):
+        """ログイベントをジョブタブのログに追記"""
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        self.log_text.insert(tk.END, f"[{timestamp}] [{channel}] {message}\n")
+        self.log_text.see(tk.END)
+
+    def on_partial_event(self, channel, text, final):
+        """途中結果を認識結果エリアに追記（全体の結果が届いたら置き換えて保存できるようにする）"""
+        if channel != 'recognition':
+            return
+        if final:
+            self.result_text.delete(1.0, tk.END)
+            self.save_btn.config(state=tk.NORMAL)
+        self.result_text.insert(tk.END, text)
+        self.result_text.see(tk.END)
+
+    def on_model_saved_event(self, channel, model_path):
+        """学習したモデルが保存されたら現在のモデルの表示を更新"""
+        self.refresh_active_model()
+
+    def on_dataset_changed_event(self, channel):
+        """文字起こしの結果が保存されたら学習データの一覧を更新"""
+        self.refresh_dataset_list()
+
+    def on_error_event(self, channel, message):
+        """ワーカースレッドで起きたエラーをダイアログで表示"""
+        messagebox.showerror("エラー", message)
 
     def start_processing(self):
         if not self.file_path.get():
@@ -526,28 +816,43 @@ class SpeechRecognitionApp:
             messagebox.showerror("エラー", "ユーザーを選択してください")
             return
         
-        self.process_btn.config(state=tk.DISABLED)
         self.save_btn.config(state=tk.DISABLED)
         self.result_text.delete(1.0, tk.END)
-        
-        def process():
+        input_file = self.file_path.get()
+        user_dir = self.user_manager.get_user_dir()
+        preset = self.preset_names[self.preset_var.get()]
+        cascade = self.cascade_var.get()
+        backend = self.backend_var.get()
+        # ユーザーの現在のモデルで文字起こし（登録簿から取得、なければ標準モデル）
+        model_path = self.registry.active_model(self.user_manager.current_user)
+        if model_path:
+            self.registry.touch(model_path, self.user_manager.current_user)
+        
+        def process(job):
             try:
                 # 音声ファイルを処理
                 result, transcript_file, dataset_dir = transcribe_audio(
-                    self.file_path.get(), 
-                    progress_callback=self.update_progress
+                    input_file, 
+                    model_path=model_path,
+                    progress_callback=self.bus.callback('recognition'),
+                    cancel_event=job.cancel_event,
+                    num_threads=job.threads,
+                    configure_threads=False,
+                    preset=preset,
+                    cascade=cascade,
+                    backend=backend,
+                    segment_callback=lambda segment: self.bus.partial('recognition', segment['text'])
                 )
                 
                 # 結果をユーザーディレクトリに保存
-                user_dir = self.user_manager.get_user_dir()
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 
                 # 音声ファイルをコピー
                 audio_dir = os.path.join(user_dir, "audio")
                 os.makedirs(audio_dir, exist_ok=True)
-                audio_ext = os.path.splitext(self.file_path.get())[1]
+                audio_ext = os.path.splitext(input_file)[1]
                 audio_file = os.path.join(audio_dir, f"{timestamp}{audio_ext}")
-                shutil.copy2(self.file_path.get(), audio_file)
+                shutil.copy2(input_file, audio_file)
                 
                 # テキストファイルを保存
                 transcripts_dir = os.path.join(user_dir, "transcripts")
@@ -555,20 +860,29 @@ class SpeechRecognitionApp:
                 transcript_file = os.path.join(transcripts_dir, f"{timestamp}.txt")
                 with open(transcript_file, 'w', encoding='utf-8') as f:
                     f.write(result)
+                # タイムスタンプ付きのセグメント（長い録音を学習時にセグメントの境界で分割するのに使う）
+                segments_file = os.path.join(dataset_dir, 'transcript.json')
+                if os.path.exists(segments_file):
+                    shutil.copy2(segments_file, os.path.join(transcripts_dir, f"{timestamp}.json"))
                 
-                self.root.after(0, lambda: self.result_text.insert(tk.END, result))
-                self.root.after(0, lambda: self.save_btn.config(state=tk.NORMAL))
-                self.root.after(0, lambda: self.status_var.set("処理が完了しました"))
-                self.root.after(0, self.refresh_dataset_list)
+                self.bus.partial('recognition', result, final=True)
+                self.bus.progress('recognition', 100, "処理が完了しました")
+                self.bus.log('recognition', f"認識結果を保存しました: {transcript_file}")
+                self.bus.dataset_changed('recognition')
                 
             except Exception as e:
-                error_message = f"エラーが発生しました: {str(e)}"
-                self.root.after(0, lambda: self.status_var.set(error_message))
-            finally:
-                self.root.after(0, lambda: self.process_btn.config(state=tk.NORMAL))
-        
-        thread = threading.Thread(target=process)
-        thread.start()
+                if job.cancelled:
+                    error_message = "処理がキャンセルされました"
+                else:
+                    error_message = f"エラーが発生しました: {str(e)}"
+                self.bus.progress('recognition', 100, error_message)
+                self.bus.log('recognition', error_message)
+                raise
+        
+        self.scheduler.submit(
+            f"文字起こし ({os.path.basename(input_file)})", process,
+            resource='inference', threads=self.inference_threads)
+        self.status_var.set("ジョブを登録しました")
 
     def save_result(self):
         file_path = filedialog.asksaveasfilename(
@@ -640,17 +954,13 @@ def initialize_whisper():
             # FFTビン周波数
             fft_freqs = np.linspace(0, sampling_rate/2, n_fft//2 + 1)
             
-            # メルフィルタバンクの生成
-            mel_filters = np.zeros((n_mels, n_fft//2 + 1))
-            for i in range(n_mels):
-                lower = hz_points[i]
-                center = hz_points[i+1]
-                upper = hz_points[i+2]
-                
-                # 三角フィルタの左側
-                left_slope = (fft_freqs - lower) / (center - lower)
-                right_slope = (upper - fft_freqs) / (upper - center)
-                mel_filters[i] = np.maximum(0, np.minimum(left_slope, right_slope))
+            # メルフィルタバンクの生成（三角フィルタを全バンド一括で計算）
+            lower = hz_points[:-2, np.newaxis]
+            center = hz_points[1:-1, np.newaxis]
+            upper = hz_points[2:, np.newaxis]
+            left_slope = (fft_freqs - lower) / (center - lower)
+            right_slope = (upper - fft_freqs) / (upper - center)
+            mel_filters = np.maximum(0, np.minimum(left_slope, right_slope))
             
             # 正規化
             enorm = 2.0 / (hz_points[2:] - hz_points[:-2])
@@ -665,10 +975,15 @@ def initialize_whisper():
     else:
         print(f"✓ mel_filters.npzが存在します: {mel_filters_path}")
     
+    # ハードウェアに合わせたモデルサイズとスレッド数を決定（結果は保存して再利用）
+    from hardware_calibration import get_calibration
+    calibration = get_calibration(app_cache_dir)
+    print(f"✓ 使用するモデル: {calibration['model_name']}（{calibration['intra_op_threads']}スレッド）")
+    
     # モデルを事前にダウンロード
     try:
         print("Whisperモデルをダウンロード中...")
-        model = whisper.load_model("base", download_root=models_dir)
+        model = whisper.load_model(calibration['model_name'], download_root=models_dir)
         print("✓ モデルのダウンロードが完了しました")
         
         # テスト用の音声データでモデルの動作確認
@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from model_registry import registry_lock
+
+
+class TokenCache:
+    def __init__(self, cache_dir, tokenizer):
+        """
+        テキストのトークンID列をまとめて1つの配列ファイルに保存するキャッシュ
+        キーはテキストの内容から作るため、転記を編集すると自動的に別のエントリになる。
+        Args:
+            cache_dir (str): キャッシュの保存先
+            tokenizer: Whisperのトークナイザ
+        """
+        self.tokenizer = tokenizer
+        name = os.path.splitext(tokenizer.encoding.name)[0]
+        self.array_path = os.path.join(cache_dir, f'tokens_{name}.npy')
+        self.index_path = os.path.join(cache_dir, f'tokens_{name}.json')
+        # 語彙数が65536未満なら2バイトで保存
+        self.dtype = np.uint16 if tokenizer.encoding.n_vocab < 2 ** 16 else np.int32
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._array = np.zeros(0, dtype=self.dtype)
+        self._new = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _read(self):
+        """保存済みの配列とインデックスを読み込む（ないか壊れていればNone）"""
+        if not (os.path.exists(self.array_path) and os.path.exists(self.index_path)):
+            return None
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            # 保存時に置き換えられるよう、メモリマップせずに読み込む（Windowsでは開いたままのファイルを置換できない）
+            array = np.load(self.array_path)
+        except (OSError, ValueError) as e:
+            print(f"トークンキャッシュの読み込みに失敗したため作り直します: {str(e)}")
+            return None
+        entries = {key: tuple(entry) for key, entry in entries.items()}
+        # 配列とインデックスが食い違っていれば使わない
+        if any(offset + length > len(array) for offset, length in entries.values()):
+            print("トークンキャッシュの配列とインデックスが一致しないため作り直します")
+            return None
+        return entries, array.astype(self.dtype, copy=False)
+
+    def _load(self):
+        # 他の学習プロセスが書き込み中の配列とインデックスを読まないよう、ファイルロックを取って読む
+        with registry_lock(self.index_path):
+            stored = self._read()
+        if stored is not None:
+            self._entries, self._array = stored
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def encode(self, text):
+        """テキストのトークンID列（キャッシュになければトークナイズして追加）"""
+        key = self.key(text)
+        if key in self._new:
+            return self._new[key].tolist()
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            offset, length = entry
+            return self._array[offset:offset + length].tolist()
+        self.misses += 1
+        tokens = self.tokenizer.encode(text)
+        self._new[key] = np.asarray(tokens, dtype=self.dtype)
+        return tokens
+
+    def save(self):
+        """追加したエントリを配列ファイルに書き込む"""
+        if not self._new:
+            return
+        # 並行して学習する他のプロセスと同じキャッシュを共有するため、ファイルロックを取ってから
+        # 保存済みの内容を読み直し、そこへ自分の追加分を加える（他のジョブが追加したエントリを消さない）
+        with registry_lock(self.index_path):
+            stored = self._read()
+            entries, array = stored if stored is not None else ({}, np.zeros(0, dtype=self.dtype))
+            entries = dict(entries)
+            arrays = [array] if len(array) else []
+            offset = len(array)
+            for key, tokens in self._new.items():
+                if key in entries:
+                    continue
+                entries[key] = (offset, len(tokens))
+                arrays.append(tokens)
+                offset += len(tokens)
+            array = np.concatenate(arrays).astype(self.dtype) if arrays else np.zeros(0, dtype=self.dtype)
+
+            # 書き込み途中で中断されても既存のキャッシュが壊れないよう、一時ファイルから置き換える
+            suffix = f'.{os.getpid()}.tmp'
+            with open(self.array_path + suffix, 'wb') as f:
+                np.save(f, array)
+            with open(self.index_path + suffix, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(self.array_path + suffix, self.array_path)
+            os.replace(self.index_path + suffix, self.index_path)
+
+        self._entries = entries
+        self._array = array
+        self._new = {}
@@ -0,0 +1,151 @@
+import sys
+import time
+import torch
+
+from training_checkpoint import epoch_batches
+
+# 長さで並べ替える単位（バッチサイズの何倍の範囲で並べ替えるか）
+BUCKET_MULTIPLIER = 50
+
+
+def bucket_batches(token_lengths, batch_size, seed, epoch, max_tokens=None, durations=None,
+                   bucket_multiplier=BUCKET_MULTIPLIER):
+    """
+    トークン数の近いサンプルをまとめたバッチを作成（seedとエポック番号から決定的に作成）
+    エポックごとにランダムに並べた後、batch_size × bucket_multiplier 件ずつの範囲でトークン数
+    （同じ場合は音声の長さ）の順に並べ替えてバッチに分け、最後にバッチの順番をシャッフルする。
+    Args:
+        token_lengths (list): 各サンプルのトークン数
+        batch_size (int): 1バッチの最大サンプル数
+        seed (int): 乱数シード
+        epoch (int): エポック番号
+        max_tokens (int): 1バッチのパディング込みトークン数の上限（Noneなら件数のみで区切る）
+        durations (list): 各サンプルの音声の長さ（秒、並べ替えの第2キー）
+    Returns:
+        list: サンプル番号のリストのリスト
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed + epoch)
+    order = torch.randperm(len(token_lengths), generator=generator).tolist()
+    bucket_size = batch_size * bucket_multiplier
+
+    def sort_key(index):
+        return token_lengths[index], durations[index] if durations else 0.0
+
+    batches = []
+    for start in range(0, len(order), bucket_size):
+        current = []
+        longest = 0
+        for index in sorted(order[start:start + bucket_size], key=sort_key):
+            length = max(longest, token_lengths[index])
+            if current and (len(current) >= batch_size
+                            or (max_tokens and length * (len(current) + 1) > max_tokens)):
+                batches.append(current)
+                current = []
+                length = token_lengths[index]
+            current.append(index)
+            longest = length
+        if current:
+            batches.append(current)
+
+    shuffled = torch.randperm(len(batches), generator=generator).tolist()
+    return [batches[index] for index in shuffled]
+
+
+def padding_ratio(batches, token_lengths):
+    """パディングが占める割合（パディング込みのトークン数に対する比率）"""
+    padded = sum(len(batch) * max(token_lengths[index] for index in batch) for batch in batches)
+    real = sum(token_lengths[index] for batch in batches for index in batch)
+    return 1.0 - real / padded if padded else 0.0
+
+
+def collate_windows(windows, mels):
+    """
+    窓のログメルとトークン列をパディングしてバッチにまとめる
+    Args:
+        windows (list): 学習用の窓（'tokens' を含む）
+        mels (list): 各窓のログメル（n_mels, 3000）
+    Returns:
+        tuple: (mel (B, n_mels, 3000), デコーダ入力 (B, L), 正解 (B, L、パディングは-100))
+    """
+    length = max(len(window['tokens']) for window in windows) - 1
+    inputs = torch.zeros(len(windows), length, dtype=torch.long)
+    targets = torch.full((len(windows), length), -100, dtype=torch.long)
+    for row, window in enumerate(windows):
+        tokens = torch.tensor(window['tokens'], dtype=torch.long)
+        inputs[row, :len(tokens) - 1] = tokens[:-1]
+        targets[row, :len(tokens) - 1] = tokens[1:]
+    return torch.stack(mels), inputs, targets
+
+
+def window_losses(model, mel, inputs, targets):
+    """
+    バッチの順伝播を行い、窓ごとの平均損失を計算
+    デコーダは因果マスクを使うため、末尾のパディングは実際のトークンの出力に影響しない。
+    Returns:
+        torch.Tensor: 窓ごとの損失 (B,)
+    """
+    encoder_output = model.encoder(mel)
+    logits = model.decoder(inputs, encoder_output)
+    token_losses = torch.nn.functional.cross_entropy(
+        logits.transpose(1, 2), targets, ignore_index=-100, reduction='none')
+    return token_losses.sum(dim=1) / (targets != -100).sum(dim=1)
+
+
+def benchmark_bucketing(model, windows, mels, batch_size=4, max_tokens=None, seed=0, max_steps=20):
+    """
+    ランダムなバッチと長さでまとめたバッチで、パディング率と1ステップ（順伝播+逆伝播）の時間を比較
+    Returns:
+        dict: {'random': {...}, 'bucketed': {...}}
+    """
+    token_lengths = [len(window['tokens']) for window in windows]
+    plans = {
+        'random': epoch_batches(len(windows), batch_size, seed, 0),
+        'bucketed': bucket_batches(token_lengths, batch_size, seed, 0, max_tokens),
+    }
+    model.train()
+    report = {}
+    for name, batches in plans.items():
+        elapsed = 0.0
+        measured = batches[:max_steps]
+        for batch in measured:
+            mel, inputs, targets = collate_windows([windows[i] for i in batch], [mels[i] for i in batch])
+            start_time = time.perf_counter()
+            window_losses(model, mel.to(model.device), inputs.to(model.device), targets.to(model.device)).sum().backward()
+            elapsed += time.perf_counter() - start_time
+            model.zero_grad(set_to_none=True)
+        samples = sum(len(batch) for batch in measured)
+        report[name] = {
+            'batches': len(batches),
+            'padding_ratio': padding_ratio(batches, token_lengths),
+            'seconds_per_sample': elapsed / samples if samples else 0.0,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    # 使い方: python training_batches.py <データセットのディレクトリ> [バッチサイズ] [最大トークン数]
+    import whisper
+    from whisper.tokenizer import get_tokenizer
+    from PersonalizedSR import AudioTextDataset, get_runtime_config, MODELS_DIR
+    from training_windows import build_training_windows
+    from mel_features import batch_log_mel_spectrogram, load_window_audio
+
+    if len(sys.argv) < 2:
+        print("使い方: python training_batches.py <データセットのディレクトリ> [バッチサイズ] [最大トークン数]")
+        sys.exit(1)
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    max_tokens = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    model = whisper.load_model(get_runtime_config()['model_name'], download_root=MODELS_DIR)
+    tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                              language="ja", task="transcribe")
+    windows, _ = build_training_windows(AudioTextDataset(sys.argv[1]).samples, tokenizer,
+                                        model.dims.n_text_ctx - len(tokenizer.sot_sequence))
+    mels = list(batch_log_mel_spectrogram([load_window_audio(window['pieces']) for window in windows],
+                                          n_mels=model.dims.n_mels))
+    report = benchmark_bucketing(model, windows, mels, batch_size, max_tokens)
+    print("=== バッチ構成の比較 ===")
+    for name, label in [('random', "ランダム"), ('bucketed', "トークン数でまとめる")]:
+        result = report[name]
+        print(f"- {label}: {result['batches']}バッチ、パディング率 {result['padding_ratio'] * 100:.1f}%、"
+              f"1サンプルあたり {result['seconds_per_sample'] * 1000:.0f}ms")
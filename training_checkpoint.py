@@ -0,0 +1,200 @@
+import os
+import re
+import json
+import time
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+CHECKPOINT_SUBDIR = 'checkpoints'
+CHECKPOINT_PATTERN = re.compile(r'^checkpoint_(\d+)\.pt$')
+DEFAULT_KEEP_CHECKPOINTS = 3
+DEFAULT_CHECKPOINT_MINUTES = 10.0
+
+
+def capture_rng_state():
+    """Python・NumPy・PyTorchの乱数状態を取得"""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    """capture_rng_stateで取得した乱数状態を復元"""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def to_cpu(obj):
+    """state_dict内のテンソルをCPUにコピー（学習を続けても書き込み中の内容が変わらないようにする）"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def epoch_batches(num_samples, batch_size, seed, epoch):
+    """
+    エポックのバッチ構成（サンプル番号のリスト）をseedとエポック番号から決定的に作成
+    中断したエポックを同じ並び順で途中のバッチから再開するために使う。
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed + epoch)
+    order = torch.randperm(num_samples, generator=generator).tolist()
+    return [order[start:start + batch_size] for start in range(0, num_samples, batch_size)]
+
+
+def list_checkpoints(checkpoint_dir):
+    """チェックポイントを古い順に列挙"""
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(checkpoint_dir):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            checkpoints.append((int(match.group(1)), os.path.join(checkpoint_dir, name)))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def find_latest_checkpoint(path):
+    """
+    再開に使うチェックポイントを取得
+    Args:
+        path (str): チェックポイントファイル、またはモデルの保存先ディレクトリ
+    Returns:
+        str: チェックポイントファイルのパス（見つからなければNone）
+    """
+    if os.path.isfile(path):
+        return path
+    checkpoints = list_checkpoints(os.path.join(path, CHECKPOINT_SUBDIR))
+    return checkpoints[-1] if checkpoints else None
+
+
+def find_resumable_run(finetuned_dir):
+    """学習が完了していない（チェックポイントが残っている）最新の保存先ディレクトリを取得"""
+    if not os.path.isdir(finetuned_dir):
+        return None
+    for name in sorted(os.listdir(finetuned_dir), reverse=True):
+        run_dir = os.path.join(finetuned_dir, name)
+        info_path = os.path.join(run_dir, 'training_info.json')
+        if os.path.exists(info_path):
+            with open(info_path, 'r', encoding='utf-8') as f:
+                if json.load(f).get('training_completed'):
+                    continue
+        if find_latest_checkpoint(run_dir):
+            return run_dir
+    return None
+
+
+class CheckpointPolicy:
+    def __init__(self, every_steps=None, every_minutes=DEFAULT_CHECKPOINT_MINUTES):
+        """
+        チェックポイントを保存するタイミング（ステップ数または経過時間のどちらかを満たしたとき）
+        Args:
+            every_steps (int): 保存間隔（ステップ数、Noneなら使わない）
+            every_minutes (float): 保存間隔（分、Noneなら使わない）
+        """
+        self.every_steps = every_steps
+        self.every_seconds = every_minutes * 60 if every_minutes else None
+        self._last_time = time.monotonic()
+
+    def should_save(self, step):
+        if self.every_steps and step % self.every_steps == 0:
+            return True
+        return bool(self.every_seconds) and time.monotonic() - self._last_time >= self.every_seconds
+
+    def saved(self):
+        self._last_time = time.monotonic()
+
+
+class CheckpointWriter:
+    def __init__(self, checkpoint_dir, keep_last=DEFAULT_KEEP_CHECKPOINTS):
+        """
+        CPUにコピーしたスナップショットをバックグラウンドスレッドでディスクに書き込む
+        書き込み中に次の保存が要求された場合は、前の書き込みが終わるまで待つ。
+        Args:
+            checkpoint_dir (str): 保存先
+            keep_last (int): 残すチェックポイントの数
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.write_seconds = 0.0
+        self.snapshot_seconds = 0.0
+        self.last_bytes = None
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def save(self, step, state, wait=False):
+        """
+        スナップショットを取り、書き込みを依頼
+        Args:
+            step (int): 学習ステップ（ファイル名に使用）
+            state (dict): 保存する内容（テンソルはCPUにコピーされる）
+            wait (bool): 書き込み完了まで待つ
+        """
+        self._raise_error()
+        start_time = time.perf_counter()
+        snapshot = to_cpu(state)
+        self.snapshot_seconds += time.perf_counter() - start_time
+        self._queue.put((step, snapshot))
+        if wait:
+            self.flush()
+
+    def flush(self):
+        """依頼済みの書き込みがすべて終わるまで待つ"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """書き込みを終えてスレッドを停止"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"チェックポイントの保存に失敗: {str(error)}")
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                step, snapshot = item
+                start_time = time.perf_counter()
+                path = os.path.join(self.checkpoint_dir, f'checkpoint_{step:08d}.pt')
+                # 書き込み途中で中断されても壊れたファイルが残らないよう、一時ファイルから置き換える
+                temp_path = path + '.tmp'
+                torch.save(snapshot, temp_path)
+                os.replace(temp_path, path)
+                self.last_bytes = os.path.getsize(path)
+                self._rotate()
+                self.write_seconds += time.perf_counter() - start_time
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _rotate(self):
+        """古いチェックポイントを削除して直近keep_last個だけを残す"""
+        checkpoints = list_checkpoints(self.checkpoint_dir)
+        for path in checkpoints[:-self.keep_last] if self.keep_last else []:
+            os.remove(path)
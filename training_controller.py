@@ -0,0 +1,122 @@
+import math
+import torch
+import whisper
+
+from evaluation import character_error_rate
+from repetition_guard import repetition_guard
+
+LR_SCHEDULES = ('cosine', 'linear', 'constant')
+DEFAULT_LR_SCHEDULE = 'cosine'
+DEFAULT_VALIDATION_SPLIT = 0.1
+DEFAULT_WARMUP_RATIO = 0.1
+DEFAULT_PATIENCE = 3
+VALIDATION_BATCH_SIZE = 8
+
+
+def split_dataset(num_samples, validation_split=DEFAULT_VALIDATION_SPLIT, seed=0):
+    """
+    データセットを学習用と検証用に分割（seedが同じなら同じ分割になる）
+    サンプルが2件未満、またはvalidation_splitが0の場合は検証用を作らない。
+    Returns:
+        tuple: (学習用のサンプル番号, 検証用のサンプル番号)
+    """
+    if num_samples < 2 or not validation_split:
+        return list(range(num_samples)), []
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    order = torch.randperm(num_samples, generator=generator).tolist()
+    num_validation = min(num_samples - 1, max(1, round(num_samples * validation_split)))
+    return sorted(order[num_validation:]), sorted(order[:num_validation])
+
+
+def lr_lambda(total_steps, warmup_steps, schedule=DEFAULT_LR_SCHEDULE):
+    """
+    LambdaLR用の学習率倍率（ウォームアップ後にcosine/linearで0まで減衰）
+    Args:
+        total_steps (int): オプティマイザの総ステップ数
+        warmup_steps (int): ウォームアップのステップ数
+        schedule (str): 'cosine' / 'linear' / 'constant'
+    """
+    if schedule not in LR_SCHEDULES:
+        raise ValueError(f"不明な学習率スケジュールです: {schedule}（{', '.join(LR_SCHEDULES)}）")
+
+    def factor(step):
+        if step < warmup_steps:
+            return (step + 1) / warmup_steps
+        if schedule == 'constant':
+            return 1.0
+        progress = min(1.0, (step - warmup_steps) / max(1, total_steps - warmup_steps))
+        if schedule == 'linear':
+            return 1.0 - progress
+        return 0.5 * (1.0 + math.cos(math.pi * progress))
+
+    return factor
+
+
+class EarlyStopping:
+    def __init__(self, patience=DEFAULT_PATIENCE, min_delta=0.0):
+        """
+        検証CERが改善しなくなったら学習を止める
+        Args:
+            patience (int): 改善がないまま続ける評価回数（Noneなら止めない）
+            min_delta (float): 改善とみなす最小の減少幅
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.best_step = None
+        self.bad_evaluations = 0
+
+    def update(self, metric, step):
+        """
+        評価結果を記録
+        Returns:
+            bool: 最良値を更新した場合True
+        """
+        if self.best is None or metric < self.best - self.min_delta:
+            self.best = metric
+            self.best_step = step
+            self.bad_evaluations = 0
+            return True
+        self.bad_evaluations += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.patience is not None and self.bad_evaluations >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'best_step': self.best_step, 'bad_evaluations': self.bad_evaluations}
+
+    def load_state_dict(self, state):
+        self.best = state['best']
+        self.best_step = state['best_step']
+        self.bad_evaluations = state['bad_evaluations']
+
+
+@torch.no_grad()
+def evaluate_cer(model, mels, references, batch_size=VALIDATION_BATCH_SIZE):
+    """
+    検証用サンプルを貪欲法でデコードし、平均CERを計算
+    Args:
+        model: Whisperモデル
+        mels (list): 各サンプルのログメル（n_mels, 3000）
+        references (list): 正解テキスト
+    Returns:
+        float: 平均CER
+    """
+    was_training = model.training
+    model.eval()
+    options = whisper.DecodingOptions(language="ja", task="transcribe", fp16=False, without_timestamps=True)
+    errors = []
+    try:
+        # 繰り返しに陥った出力で評価が長引かないよう、検出したら打ち切る
+        with repetition_guard('skip'):
+            for start in range(0, len(mels), batch_size):
+                batch = torch.stack(mels[start:start + batch_size]).to(model.device)
+                results = model.decode(batch, options)
+                for result, reference in zip(results, references[start:start + batch_size]):
+                    errors.append(character_error_rate(reference, result.text))
+    finally:
+        model.train(was_training)
+    return sum(errors) / len(errors) if errors else 0.0
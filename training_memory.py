@@ -0,0 +1,340 @@
+import os
+import sys
+import time
+import tempfile
+import contextlib
+import multiprocessing as mp
+import torch
+import torch.utils.checkpoint
+
+OPTIMIZERS = ('adamw', 'adafactor')
+DEFAULT_OPTIMIZER = 'adamw'
+PRECISIONS = ('fp32', 'bf16')
+DEFAULT_PRECISION = 'fp32'
+
+# 学習対象として指定できるパラメータのグループ（パラメータ名の接頭辞）
+PARAMETER_GROUPS = {
+    'encoder': ('encoder.',),
+    'decoder': ('decoder.',),
+    'token_embedding': ('decoder.token_embedding.', 'decoder.positional_embedding'),
+    'decoder_ln': ('decoder.ln.',),
+    'encoder_ln': ('encoder.ln_post.',),
+}
+
+
+def select_trainable_parameters(model, train_decoder_blocks=None, parameter_groups=None):
+    """
+    学習するパラメータを選び、それ以外を凍結する
+    どちらも指定しない場合はすべてのパラメータを学習する。
+    凍結した部分は勾配もオプティマイザの状態も持たず、エンコーダを凍結すれば活性化も保持しない。
+    Args:
+        model: Whisperモデル
+        train_decoder_blocks (int): 学習するデコーダブロックの数（上位から数える、最終層のLayerNormも含む）
+        parameter_groups (list): 学習するパラメータのグループ名（PARAMETER_GROUPSのキー）
+    Returns:
+        list: 学習するパラメータ
+    """
+    prefixes = trainable_prefixes(model, train_decoder_blocks, parameter_groups)
+    if prefixes is None:
+        for parameter in model.parameters():
+            parameter.requires_grad_(True)
+        return list(model.parameters())
+
+    trainable = []
+    for name, parameter in model.named_parameters():
+        selected = name.startswith(prefixes)
+        parameter.requires_grad_(selected)
+        if selected:
+            trainable.append(parameter)
+    if not trainable:
+        raise ValueError("学習するパラメータがありません")
+    return trainable
+
+
+def trainable_prefixes(model, train_decoder_blocks=None, parameter_groups=None):
+    """学習するパラメータ名の接頭辞（すべて学習する場合はNone）"""
+    if train_decoder_blocks is None and not parameter_groups:
+        return None
+    prefixes = []
+    for group in parameter_groups or []:
+        if group not in PARAMETER_GROUPS:
+            raise ValueError(f"不明なパラメータグループです: {group}（{', '.join(PARAMETER_GROUPS)}）")
+        prefixes.extend(PARAMETER_GROUPS[group])
+    if train_decoder_blocks:
+        num_blocks = len(model.decoder.blocks)
+        if not 0 < train_decoder_blocks <= num_blocks:
+            raise ValueError(f"学習するデコーダブロックの数は1〜{num_blocks}で指定してください: {train_decoder_blocks}")
+        prefixes.extend(f'decoder.blocks.{index}.' for index in range(num_blocks - train_decoder_blocks, num_blocks))
+        prefixes.append('decoder.ln.')
+    return tuple(prefixes)
+
+
+def share_frozen_weights(model, shared_model):
+    """
+    凍結したパラメータのうち値が同じものを、常駐している共有モデルの重みに置き換えてメモリを節約する
+    凍結したパラメータはオプティマイザが更新しないため、複数の学習ジョブで同じテンソルを参照できる。
+    Returns:
+        int: 共有したパラメータ数
+    """
+    shared_parameters = dict(shared_model.named_parameters())
+    num_shared = 0
+    for name, parameter in model.named_parameters():
+        shared = shared_parameters.get(name)
+        if (parameter.requires_grad or shared is None or shared.device != parameter.device
+                or shared.dtype != parameter.dtype or not torch.equal(shared.data, parameter.data)):
+            continue
+        parameter.data = shared.data
+        num_shared += parameter.numel()
+    return num_shared
+
+
+def build_optimizer(parameters, name=DEFAULT_OPTIMIZER, learning_rate=1e-5):
+    """
+    オプティマイザを作成
+    'adafactor' は2次モーメントを行・列の平均に分解して保持するため、AdamW（パラメータ2つ分）より状態が小さい。
+    PyTorchのAdafactor（2.5以降）を使い、ない場合はtransformersのAdafactorを使う。
+    """
+    if name not in OPTIMIZERS:
+        raise ValueError(f"不明なオプティマイザです: {name}（{', '.join(OPTIMIZERS)}）")
+    if name == 'adamw':
+        return torch.optim.AdamW(parameters, lr=learning_rate)
+    if hasattr(torch.optim, 'Adafactor'):
+        return torch.optim.Adafactor(parameters, lr=learning_rate)
+    try:
+        from transformers.optimization import Adafactor
+    except ImportError:
+        raise RuntimeError("Adafactorを使うにはPyTorch 2.5以降、またはtransformersが必要です")
+    # 学習率はスケジューラで制御するため、Adafactor独自の相対ステップ幅は使わない
+    return Adafactor(parameters, lr=learning_rate, scale_parameter=False, relative_step=False, warmup_init=False)
+
+
+def autocast_context(device, precision=DEFAULT_PRECISION):
+    """
+    順伝播を行う範囲のautocast（'bf16' ならbfloat16で計算し、重みと勾配はfp32のまま保持する）
+    bfloat16は指数部がfp32と同じ幅のため、fp16のような損失スケーリングは不要。
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"不明な精度です: {precision}（{', '.join(PRECISIONS)}）")
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device, dtype=torch.bfloat16)
+
+
+def enable_gradient_checkpointing(model):
+    """
+    エンコーダ・デコーダの各残差ブロックの活性化を保持せず、逆伝播時に再計算する
+    学習中（勾配を計算し、KVキャッシュを使わない呼び出し）だけ有効で、推論には影響しない。
+    重みの名前は変わらないため、保存・読み込みはそのまま行える。
+    """
+    for block in list(model.encoder.blocks) + list(model.decoder.blocks):
+        if 'forward' in block.__dict__:
+            continue
+
+        def checkpointed(x, xa=None, mask=None, kv_cache=None, block=block):
+            forward = type(block).forward
+            if kv_cache is not None or not block.training or not torch.is_grad_enabled():
+                return forward(block, x, xa, mask, kv_cache)
+            return torch.utils.checkpoint.checkpoint(forward, block, x, xa, mask, None, use_reentrant=False)
+
+        block.forward = checkpointed
+
+
+def disable_gradient_checkpointing(model):
+    for block in list(model.encoder.blocks) + list(model.decoder.blocks):
+        block.__dict__.pop('forward', None)
+
+
+# エンコーダの1ブロック・1窓あたりに保持する活性化の量（状態の次元 × 系列長に対する倍率、実測からの概算）
+ACTIVATION_FACTOR = 24
+
+
+def estimate_training_bytes(model, batch_size, optimizer_name=DEFAULT_OPTIMIZER, train_decoder_blocks=None,
+                            parameter_groups=None, precision=DEFAULT_PRECISION, gradient_checkpointing=False,
+                            shared_frozen=False):
+    """
+    学習ジョブのメモリ使用量の見込み（スケジューラでの同時実行数の判断に使う概算）
+    Args:
+        model: Whisperモデル（パラメータ数と次元の取得にだけ使う）
+        shared_frozen (bool): 凍結したパラメータを共有モデルと共有する場合True（重みを数えない）
+    Returns:
+        int: バイト数
+    """
+    prefixes = trainable_prefixes(model, train_decoder_blocks, parameter_groups)
+    num_parameters = count_parameters(model.parameters())
+    num_trainable = num_parameters if prefixes is None else sum(
+        parameter.numel() for name, parameter in model.named_parameters() if name.startswith(prefixes))
+    weights = (num_trainable if shared_frozen else num_parameters) * 4
+    # 勾配とオプティマイザの状態（AdamWは1次・2次モーメントの2つ、Adafactorは分解した小さな状態だけ）
+    optimizer_factor = 2 if optimizer_name == 'adamw' else 0
+    training_state = num_trainable * 4 * (1 + optimizer_factor)
+    dims = model.dims
+    activation_bytes = 2 if precision == 'bf16' else 4
+    layers = 1 if gradient_checkpointing else dims.n_audio_layer
+    # エンコーダを凍結した場合、エンコーダの活性化は保持しない
+    encoder_trained = prefixes is None or any(prefix.startswith('encoder.') for prefix in prefixes)
+    activations = (batch_size * layers * dims.n_audio_ctx * dims.n_audio_state * ACTIVATION_FACTOR
+                   * activation_bytes) if encoder_trained else 0
+    return weights + training_state + activations
+
+
+def count_parameters(parameters):
+    return sum(parameter.numel() for parameter in parameters)
+
+
+def optimizer_state_bytes(optimizer):
+    """オプティマイザの状態（モーメントなど）が使うメモリ量（バイト）"""
+    return sum(value.numel() * value.element_size()
+               for state in optimizer.state.values() for value in state.values()
+               if isinstance(value, torch.Tensor))
+
+
+def peak_rss_bytes():
+    """このプロセスの最大常駐メモリ量（バイト、取得できなければNone）"""
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _measure_option(model_name, option, steps, batch_size, seed, results):
+    """1つの設定で学習ステップを実行し、メモリ使用量・ステップ時間・損失・保存サイズを測定（別プロセスで実行する）"""
+    from hardware_calibration import build_dummy_model
+    from training_batches import window_losses
+
+    torch.manual_seed(seed)
+    model = build_dummy_model(model_name, 'cpu').train()
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    baseline_rss = peak_rss_bytes()
+    parameters = select_trainable_parameters(model, option.get('train_decoder_blocks'), option.get('parameter_groups'))
+    optimizer = build_optimizer(parameters, option.get('optimizer_name', DEFAULT_OPTIMIZER), option.get('learning_rate', 1e-3))
+    if option.get('gradient_checkpointing'):
+        enable_gradient_checkpointing(model)
+    mel = torch.randn(batch_size, model.dims.n_mels, 3000, generator=generator)
+    tokens = torch.randint(0, 50000, (batch_size, 101), generator=generator)
+    losses = []
+    elapsed = 0.0
+    for _ in range(steps):
+        start_time = time.perf_counter()
+        with autocast_context('cpu', option.get('precision', DEFAULT_PRECISION)):
+            loss = window_losses(model, mel, tokens[:, :-1], tokens[:, 1:]).mean()
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        elapsed += time.perf_counter() - start_time
+        losses.append(loss.item())
+
+    sizes = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for key, state in [('model_file_bytes', {'model_state_dict': model.state_dict(), 'dims': model.dims}),
+                           ('checkpoint_bytes', {'model_state_dict': model.state_dict(), 'dims': model.dims,
+                                                 'optimizer_state_dict': optimizer.state_dict()})]:
+            path = os.path.join(temp_dir, f'{key}.pt')
+            torch.save(state, path)
+            sizes[key] = os.path.getsize(path)
+    results.put({
+        'trainable_parameters': count_parameters(parameters),
+        'total_parameters': count_parameters(model.parameters()),
+        'optimizer_state_bytes': optimizer_state_bytes(optimizer),
+        'baseline_rss_bytes': baseline_rss,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'seconds_per_step': elapsed / steps if steps else 0.0,
+        'losses': losses,
+        **sizes,
+    })
+
+
+def benchmark_memory(model_name='base', options=None, steps=2, batch_size=2, seed=0):
+    """
+    学習設定ごとのピークメモリ・ステップ時間・損失・保存サイズを比較
+    最大常駐メモリはプロセス単位でしか取れないため、設定ごとに別プロセスで測定する。
+    Args:
+        model_name (str): モデルサイズ（重みはseedから作るランダムな値）
+        options (list): fine_tune_modelと同じ名前の設定（optimizer_name, train_decoder_blocks, parameter_groups,
+                        precision, gradient_checkpointing, learning_rate）の辞書のリスト
+    Returns:
+        list: 設定ごとの測定結果
+    """
+    if options is None:
+        options = [{'optimizer_name': 'adamw'}, {'optimizer_name': 'adafactor'},
+                   {'optimizer_name': 'adamw', 'train_decoder_blocks': 2},
+                   {'optimizer_name': 'adafactor', 'train_decoder_blocks': 2}]
+    context = mp.get_context('spawn')
+    report = []
+    for option in options:
+        results = context.Queue()
+        process = context.Process(target=_measure_option,
+                                  args=(model_name, option, steps, batch_size, seed, results))
+        process.start()
+        result = results.get()
+        process.join()
+        report.append({**option, **result})
+    return report
+
+
+def option_label(option):
+    """測定結果の表示名"""
+    parts = [option.get('optimizer_name', DEFAULT_OPTIMIZER)]
+    if option.get('train_decoder_blocks'):
+        parts.append(f"上位{option['train_decoder_blocks']}ブロック")
+    parts.append(option.get('precision', DEFAULT_PRECISION))
+    if option.get('gradient_checkpointing'):
+        parts.append("勾配チェックポイント")
+    return ' / '.join(parts)
+
+
+if __name__ == "__main__":
+    # 使い方: python training_memory.py [モデルサイズ] [学習するデコーダブロック数]
+    #         python training_memory.py --precision [モデルサイズ] [ステップ数]
+    if len(sys.argv) > 1 and sys.argv[1] == '--precision':
+        # fp32とbf16、勾配チェックポイントの有無を同じ初期値・同じデータで比較
+        model_name = sys.argv[2] if len(sys.argv) > 2 else 'base'
+        steps = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+        options = [{'precision': precision, 'gradient_checkpointing': checkpointing}
+                   for precision in PRECISIONS for checkpointing in (False, True)]
+        print(f"=== 精度と勾配チェックポイントの比較（{model_name}、{steps}ステップ） ===")
+        report = benchmark_memory(model_name, options, steps)
+        reference = report[0]
+        for result in report:
+            peak = result['peak_rss_bytes']
+            peak_text = f"{peak / 2 ** 20:.0f}MB" if peak else "取得不可"
+            print(f"- {option_label(result)}: 1ステップ {result['seconds_per_step']:.2f}秒"
+                  f"（fp32比 {result['seconds_per_step'] / reference['seconds_per_step']:.2f}倍）、"
+                  f"ピークメモリ {peak_text}、最終損失 {result['losses'][-1]:.4f}"
+                  f"（fp32との差 {result['losses'][-1] - reference['losses'][-1]:+.4f}）")
+        sys.exit(0)
+
+    model_name = sys.argv[1] if len(sys.argv) > 1 else 'base'
+    blocks = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    options = [{'optimizer_name': 'adamw'}, {'optimizer_name': 'adafactor'},
+               {'optimizer_name': 'adamw', 'train_decoder_blocks': blocks},
+               {'optimizer_name': 'adafactor', 'train_decoder_blocks': blocks}]
+    print(f"=== 学習設定ごとのメモリ使用量（{model_name}） ===")
+    for result in benchmark_memory(model_name, options):
+        peak = result['peak_rss_bytes']
+        peak_text = f"{peak / 2 ** 20:.0f}MB" if peak else "取得不可"
+        print(f"- {option_label(result)}: "
+              f"学習パラメータ {result['trainable_parameters'] / 1e6:.1f}M / {result['total_parameters'] / 1e6:.1f}M、"
+              f"オプティマイザ状態 {result['optimizer_state_bytes'] / 2 ** 20:.0f}MB、ピークメモリ {peak_text}、"
+              f"model.pt {result['model_file_bytes'] / 2 ** 20:.0f}MB"
+              f"（オプティマイザ状態込み {result['checkpoint_bytes'] / 2 ** 20:.0f}MB）")
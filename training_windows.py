@@ -0,0 +1,216 @@
+import os
+import json
+import difflib
+import soundfile as sf
+
+from dataset_audio import load_dataset_audio, SAMPLE_RATE
+from evaluation import normalize_text
+
+WINDOW_SECONDS = 30.0
+TIME_PRECISION = 0.02
+# 編集された転記をセグメントの時刻に割り当てるのに必要な、認識結果との文字の一致率
+MIN_ALIGNMENT_RATIO = 0.6
+
+
+def audio_duration(audio_path):
+    """音声の長さ（秒）。ヘッダから取得できない形式はデコードして求める"""
+    try:
+        return sf.info(audio_path).duration
+    except RuntimeError:
+        return len(load_dataset_audio(audio_path)) / SAMPLE_RATE
+
+
+def load_segments(sample_dir):
+    """データセットのtranscript.jsonに保存されたタイムスタンプ付きセグメント（なければNone）"""
+    transcript_json = os.path.join(sample_dir, 'transcript.json')
+    if not os.path.exists(transcript_json):
+        return None
+    with open(transcript_json, 'r', encoding='utf-8') as f:
+        return json.load(f).get('segments')
+
+
+def align_segments(segments, transcript, min_ratio=MIN_ALIGNMENT_RATIO):
+    """
+    編集された転記テキストを保存済みのセグメントの時刻に割り当てる
+    セグメントのテキストを連結した認識結果と転記を文字単位で対応付け、セグメントの境界を転記上の位置に移す。
+    Returns:
+        list: テキストを転記の対応部分に置き換えたセグメント（一致率がmin_ratio未満ならNone）
+    """
+    original = ''.join(segment['text'] for segment in segments)
+    matcher = difflib.SequenceMatcher(None, original, transcript, autojunk=False)
+    if matcher.ratio() < min_ratio:
+        return None
+    # 認識結果の各位置に対応する転記上の位置（置換された範囲は長さの比で按分）
+    mapping = [0] * (len(original) + 1)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        for i in range(i1, i2):
+            mapping[i] = j1 + (i - i1 if tag == 'equal' else (i - i1) * (j2 - j1) // (i2 - i1))
+    mapping[len(original)] = len(transcript)
+    aligned = []
+    position = 0
+    for segment in segments:
+        start, end = mapping[position], mapping[position + len(segment['text'])]
+        aligned.append({'start': segment['start'], 'end': segment['end'], 'text': transcript[start:end]})
+        position += len(segment['text'])
+    return aligned
+
+
+def sample_utterances(audio_path, transcript, segments, max_seconds=WINDOW_SECONDS):
+    """
+    1件の録音を30秒以内の発話に分割
+    30秒を超える録音は、保存済みのセグメントの境界で分割する。転記が編集されている場合は、
+    認識結果と文字単位で対応付けてセグメントに割り当てる。セグメントがない、または対応付けられない
+    場合は従来どおり先頭30秒だけを使う。
+    Returns:
+        list: {'audio', 'start', 'end', 'segments': [(開始, 終了, テキスト)], 'aligned'} のリスト
+              （segmentsの時刻は発話の開始からの相対時刻）
+    """
+    duration = audio_duration(audio_path)
+    if duration <= max_seconds:
+        return [{'audio': audio_path, 'start': 0.0, 'end': duration,
+                 'segments': [(0.0, duration, transcript)], 'aligned': True}]
+
+    if segments and normalize_text(''.join(s['text'] for s in segments)) != normalize_text(transcript):
+        segments = align_segments(segments, transcript)
+    if not segments:
+        print(f"警告: {audio_path} は30秒を超えていますが、セグメントと転記を対応付けられないため"
+              f"先頭{max_seconds:.0f}秒だけを使います")
+        return [{'audio': audio_path, 'start': 0.0, 'end': max_seconds,
+                 'segments': [(0.0, max_seconds, transcript)], 'aligned': False}]
+
+    utterances = []
+    current = []
+
+    def flush():
+        start = current[0]['start']
+        utterances.append({
+            'audio': audio_path,
+            'start': start,
+            'end': current[-1]['end'],
+            'segments': [(s['start'] - start, s['end'] - start, s['text'].strip()) for s in current],
+            'aligned': True,
+        })
+
+    for segment in segments:
+        if segment['end'] - segment['start'] > max_seconds or not segment['text'].strip():
+            continue
+        if current and segment['end'] - current[0]['start'] > max_seconds:
+            flush()
+            current = []
+        current.append(segment)
+    if current:
+        flush()
+    return utterances
+
+
+def timestamp_token(tokenizer, seconds):
+    """秒をタイムスタンプトークンに変換（0.02秒単位、最大30秒）"""
+    return tokenizer.timestamp_begin + min(int(WINDOW_SECONDS / TIME_PRECISION), round(seconds / TIME_PRECISION))
+
+
+def utterance_token_count(encode, utterance):
+    """発話を窓に入れたときのトークン数（セグメントごとに開始・終了のタイムスタンプを含む）"""
+    return sum(len(encode(text)) + 2 for _, _, text in utterance['segments'])
+
+
+def pack_utterances(utterances, token_counts, max_seconds=WINDOW_SECONDS, max_tokens=440):
+    """
+    発話を長さの降順に、収まる最初の窓へ詰める（First Fit Decreasing）
+    Returns:
+        list: 各窓に入る発話の番号のリスト
+    """
+    order = sorted(range(len(utterances)), key=lambda i: -(utterances[i]['end'] - utterances[i]['start']))
+    bins = []
+    for index in order:
+        utterance = utterances[index]
+        seconds = utterance['end'] - utterance['start']
+        if token_counts[index] > max_tokens:
+            print(f"警告: トークン数が多すぎる発話を除外します: {utterance['audio']}")
+            continue
+        for packed in bins:
+            if (utterance['aligned'] and packed['aligned'] and packed['seconds'] + seconds <= max_seconds
+                    and packed['tokens'] + token_counts[index] <= max_tokens):
+                packed['items'].append(index)
+                packed['seconds'] += seconds
+                packed['tokens'] += token_counts[index]
+                break
+        else:
+            bins.append({'items': [index], 'seconds': seconds, 'tokens': token_counts[index],
+                         'aligned': utterance['aligned']})
+    return [sorted(packed['items']) for packed in bins]
+
+
+def window_tokens(tokenizer, window, encode=None):
+    """
+    窓の学習用トークン列（SOTシーケンス + タイムスタンプ付きテキスト + EOT）
+    先頭30秒だけを使う録音はタイムスタンプなしで学習する。
+    Args:
+        encode (callable): テキストのトークナイズに使う関数（省略時はtokenizer.encode）
+    """
+    encode = encode or tokenizer.encode
+    if not window['aligned']:
+        return list(tokenizer.sot_sequence_including_notimestamps) + encode(window['text']) + [tokenizer.eot]
+    tokens = list(tokenizer.sot_sequence)
+    for start, end, text in window['segments']:
+        tokens.append(timestamp_token(tokenizer, start))
+        tokens.extend(encode(text))
+        tokens.append(timestamp_token(tokenizer, end))
+    tokens.append(tokenizer.eot)
+    return tokens
+
+
+def build_training_windows(samples, tokenizer, max_tokens=440, max_seconds=WINDOW_SECONDS, token_cache=None):
+    """
+    データセットのサンプルを30秒の学習用の窓にまとめる
+    短い発話は複数を1つの窓に連結し、長い録音はセグメントの境界で分割する。
+    Args:
+        samples (list): AudioTextDataset.samples の要素（'audio', 'transcript'）
+        tokenizer: Whisperのトークナイザ
+        max_tokens (int): 1窓あたりの最大トークン数
+        token_cache (TokenCache): トークンID列のキャッシュ（省略時は毎回トークナイズ）
+    Returns:
+        tuple: (窓のリスト, 統計)
+               窓は {'pieces': [(音声, 開始, 終了)], 'segments', 'text', 'tokens', 'seconds', 'aligned'}
+    """
+    utterances = []
+    recording_seconds = []
+    for sample in samples:
+        with open(sample['transcript'], 'r', encoding='utf-8') as f:
+            transcript = f.read().strip()
+        segments = load_segments(os.path.dirname(sample['transcript']))
+        utterances.extend(sample_utterances(sample['audio'], transcript, segments, max_seconds))
+        recording_seconds.append(min(max_seconds, audio_duration(sample['audio'])))
+
+    encode = token_cache.encode if token_cache else tokenizer.encode
+    token_counts = [utterance_token_count(encode, utterance) for utterance in utterances]
+    windows = []
+    for items in pack_utterances(utterances, token_counts, max_seconds, max_tokens):
+        pieces = []
+        segments = []
+        offset = 0.0
+        for index in items:
+            utterance = utterances[index]
+            pieces.append((utterance['audio'], utterance['start'], utterance['end']))
+            segments.extend((offset + start, offset + end, text) for start, end, text in utterance['segments'])
+            offset += utterance['end'] - utterance['start']
+        window = {
+            'pieces': pieces,
+            'segments': segments,
+            'text': ''.join(text for _, _, text in segments),
+            'seconds': offset,
+            'aligned': all(utterances[index]['aligned'] for index in items),
+        }
+        window['tokens'] = window_tokens(tokenizer, window, encode)
+        windows.append(window)
+
+    useful_seconds = sum(window['seconds'] for window in windows)
+    stats = {
+        'recordings': len(samples),
+        'utterances': len(utterances),
+        'windows': len(windows),
+        'useful_seconds': useful_seconds,
+        # 従来（録音ごとに1窓、30秒を超える分は切り捨て）の1回のエンコードあたりの有効音声秒数
+        'seconds_per_pass_unpacked': sum(recording_seconds) / len(samples) if samples else 0.0,
+        'seconds_per_pass': useful_seconds / len(windows) if windows else 0.0,
+    }
+    return windows, stats